@@ -1,3 +1,23 @@
-from .fetch import get_assembly, get_stimulus_set
+import importlib
+
 from .lookup import get_catalog, list_stimulus_sets, list_assemblies, list_catalogs
 
+# fetching and loading pull in boto3, xarray and netCDF4, so they are only imported when first used (PEP 562)
+_lazy_attributes = {
+    'get_assembly': 'fetch',
+    'get_stimulus_set': 'fetch',
+}
+_lazy_submodules = ['assemblies', 'cache', 'dtypes', 'fetch', 'packaging', 'stimuli', 'transform']
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        module = importlib.import_module(f"{__name__}.{_lazy_attributes[name]}")
+        return getattr(module, name)
+    if name in _lazy_submodules:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attributes) + _lazy_submodules)
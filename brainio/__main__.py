@@ -0,0 +1,81 @@
+import argparse
+import sys
+
+
+def verify(args):
+    from brainio.fetch import verify_local_data, get_local_data_path
+    report = verify_local_data(max_workers=args.workers)
+    for path, status in zip(report['path'], report['status']):
+        if status != "ok" or args.verbose:
+            print(f"{status}: {path}")
+    failures = (report['status'] != "ok").sum()
+    print(f"Verified {len(report)} files in {get_local_data_path()}: {len(report) - failures} ok, {failures} failed")
+    return 1 if failures > 0 else 0
+
+
+def cache_stats(args):
+    from brainio import cache
+    report = cache.stats()
+    for entry, size, last_access, pinned in report.itertuples(index=False):
+        print(f"{size:>16,d}  {last_access:%Y-%m-%d %H:%M}  {'pinned' if pinned else '      '}  {entry}")
+    budget = cache.get_budget()
+    print(f"{len(report)} entries, {report['size'].sum():,d} bytes"
+          + (f" of a {budget:,d} byte budget" if budget is not None else ""))
+    return 0
+
+
+def cache_gc(args):
+    from brainio import cache
+    if args.budget is None and cache.get_budget() is None:
+        print(f"No budget: pass --budget or set {cache.BRAINIO_CACHE_BUDGET}")
+        return 1
+    evicted = cache.gc(budget=args.budget, dry_run=args.dry_run)
+    for entry in evicted:
+        print(f"{'would evict' if args.dry_run else 'evicted'}: {entry}")
+    print(f"{len(evicted)} entries {'would be ' if args.dry_run else ''}evicted")
+    return 0
+
+
+def cache_pin(args):
+    from brainio import cache
+    for entry in cache.pin(args.identifier):
+        print(f"pinned: {entry}")
+    return 0
+
+
+def cache_unpin(args):
+    from brainio import cache
+    cache.unpin(args.identifier)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="brainio", description="Manage the local BrainIO data cache.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    verify_parser = subparsers.add_parser(
+        "verify", help="re-hash all previously verified files in the local cache and report any that changed")
+    verify_parser.add_argument("--workers", type=int, default=None, help="number of files hashed in parallel")
+    verify_parser.add_argument("--verbose", action="store_true", help="also list files that are ok")
+    verify_parser.set_defaults(func=verify)
+
+    cache_parser = subparsers.add_parser("cache", help="report and reclaim the space used by the local cache")
+    cache_subparsers = cache_parser.add_subparsers(dest="cache_command", required=True)
+    cache_subparsers.add_parser("stats", help="list cache entries, least recently used first") \
+        .set_defaults(func=cache_stats)
+    gc_parser = cache_subparsers.add_parser("gc", help="evict least recently used entries to fit the budget")
+    gc_parser.add_argument("--budget", default=None,
+                           help="budget in bytes, e.g. 500G. Defaults to the BRAINIO_CACHE_BUDGET environment variable")
+    gc_parser.add_argument("--dry-run", action="store_true", help="only list the entries that would be evicted")
+    gc_parser.set_defaults(func=cache_gc)
+    pin_parser = cache_subparsers.add_parser("pin", help="never evict the files of an assembly or stimulus set")
+    pin_parser.add_argument("identifier")
+    pin_parser.set_defaults(func=cache_pin)
+    unpin_parser = cache_subparsers.add_parser("unpin", help="allow evicting a pinned assembly or stimulus set")
+    unpin_parser.add_argument("identifier")
+    unpin_parser.set_defaults(func=cache_unpin)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,12 +5,13 @@ from collections import OrderedDict, defaultdict
 
 import itertools
 
-import netCDF4
 import numpy as np
 import pandas as pd
 import xarray as xr
 from xarray import DataArray, IndexVariable
 
+from brainio.dtypes import COMPACT_ATTRIBUTE
+
 BRAINIO_CHUNKS = 'BRAINIO_CHUNKS'
 
 _logger = logging.getLogger(__name__)
@@ -507,18 +508,36 @@ class StimulusMergeAssemblyLoader(StimulusReferenceAssemblyLoader):
         df_of_coords = pd.DataFrame(coords_for_dim(assy, dim_name))
         cols_to_use = stimulus_set.columns.difference(df_of_coords.columns.difference([index_column]))
         merged = df_of_coords.merge(stimulus_set[cols_to_use], on=index_column, how="left")
+        compacted = stimulus_set.attrs.get(COMPACT_ATTRIBUTE, False)
         for col in stimulus_set.columns:
-            assy[col] = (dim_name, merged[col])
+            assy[col] = (dim_name, widen_dtype(merged[col]) if compacted else merged[col])
         assy = self.assembly_class(data=assy)
         return assy
 
 
+def widen_dtype(values):
+    """
+    Reverts the compact dtypes of compacted stimulus set metadata (see :func:`brainio.dtypes.compact_dtypes`),
+    so that assembly coordinates have the same dtypes as if the metadata had not been compacted.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return np.asarray(values)
+    if values.dtype.kind == 'i':
+        return values.astype(np.int64)
+    if values.dtype.kind == 'u':
+        return values.astype(np.uint64)
+    if values.dtype.kind == 'f':
+        return values.astype(np.float64)
+    return values
+
+
 class GroupAppendAssemblyLoader(StimulusReferenceAssemblyLoader):
     """
     Loads an assembly plus any included metadata assemblies and a pointer to a stimulus set.
     """
 
     def load(self):
+        import netCDF4  # deferred since it is slow to import and only needed for group access
         result = super(GroupAppendAssemblyLoader, self).load()
         nc = netCDF4.Dataset(self.file_path, "r")
         for group in nc.groups:
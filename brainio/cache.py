@@ -0,0 +1,246 @@
+"""
+Keeps the local data directory (see :func:`brainio.fetch.get_local_data_path`) within a size budget.
+
+Every fetched file lives in a directory of its own in the local data directory, next to the stimuli extracted from it.
+These directories are the entries of the cache. An index records the size and last access of each entry,
+and when the budget is exceeded, the least recently used entries are evicted.
+Entries belonging to pinned identifiers are never evicted, and neither are the entries of assemblies and stimulus sets
+that any process sharing the local data directory is loading. Accesses are only recorded while a budget is set.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, ExitStack
+
+import pandas as pd
+
+from brainio.fetch import get_local_data_path, file_lock, filename_from_link, forget_verified, parse_size, \
+    remove_unused_locks, use_lock, _file_lookups, _write_json_atomic
+
+BRAINIO_CACHE_BUDGET = 'BRAINIO_CACHE_BUDGET'
+CACHE_INDEX = '.cache_index.json'
+
+_logger = logging.getLogger(__name__)
+_in_use = Counter()
+_in_use_lock = threading.Lock()
+
+
+def get_budget():
+    """
+    :return: the cache budget in bytes from the `BRAINIO_CACHE_BUDGET` environment variable, or None if unlimited
+    """
+    budget = os.getenv(BRAINIO_CACHE_BUDGET)
+    return parse_size(budget) if budget else None
+
+
+def _index_path():
+    return os.path.join(get_local_data_path(), CACHE_INDEX)
+
+
+def _read_index():
+    try:
+        with open(_index_path()) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    index.setdefault('entries', {})
+    index.setdefault('pins', {})
+    return index
+
+
+def _write_index(index):
+    os.makedirs(get_local_data_path(), exist_ok=True)
+    _write_json_atomic(_index_path(), index)
+
+
+def _entry_name(path):
+    relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(get_local_data_path()))
+    return relative_path.split(os.sep)[0]
+
+
+def _entry_names():
+    local_data_path = get_local_data_path()
+    if not os.path.isdir(local_data_path):
+        return []
+    return [name for name in os.listdir(local_data_path)
+            if not name.startswith('.') and os.path.isdir(os.path.join(local_data_path, name))]
+
+
+def _entry_size(entry_directory):
+    size = 0
+    for directory, _, filenames in os.walk(entry_directory):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(directory, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def _update_entry(entries, name, last_access=None):
+    """
+    Refreshes the size of an entry if its directory changed since it was last measured.
+    """
+    entry_directory = os.path.join(get_local_data_path(), name)
+    mtime_ns = os.stat(entry_directory).st_mtime_ns
+    entry = entries.get(name)
+    if entry is None or entry.get('mtime_ns') != mtime_ns:
+        entry = {'size': _entry_size(entry_directory), 'mtime_ns': mtime_ns,
+                 'last_access': entry['last_access'] if entry else mtime_ns / 1e9}
+    if last_access is not None:
+        entry['last_access'] = last_access
+    entries[name] = entry
+    return entry
+
+
+@contextmanager
+def in_use(names):
+    """
+    Protects the entries `names` from eviction by any process sharing the local data directory
+    while the block runs, e.g. while they are loaded.
+    """
+    names = sorted(set(names))
+    local_data_path = get_local_data_path()
+    # the process-wide count also protects the entries on platforms without file locks
+    with _in_use_lock:
+        _in_use.update(names)
+    try:
+        with ExitStack() as stack:
+            for name in names:
+                stack.enter_context(use_lock(os.path.join(local_data_path, name)))
+            yield
+    finally:
+        with _in_use_lock:
+            _in_use.subtract(names)
+            for name in names:
+                if _in_use[name] <= 0:
+                    del _in_use[name]
+
+
+def touch(path):
+    """
+    Records an access to the cache entry containing the local file `path`.
+    """
+    name = _entry_name(path)
+    if name.startswith('..'):  # not in the local data directory
+        return
+    with file_lock(_index_path()):
+        index = _read_index()
+        _update_entry(index['entries'], name, last_access=time.time())
+        _write_index(index)
+
+
+def stats():
+    """
+    :return: a DataFrame with one row per cache entry, least recently used first:
+        `entry`, `size` in bytes, `last_access` as a timestamp, and whether it is `pinned`
+    """
+    with file_lock(_index_path()):
+        index = _read_index()
+        entries = {name: _update_entry(index['entries'], name) for name in _entry_names()}
+        index['entries'] = entries
+        _write_index(index)
+    pinned_entries = _pinned_entries(index)
+    report = pd.DataFrame([{'entry': name, 'size': entry['size'],
+                            'last_access': pd.Timestamp(entry['last_access'], unit='s'),
+                            'pinned': name in pinned_entries} for name, entry in entries.items()],
+                          columns=['entry', 'size', 'last_access', 'pinned'])
+    return report.sort_values('last_access', ignore_index=True)
+
+
+def gc(budget=None, keep=(), dry_run=False):
+    """
+    Evicts least recently used entries until the cache fits into the budget.
+    Pinned entries, entries with downloads in progress, entries in use (see :func:`in_use`),
+    and the entries in `keep` are never evicted. Lock files that are no longer held are removed as well.
+    :param budget: the budget in bytes, by default :func:`get_budget`. Without a budget nothing is evicted.
+    :param keep: names of entries to keep regardless, e.g. the ones that were just fetched
+    :param dry_run: only report the entries that would be evicted
+    :return: the names of the evicted entries
+    """
+    budget = budget if budget is not None else get_budget()
+    if budget is None:
+        return []
+    budget = parse_size(budget)
+    local_data_path = get_local_data_path()
+    evicted = []
+    with file_lock(_index_path()):
+        index = _read_index()
+        entries = {name: _update_entry(index['entries'], name) for name in _entry_names()}
+        total = sum(entry['size'] for entry in entries.values())
+        protected = _pinned_entries(index) | set(keep)
+        for name, entry in sorted(entries.items(), key=lambda item: item[1]['last_access']):
+            if total <= budget:
+                break
+            entry_directory = os.path.join(local_data_path, name)
+            if name in protected or _is_in_use(name) or _has_partial_downloads(entry_directory):
+                continue
+            if not dry_run:
+                # entries that are being loaded, fetched or extracted are skipped rather than waited for,
+                # so that other processes can keep recording accesses to the index in the meantime
+                try:
+                    with use_lock(entry_directory, exclusive=True, blocking=False), \
+                            file_lock(entry_directory, blocking=False):
+                        if _is_in_use(name):
+                            continue
+                        for filename in os.listdir(entry_directory):
+                            forget_verified(os.path.join(entry_directory, filename))
+                        shutil.rmtree(entry_directory, ignore_errors=True)
+                except BlockingIOError:
+                    _logger.debug(f"Not evicting {entry_directory} while it is in use")
+                    continue
+                del entries[name]
+            _logger.debug(f"Evicted {entry_directory} ({entry['size']} bytes)")
+            evicted.append(name)
+            total -= entry['size']
+        index['entries'] = entries
+        if not dry_run:
+            _write_index(index)
+    if not dry_run:
+        remove_unused_locks()
+    if total > budget:
+        _logger.warning(f"Cache size {total} exceeds the budget of {budget} bytes with all evictable entries evicted")
+    return evicted
+
+
+def _is_in_use(name):
+    with _in_use_lock:
+        return name in _in_use
+
+
+def _has_partial_downloads(entry_directory):
+    return any(filename.endswith(".partial") for filename in os.listdir(entry_directory))
+
+
+def _pinned_entries(index):
+    return {name for names in index['pins'].values() for name in names}
+
+
+def pin(identifier):
+    """
+    Protects the files of an assembly (including its stimulus set) or a stimulus set from eviction.
+    """
+    names = sorted({filename_from_link(file_lookup['location']) for file_lookup in _file_lookups(identifier)})
+    with file_lock(_index_path()):
+        index = _read_index()
+        index['pins'][identifier] = names
+        _write_index(index)
+    return names
+
+
+def unpin(identifier):
+    with file_lock(_index_path()):
+        index = _read_index()
+        index['pins'].pop(identifier, None)
+        _write_index(index)
+
+
+def pinned():
+    """
+    :return: the pinned identifiers
+    """
+    return sorted(_read_index()['pins'])
@@ -1,15 +1,32 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+from contextlib import closing
 from pathlib import Path
 
 import pandas as pd
 from pandas import DataFrame
 
+from brainio.dtypes import compact_dtypes, compact_metadata_enabled
+
 
 SOURCE_CATALOG = "source_catalog"
+SIDECAR_SUFFIX = ".pkl"
+SIDECARS_DIRECTORY = '.catalogs'
+# bump whenever CatalogLoader parses CSV files differently, so that sidecars of the previous format are ignored
+SIDECAR_VERSION = 2
+CATALOG_COLUMNS = ['identifier', 'lookup_type', 'class', 'location_type', 'location', 'sha1',
+                   'stimulus_set_identifier']
+STORAGE_SQLITE = "sqlite"
+
+_logger = logging.getLogger(__name__)
 
 
 class Catalog(DataFrame):
     # http://pandas.pydata.org/pandas-docs/stable/development/extending.html#subclassing-pandas-data-structures
-    _metadata = pd.DataFrame._metadata + ["identifier", "url", "get_loader_class", "from_files"]
+    _metadata = pd.DataFrame._metadata + ["identifier", "url", "get_loader_class", "from_files", "from_sqlite"]
 
     @property
     def _constructor(self):
@@ -30,20 +47,209 @@ class Catalog(DataFrame):
         )
         return loader.load()
 
+    @classmethod
+    def from_sqlite(cls, identifier, db_path, url=None):
+        loader = SQLiteCatalogLoader(
+            cls=cls,
+            identifier=identifier,
+            db_path=db_path,
+            url=url
+        )
+        return loader.load()
+
 
 class CatalogLoader:
+    """
+    Loads a Catalog from a CSV file. With the `BRAINIO_COMPACT_METADATA` environment variable set,
+    repeated strings such as lookup types are stored as categoricals (see :func:`brainio.dtypes.compact_dtypes`).
+    The parsed frame is cached in a binary sidecar in the local data directory which is reused
+    as long as the CSV file's size, modification time and SHA-1 hash, the sidecar format, the pandas version
+    and whether the catalog is compacted are unchanged.
+    """
     def __init__(self, cls, identifier, csv_path, url=None):
         self.cls = cls
         self.identifier = identifier
         self.csv_path = Path(csv_path)
+        self.sidecar_path = self._sidecar_path(self.csv_path)
         self.url = url
 
+    @staticmethod
+    def _sidecar_path(csv_path):
+        from brainio.fetch import get_local_data_path  # fetching is built on top of the catalogs
+        # catalogs are often installed with their package, so the sidecars are kept in the local data directory
+        path_hash = hashlib.sha1(str(csv_path.absolute()).encode()).hexdigest()[:16]
+        return Path(get_local_data_path()) / SIDECARS_DIRECTORY / f"{csv_path.name}.{path_hash}{SIDECAR_SUFFIX}"
+
     def load(self):
-        catalog = pd.read_csv(self.csv_path)
+        signature = self._csv_signature()
+        catalog = self.read_sidecar(signature)
+        if catalog is None:
+            catalog = pd.read_csv(self.csv_path)
+            if compact_metadata_enabled():
+                catalog = compact_dtypes(catalog, description=self.csv_path)
+            self.write_sidecar(catalog, signature)
         catalog = self.cls(catalog)
         catalog.identifier = self.identifier
         catalog.attrs['source_path'] = self.csv_path
         catalog.url = self.url
         return catalog
 
+    def _csv_signature(self):
+        stat = os.stat(self.csv_path)
+        return stat.st_size, stat.st_mtime_ns, SIDECAR_VERSION, pd.__version__, compact_metadata_enabled()
+
+    def _csv_sha1(self):
+        with open(self.csv_path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha1').hexdigest()
+
+    def read_sidecar(self, signature):
+        """
+        :param signature: the current size and modification time of the CSV file, the sidecar format version,
+            the pandas version and whether the catalog is compacted
+        :return: the cached catalog frame, or None if there is no sidecar or it does not match the CSV file
+        """
+        try:
+            with open(self.sidecar_path, 'rb') as f:
+                sidecar = pickle.load(f)
+            if sidecar.get('signature') != signature or sidecar['sha1'] != self._csv_sha1():
+                _logger.debug(f"Catalog sidecar {self.sidecar_path} is out of date")
+                return None
+            return sidecar['frame']
+        except FileNotFoundError:
+            return None
+        except Exception:
+            _logger.debug(f"Could not read catalog sidecar {self.sidecar_path}", exc_info=True)
+            return None
+
+    def write_sidecar(self, frame, signature):
+        sidecar = {'signature': signature, 'sha1': self._csv_sha1(), 'frame': pd.DataFrame(frame)}
+        tmp_path = self.sidecar_path.with_name(f"{self.sidecar_path.name}.{os.getpid()}.tmp")
+        try:
+            self.sidecar_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(sidecar, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.sidecar_path)
+        except OSError:  # e.g. a read-only data directory
+            _logger.debug(f"Could not write catalog sidecar {self.sidecar_path}", exc_info=True)
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+
+class SQLiteCatalogLoader:
+    """
+    Loads a Catalog from a :class:`SQLiteCatalogStore`.
+    """
+    def __init__(self, cls, identifier, db_path, url=None):
+        self.cls = cls
+        self.identifier = identifier
+        self.db_path = Path(db_path)
+        self.url = url
+
+    def load(self):
+        catalog = SQLiteCatalogStore(self.db_path).read()
+        catalog = self.cls(catalog)
+        catalog.identifier = self.identifier
+        catalog.attrs['source_path'] = self.db_path
+        catalog.attrs['storage'] = STORAGE_SQLITE
+        catalog.url = self.url
+        return catalog
+
+
+class SQLiteCatalogStore:
+    """
+    Stores the rows of a catalog in a local SQLite file.
+    Rows are indexed by identifier and lookup type, so that duplicate checks do not scan the catalog,
+    and appends are transactional, so that several processes can append to the same catalog.
+    """
+    TABLE = "lookups"
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = Path(db_path)
+        self.timeout = timeout
+        columns = ", ".join(f'"{column}" TEXT' for column in CATALOG_COLUMNS)
+        with self._connect() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {self.TABLE} (row_id INTEGER PRIMARY KEY, {columns})')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {self.TABLE}_identifier '
+                               f'ON {self.TABLE} (identifier, lookup_type)')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {self.TABLE}_stimulus_set_identifier '
+                               f'ON {self.TABLE} (stimulus_set_identifier)')
+
+    def _connect(self):
+        # autocommit mode, transactions are managed explicitly
+        connection = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+        return closing(connection)
+
+    def read(self):
+        with self._connect() as connection:
+            return self._select(connection)
+
+    def find(self, identifier, lookup_type):
+        with self._connect() as connection:
+            return self._select(connection, identifier=identifier, lookup_type=lookup_type)
+
+    def _select(self, connection, identifier=None, lookup_type=None):
+        columns = ", ".join(f'"{column}"' for column in CATALOG_COLUMNS)
+        query = f'SELECT {columns} FROM {self.TABLE}'
+        params = ()
+        if identifier is not None:
+            query += ' WHERE identifier = ? AND lookup_type = ?'
+            params = (identifier, lookup_type)
+        query += ' ORDER BY row_id'
+        return pd.read_sql_query(query, connection, params=params)
+
+    def append(self, rows, check_duplicates=None):
+        """
+        Appends `rows` in a single transaction.
+        :param rows: a DataFrame with the catalog columns
+        :param check_duplicates: an optional callable `(existing_rows, new_rows) -> None`
+            that is called with the existing rows matching any identifier and lookup type in `rows`
+            while the database is locked for writing, and raises to abort the append.
+        """
+        rows = pd.DataFrame(rows).reindex(columns=CATALOG_COLUMNS)
+        values = [tuple(None if pd.isna(value) else value for value in row)
+                  for row in rows.itertuples(index=False, name=None)]
+        columns = ", ".join(f'"{column}"' for column in CATALOG_COLUMNS)
+        placeholders = ", ".join("?" for _ in CATALOG_COLUMNS)
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')  # acquire the write lock before checking for duplicates
+            try:
+                if check_duplicates is not None:
+                    check_duplicates(self._select_matching(connection, rows), rows)
+                connection.executemany(f'INSERT INTO {self.TABLE} ({columns}) VALUES ({placeholders})', values)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    def _select_matching(self, connection, rows):
+        """
+        :return: the stored rows with the same identifier and lookup type as any of `rows`
+        """
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS append_keys (identifier TEXT, lookup_type TEXT)')
+        connection.execute('DELETE FROM append_keys')
+        connection.executemany('INSERT INTO append_keys VALUES (?, ?)',
+                               rows[['identifier', 'lookup_type']].drop_duplicates().itertuples(index=False))
+        columns = ", ".join(f'lookups."{column}"' for column in CATALOG_COLUMNS)
+        return pd.read_sql_query(f'SELECT {columns} FROM {self.TABLE} AS lookups '
+                                 f'JOIN append_keys USING (identifier, lookup_type) ORDER BY row_id', connection)
+
+    def export_csv(self, csv_path):
+        """
+        Writes the catalog to a CSV file following the BrainIO catalog specification.
+        """
+        self.read().to_csv(csv_path, index=False)
+
+    @classmethod
+    def from_csv(cls, csv_path, db_path):
+        """
+        Creates a store at `db_path` with the rows of the catalog CSV file at `csv_path`.
+        :raises ValueError: if there already is a store with rows at `db_path`,
+            whose rows could duplicate those of the CSV file
+        """
+        store = cls(db_path)
+        with store._connect() as connection:
+            if connection.execute(f'SELECT EXISTS (SELECT 1 FROM {cls.TABLE})').fetchone()[0]:
+                raise ValueError(f"Catalog store {db_path} already has rows, append to it instead")
+        store.append(pd.read_csv(csv_path))
+        return store
 
@@ -0,0 +1,90 @@
+"""
+Compact dtypes for metadata tables such as catalogs and stimulus sets,
+which often repeat the same strings in many rows and store small numbers as 64-bit values.
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+BRAINIO_COMPACT_METADATA = 'BRAINIO_COMPACT_METADATA'
+COMPACT_ATTRIBUTE = 'compact_dtypes'  # set in the `attrs` of frames converted by compact_dtypes
+
+_logger = logging.getLogger(__name__)
+
+
+def compact_metadata_enabled():
+    """
+    :return: whether metadata tables are loaded with compact dtypes,
+        according to the `BRAINIO_COMPACT_METADATA` environment variable (disabled by default)
+    """
+    return os.getenv(BRAINIO_COMPACT_METADATA, '').lower() in ('1', 'true', 'yes')
+
+
+def infer_compact_dtypes(frame, exclude=(), max_category_ratio=0.5):
+    """
+    :param max_category_ratio: the highest ratio of distinct values to rows of a column stored as a categorical
+    :return: a dict with a compact dtype for every column of `frame` that can be stored more compactly:
+        `category` for string columns with repeated values,
+        and the smallest integer or float dtype that holds all values of numeric columns exactly
+    """
+    dtypes = {}
+    for column in frame.columns:
+        if column in exclude:
+            continue
+        values = frame[column]
+        if values.dtype == object:
+            if len(values) > 0 and pd.api.types.infer_dtype(values, skipna=True) == 'string' \
+                    and values.nunique(dropna=False) <= max_category_ratio * len(values):
+                dtypes[column] = 'category'
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            downcast = pd.to_numeric(values, downcast='integer').dtype
+            if downcast.itemsize < values.dtype.itemsize:
+                dtypes[column] = str(downcast)
+        elif values.dtype == np.float64:
+            if np.array_equal(values.to_numpy().astype(np.float32).astype(np.float64), values.to_numpy(),
+                              equal_nan=True):
+                dtypes[column] = 'float32'
+    return dtypes
+
+
+def compact_dtypes(frame, dtypes=None, exclude=(), description=None):
+    """
+    Converts the columns of `frame` to compact dtypes, to reduce the memory used by large metadata tables.
+    :param dtypes: a dict of dtypes per column, e.g. from a dtypes sidecar. By default, dtypes are inferred with
+        :func:`infer_compact_dtypes`. Columns whose values do not fit their dtype are inferred as well.
+    :param exclude: columns to leave as they are
+    :param description: a name for `frame` in log messages
+    :return: `frame` with its columns converted, marked with `COMPACT_ATTRIBUTE` in its `attrs`
+    """
+    debug = _logger.isEnabledFor(logging.DEBUG)
+    before = int(frame.memory_usage(deep=True).sum()) if debug else None
+    inferred = None
+    if dtypes is None:
+        dtypes = inferred = infer_compact_dtypes(frame, exclude=exclude)
+    for column, dtype in dtypes.items():
+        if column not in frame.columns or column in exclude:
+            continue
+        try:
+            frame[column] = _astype_exact(frame[column], dtype)
+        except (ValueError, TypeError):
+            if inferred is None:
+                inferred = infer_compact_dtypes(frame, exclude=exclude)
+            _logger.debug(f"Column {column} does not fit dtype {dtype}, using {inferred.get(column)} instead")
+            if column in inferred:
+                frame[column] = frame[column].astype(inferred[column])
+    frame.attrs[COMPACT_ATTRIBUTE] = True
+    if debug:
+        after = int(frame.memory_usage(deep=True).sum())
+        _logger.debug(f"Compacted metadata{' of ' + str(description) if description else ''}: "
+                      f"{before:,d} -> {after:,d} bytes ({before - after:,d} bytes saved)")
+    return frame
+
+
+def _astype_exact(values, dtype):
+    converted = values.astype(dtype)
+    if converted.dtype.kind in 'biuf' and values.dtype.kind in 'biuf' and not np.array_equal(
+            converted.to_numpy().astype(values.dtype), values.to_numpy(), equal_nan=values.dtype.kind == 'f'):
+        raise ValueError(f"Values of {values.name} change when converted to {dtype}")
+    return converted
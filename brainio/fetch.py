@@ -1,25 +1,64 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import errno
+import hashlib
+import inspect
+import json
 import logging
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 import zipfile
-from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import boto3
-from botocore import UNSIGNED
-from botocore.config import Config
+import numpy as np
+import pandas as pd
 from six.moves.urllib.parse import urlparse
-from tqdm import tqdm
+from six.moves.urllib.request import url2pathname
 
-import brainio.assemblies as assemblies
 import brainio.stimuli as stimuli
-from brainio.lookup import lookup_assembly, lookup_stimulus_set, sha1_hash
-from brainio.stimuli import StimulusSetLoader
+from brainio.lookup import lookup_assembly, lookup_stimulus_set, sha1_hash, AssemblyLookupError, \
+    KIND, KIND_ZIP
+from brainio.stimuli import StimulusSetLoader, StimulusPaths, ZipStimulusStore, RemoteZipStimulusStore
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, locks then only apply within a process
+    fcntl = None
 
 BRAINIO_HOME = 'BRAINIO_HOME'
+BRAINIO_SHARED_HOME = 'BRAINIO_SHARED_HOME'
+BRAINIO_DOWNLOAD_THREADS = 'BRAINIO_DOWNLOAD_THREADS'
+BRAINIO_DOWNLOAD_PART_SIZE = 'BRAINIO_DOWNLOAD_PART_SIZE'
+BRAINIO_PARANOID = 'BRAINIO_PARANOID'
+BRAINIO_MEMORY_CACHE = 'BRAINIO_MEMORY_CACHE'
+BRAINIO_MEMORY_CACHE_MODE = 'BRAINIO_MEMORY_CACHE_MODE'
+BRAINIO_STIMULUS_SET_CACHE = 'BRAINIO_STIMULUS_SET_CACHE'
+BRAINIO_ATOMIC_UNZIP = 'BRAINIO_ATOMIC_UNZIP'
+BRAINIO_STIMULUS_MODE = 'BRAINIO_STIMULUS_MODE'
+STIMULUS_MODE_FILES = 'files'
+STIMULUS_MODE_ZIP = 'zip'
+STIMULUS_MODE_REMOTE = 'remote'
+VERIFIED_DIRECTORY = '.verified'
+LOCKS_DIRECTORY = '.locks'
+LOCK_SUFFIX = '.lock'
+USE_LOCK_SUFFIX = '.use'
+MB = 2 ** 20
 
 _logger = logging.getLogger(__name__)
 _local_data_path = None
+_shared_data_paths = None
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+_memory_cache = None
+_stimulus_set_memo = None
+_stimulus_set_locks = {}  # key -> (lock, number of threads using it)
+_units = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
 
 
 def get_local_data_path():
@@ -30,28 +69,518 @@ def get_local_data_path():
     return _local_data_path
 
 
+def get_shared_data_paths():
+    """
+    The shared tiers are read-only directories with the same layout as the local data path,
+    e.g. a data directory on a network filesystem that is populated once for a whole cluster.
+    Files found there are copied into the (fast, node-local) local data path on first access.
+    :return: the directories listed in the `BRAINIO_SHARED_HOME` environment variable, separated by `os.pathsep`
+    """
+    global _shared_data_paths
+    if _shared_data_paths is None:
+        _shared_data_paths = [os.path.expanduser(path)
+                              for path in os.getenv(BRAINIO_SHARED_HOME, '').split(os.pathsep) if path]
+    return _shared_data_paths
+
+
+def get_data_paths():
+    """
+    :return: all data tiers in the order in which they are searched: the local data path first, then the shared ones
+    """
+    return [get_local_data_path()] + get_shared_data_paths()
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Holds an exclusive advisory lock for the local file `path`, blocking until it is available.
+    Processes sharing the same `BRAINIO_HOME` wait for each other, as do threads within one process.
+    The lock files are kept in a separate directory so that they never show up next to the data,
+    and are removed by :func:`remove_unused_locks`.
+    :param blocking: if False, raise `BlockingIOError` instead of waiting when the lock is held
+    """
+    lock_path = _lock_path(path)
+    # POSIX locks are held per process, so threads additionally need to be excluded from each other
+    thread_lock = _acquire_thread_lock(lock_path, blocking=blocking)
+    if thread_lock is None:
+        raise BlockingIOError(f"{path} is locked")
+    try:
+        if fcntl is None:
+            yield
+            return
+        _logger.debug(f"Acquiring lock for {path}")
+        try:
+            lock_file = _open_locked(lock_path, fcntl.lockf, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except PermissionError as e:  # some platforms report a held lock as EACCES
+            if blocking or e.errno != errno.EACCES:
+                raise
+            raise BlockingIOError(f"{path} is locked") from e
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+    finally:
+        thread_lock.release()
+
+
+@contextmanager
+def use_lock(path, exclusive=False, blocking=True):
+    """
+    Marks the local file or directory `path` as in use, e.g. by the processes reading it,
+    so that it is not removed from under them (see :func:`brainio.cache.gc`).
+    Any number of shared locks can be held at the same time, but they exclude an exclusive lock, e.g. for removal.
+    Unlike :func:`file_lock`, these locks belong to their open file,
+    so they exclude each other in threads of the same process as well.
+    :param exclusive: hold an exclusive lock instead of a shared one
+    :param blocking: if False, raise `BlockingIOError` instead of waiting when the lock is not available
+    """
+    if fcntl is None:
+        yield
+        return
+    operation = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB)
+    with _open_locked(_lock_path(path)[:-len(LOCK_SUFFIX)] + USE_LOCK_SUFFIX, fcntl.flock, operation):
+        yield
+
+
+def _open_locked(lock_path, lock, operation):
+    """
+    :param lock: `fcntl.lockf` or `fcntl.flock`
+    :return: the lock file at `lock_path`, locked
+    """
+    while True:
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        lock_file = open(lock_path, 'a')
+        try:
+            lock(lock_file, operation)
+            if _is_current_lock_file(lock_file, lock_path):
+                return lock_file
+        except BaseException:
+            lock_file.close()
+            raise
+        lock_file.close()  # the lock file was removed while waiting for it, lock the new one
+
+
+def _acquire_thread_lock(lock_path, blocking=True):
+    """
+    :return: the acquired thread lock of `lock_path`, or None if it is held and `blocking` is False
+    """
+    while True:
+        with _thread_locks_lock:
+            thread_lock = _thread_locks.setdefault(lock_path, threading.Lock())
+        if not thread_lock.acquire(blocking=blocking):
+            return None
+        with _thread_locks_lock:
+            if _thread_locks.get(lock_path) is thread_lock:
+                return thread_lock
+        thread_lock.release()  # dropped by remove_unused_locks while waiting for it
+
+
+def _lock_path(path):
+    return os.path.join(get_local_data_path(), LOCKS_DIRECTORY,
+                        hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + LOCK_SUFFIX)
+
+
+def _is_current_lock_file(lock_file, lock_path):
+    try:
+        stat = os.stat(lock_path)
+    except FileNotFoundError:
+        return False
+    return os.path.samestat(os.fstat(lock_file.fileno()), stat)
+
+
+def remove_unused_locks():
+    """
+    Removes the lock files (see :func:`file_lock` and :func:`use_lock`)
+    that are not held by any thread or process at the moment.
+    :return: the number of removed lock files
+    """
+    locks_directory = os.path.join(get_local_data_path(), LOCKS_DIRECTORY)
+    if fcntl is None or not os.path.isdir(locks_directory):
+        return 0
+    removed = 0
+    for filename in os.listdir(locks_directory):
+        lock_path = os.path.join(locks_directory, filename)
+        if filename.endswith(USE_LOCK_SUFFIX):
+            removed += _remove_if_unlocked(lock_path, fcntl.flock)
+            continue
+        # closing another handle of a file releases this process' locks on it, so never open a lock held here,
+        # and keep other threads from locking it until the handle is closed
+        thread_lock = _acquire_thread_lock(lock_path, blocking=False)
+        if thread_lock is None:
+            continue
+        try:
+            removed += _remove_if_unlocked(lock_path, fcntl.lockf)
+        finally:
+            with _thread_locks_lock:
+                del _thread_locks[lock_path]  # threads that wait for it start over, see _acquire_thread_lock
+            thread_lock.release()
+    return removed
+
+
+def _remove_if_unlocked(lock_path, lock):
+    """
+    :return: 1 if the lock file was removed, 0 if it is held
+    """
+    try:
+        with open(lock_path, 'a') as lock_file:
+            try:
+                lock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:  # held by another process
+                return 0
+            # waiting processes notice that the file is gone once they acquire it, see _open_locked
+            if _is_current_lock_file(lock_file, lock_path):
+                os.remove(lock_path)
+                return 1
+    except FileNotFoundError:  # removed by another process in the meantime
+        pass
+    return 0
+
+
+class DownloadConfig(object):
+    """
+    Settings for parallel ranged downloads, modeled after boto3's `TransferConfig`.
+    :param max_concurrency: the number of parts downloaded at the same time,
+        by default the value of the `BRAINIO_DOWNLOAD_THREADS` environment variable or 10.
+    :param part_size: the size in bytes of each ranged request,
+        by default the value of the `BRAINIO_DOWNLOAD_PART_SIZE` environment variable or 8 MB.
+    :param multipart_threshold: objects up to this size in bytes are downloaded with a single request,
+        by default `part_size`.
+    """
+
+    def __init__(self, max_concurrency=None, part_size=None, multipart_threshold=None):
+        self.max_concurrency = max_concurrency or int(os.getenv(BRAINIO_DOWNLOAD_THREADS, 10))
+        self.part_size = part_size or int(os.getenv(BRAINIO_DOWNLOAD_PART_SIZE, 8 * MB))
+        self.multipart_threshold = multipart_threshold or self.part_size
+
+    def parts(self, size):
+        """
+        :return: the inclusive `(start, end)` byte ranges to download an object of `size` bytes
+        """
+        if size <= self.multipart_threshold:
+            return [(0, size - 1)] if size > 0 else []
+        return [(start, min(start + self.part_size, size) - 1) for start in range(0, size, self.part_size)]
+
+
+def download_ranges(size, read_range, target_path, config=None, progress=None, hasher=None,
+                    offset=0, checkpoint=None):
+    """
+    Downloads an object of `size` bytes as concurrent byte ranges into a preallocated file.
+    :param size: the size of the object in bytes
+    :param read_range: a callable `(start, end) -> bytes` returning the object's bytes from `start` to `end` inclusive.
+        It is called from several threads at once.
+    :param target_path: the file to write to
+    :param config: a :class:`DownloadConfig`
+    :param progress: an optional callable that receives the number of bytes written after each part
+    :param hasher: an optional `hashlib` hash object that is updated with the object's bytes in order,
+        so that the file does not need to be read again to verify it.
+        Parts that arrive early are held in memory until all preceding parts are hashed,
+        and at most `2 * max_concurrency` parts are in flight beyond the last hashed one.
+    :param offset: the number of bytes at the start of `target_path` that are already downloaded, to resume from.
+        The hasher is expected to be updated with these bytes already.
+    :param checkpoint: an optional callable that receives the number of bytes from the start of the file
+        that are completely written (and hashed), whenever that number grows
+    """
+    config = config or DownloadConfig()
+    parts = [(start + offset, end + offset) for start, end in config.parts(size - offset)]
+    order_lock = threading.Lock()
+    pending = {}  # part index -> data (if hashing) of completed parts waiting for preceding parts
+    next_index = 0
+    window = threading.Semaphore(2 * config.max_concurrency)
+    failed = threading.Event()
+
+    def complete_in_order(index, data):
+        nonlocal next_index
+        with order_lock:
+            pending[index] = data
+            if next_index not in pending:
+                return
+            while next_index in pending:
+                data = pending.pop(next_index)
+                if hasher is not None:
+                    hasher.update(data)
+                next_index += 1
+                window.release()
+            if checkpoint is not None:
+                checkpoint(parts[next_index - 1][1] + 1)
+
+    with open(target_path, 'r+b' if offset > 0 else 'wb') as target_file, _PositionalWriter(target_file) as writer:
+        target_file.truncate(size)
+
+        def download_part(index, part):
+            try:
+                start, end = part
+                data = read_range(start, end)
+                if len(data) != end - start + 1:
+                    raise IOError(f"Expected {end - start + 1} bytes for range {start}-{end}, received {len(data)}")
+                writer.write(data, start)
+                if progress is not None:
+                    progress(len(data))
+                complete_in_order(index, data if hasher is not None else None)
+            except BaseException:
+                failed.set()
+                window.release()  # wake up the scheduler so that it stops submitting parts
+                raise
+
+        if len(parts) <= 1:
+            for index, part in enumerate(parts):
+                download_part(index, part)
+            return
+        with ThreadPoolExecutor(max_workers=min(config.max_concurrency, len(parts))) as executor:
+            futures = []
+            try:
+                for index, part in enumerate(parts):
+                    if hasher is not None:
+                        window.acquire()
+                    if failed.is_set():
+                        break
+                    futures.append(executor.submit(download_part, index, part))
+                for future in futures:
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+
+class _PositionalWriter(object):
+    """
+    Writes to positions of a file from several threads at once:
+    with `os.pwrite` where available, and otherwise (e.g. on Windows) with a file handle per thread.
+    """
+
+    def __init__(self, target_file):
+        self.target_file = target_file
+        self._local = threading.local()
+        self._handles = []
+        self._handles_lock = threading.Lock()
+
+    def write(self, data, position):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self.target_file.fileno(), data, position)
+            return
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            self.target_file.flush()
+            handle = self._local.handle = open(self.target_file.name, 'r+b')
+            with self._handles_lock:
+                self._handles.append(handle)
+        handle.seek(position)
+        handle.write(data)
+
+    def close(self):
+        with self._handles_lock:
+            for handle in self._handles:
+                handle.close()
+            self._handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+_bucket_signing = {}
+
+
+def get_s3_client(signed=True, max_pool_connections=10):
+    """
+    Returns an S3 client from a process-wide pool, creating it on first use.
+    boto3 clients are thread-safe, so one client is shared by all downloads with the same configuration.
+    :param signed: whether requests are signed with the default credentials. Unsigned clients access public buckets.
+    :param max_pool_connections: the size of the client's connection pool,
+        i.e. how many requests it can make concurrently
+    """
+    key = (signed, max_pool_connections)
+    with _s3_clients_lock:
+        if key not in _s3_clients:
+            import boto3
+            from botocore import UNSIGNED
+            from botocore.config import Config
+            config = Config(max_pool_connections=max_pool_connections)
+            if not signed:
+                # disable signing requests. see https://stackoverflow.com/a/34866092/2225200
+                config = config.merge(Config(signature_version=UNSIGNED))
+            # sessions are not thread-safe, create the client from a session of its own
+            _s3_clients[key] = boto3.session.Session().client('s3', config=config)
+        return _s3_clients[key]
+
+
+class HashMismatchError(IOError):
+    pass
+
+
 class Fetcher(object):
-    """A Fetcher obtains data with which to populate a DataAssembly.  """
+    """
+    A Fetcher obtains data with which to populate a DataAssembly.
+    Files are looked up in the local data path first, then promoted from a shared tier,
+    and only downloaded from `location` if no tier has them.
+    """
 
-    def __init__(self, location, local_filename):
+    def __init__(self, location, local_filename, sha1=None, download_config=None):
+        """
+        :param sha1: the expected SHA-1 hash of the file. The hash is computed while the file is written,
+            and a file that does not match is never moved into place.
+        :param download_config: a :class:`DownloadConfig` for fetchers that download in parallel byte ranges
+        """
         self.location = location
         self.local_filename = local_filename
+        self.sha1 = sha1
+        self.download_config = download_config or DownloadConfig()
+        self.downloaded_sha1 = None  # the hash of the downloaded bytes, once downloaded
         self.local_dir_path = os.path.join(get_local_data_path(), self.local_filename)
+        self.output_filename = os.path.join(self.local_dir_path, os.path.basename(urlparse(location).path))
         os.makedirs(self.local_dir_path, exist_ok=True)
+        self._logger = logging.getLogger(fullname(self))
 
     def fetch(self):
         """
         Fetches the resource identified by location.
         :return: a full local file path
         """
-        raise NotImplementedError("The base Fetcher class does not implement .fetch().  Use a subclass of Fetcher.")
+        if not os.path.exists(self.output_filename):
+            if not self.promote():
+                self.download()
+        return self.output_filename
+
+    def download(self):
+        """
+        Downloads the resource identified by location to `self.output_filename`.
+        """
+        raise NotImplementedError("The base Fetcher class does not implement .download().  Use a subclass of Fetcher.")
+
+    def open_ranges(self):
+        """
+        Gives random access to the resource identified by location without downloading it.
+        :return: the size of the resource in bytes, and a function `read_range(start, end)`
+            that returns the bytes from `start` to `end` (inclusive), see :func:`download_ranges`
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support reading byte ranges")
+
+    def shared_filenames(self):
+        relative_path = os.path.relpath(self.output_filename, get_local_data_path())
+        return [os.path.join(shared_path, relative_path) for shared_path in get_shared_data_paths()]
+
+    def promote(self):
+        """
+        Copies the file from the first shared tier that has it into the local data path, verifying its hash on the way.
+        :return: whether the file was promoted
+        """
+        for shared_filename in self.shared_filenames():
+            if not os.path.isfile(shared_filename):
+                continue
+            try:
+                self.copy_file(shared_filename)
+            except HashMismatchError as e:
+                self._logger.warning(f"Ignoring {shared_filename}: {e}")
+                continue
+            self._logger.debug(f"Promoted {shared_filename} to {self.output_filename}")
+            return True
+        return False
+
+    def copy_file(self, source_filename):
+        """
+        Copies `source_filename` to `self.output_filename`, hashing the bytes as they are copied.
+        """
+        partial_filename = self.output_filename + ".partial"
+        hasher = hashlib.sha1()
+        try:
+            with open(source_filename, 'rb') as source, open(partial_filename, 'wb') as target:
+                buffer = bytearray(MB)
+                read = source.readinto(buffer)
+                while read > 0:
+                    hasher.update(memoryview(buffer)[:read])
+                    target.write(memoryview(buffer)[:read])
+                    read = source.readinto(buffer)
+            self._check_hash(hasher, source_filename)
+        except BaseException:
+            _remove_if_exists(partial_filename)
+            raise
+        self._move_into_place(partial_filename)
+
+    def download_resumable(self, size, etag, read_range, description):
+        """
+        Downloads into a `.partial` file which is moved into place once complete and verified.
+        Progress is recorded next to the partial file, so that an interrupted download of the same object
+        resumes where it left off.
+        :param size: the size of the object in bytes
+        :param etag: an identifier of the object's version, to not resume from the bytes of a different version
+        :param read_range: see :func:`download_ranges`
+        :param description: a label for the progress bar
+        """
+        from tqdm import tqdm
+        partial_filename = self.output_filename + ".partial"
+        progress_filename = partial_filename + ".json"
+        hasher = hashlib.sha1()
+        offset = self._resume_offset(partial_filename, progress_filename, size=size, etag=etag, hasher=hasher)
+
+        def checkpoint(completed):
+            _write_json_atomic(progress_filename, {'size': size, 'etag': etag, 'completed': completed})
+
+        with tqdm(total=size, initial=offset, unit='B', unit_scale=True, desc=description) as progress_bar:
+            self._logger.debug(f'BEGIN download_file {self.location} to {self.output_filename}'
+                               + (f' resuming at byte {offset}' if offset > 0 else ''))
+            try:
+                download_ranges(size, read_range, partial_filename, config=self.download_config,
+                                progress=progress_bar.update, hasher=hasher, offset=offset, checkpoint=checkpoint)
+                self._check_hash(hasher, f"Download of '{self.location}'")
+            except HashMismatchError:
+                _remove_if_exists(partial_filename, progress_filename)
+                raise
+            except BaseException:
+                # keep the partial file and its progress to resume from
+                self._logger.debug(f'INTERRUPTED download_file {self.location}, kept {partial_filename}')
+                raise
+            self._move_into_place(partial_filename)
+            _remove_if_exists(progress_filename)
+            self._logger.debug(f'END   download_file {self.location} to {self.output_filename}')
+
+    def _check_hash(self, hasher, source):
+        self.downloaded_sha1 = hasher.hexdigest()
+        if self.sha1 is not None and self.downloaded_sha1 != self.sha1:
+            raise HashMismatchError(f"{source}: invalid SHA-1 hash {self.downloaded_sha1} (expected {self.sha1})")
+
+    def _move_into_place(self, partial_filename):
+        os.replace(partial_filename, self.output_filename)
+        if self.sha1 is not None:
+            record_verified(self.output_filename, self.sha1)
+
+    def _resume_offset(self, partial_filename, progress_filename, size, etag, hasher):
+        """
+        :return: the number of bytes of an interrupted download of the same object that can be kept.
+            The hasher is updated with these bytes.
+        """
+        try:
+            with open(progress_filename) as f:
+                progress = json.load(f)
+            partial_size = os.path.getsize(partial_filename)
+        except (OSError, ValueError):
+            return 0
+        if progress.get('size') != size or progress.get('etag') != etag or partial_size != size:
+            self._logger.debug(f"Discarding stale partial download {partial_filename}")
+            _remove_if_exists(partial_filename, progress_filename)
+            return 0
+        completed = progress['completed']
+        with open(partial_filename, 'rb') as f:
+            buffer = bytearray(MB)
+            remaining = completed
+            while remaining > 0:
+                read = f.readinto(memoryview(buffer)[:min(remaining, len(buffer))])
+                if read == 0:
+                    return 0
+                hasher.update(memoryview(buffer)[:read])
+                remaining -= read
+        return completed
 
 
 class BotoFetcher(Fetcher):
     """A Fetcher that retrieves files from Amazon Web Services' S3 data storage.  """
 
-    def __init__(self, location, local_filename, version_id=None):
-        super(BotoFetcher, self).__init__(location, local_filename)
+    def __init__(self, location, local_filename, version_id=None, download_config=None, sha1=None):
+        super(BotoFetcher, self).__init__(location, local_filename, sha1=sha1, download_config=download_config)
         parsed_url = urlparse(self.location)
         split_path = parsed_url.path.lstrip('/').split("/")
         # http://docs.aws.amazon.com/AmazonS3/latest/dev/UsingBucket.html#access-bucket-intro
@@ -63,73 +592,375 @@ class BotoFetcher(Fetcher):
             self.bucketname = split_path[0]
             self.relative_path = os.path.join(*(split_path[1:]))
         self.extra_args = {"VersionId": version_id} if version_id else None
-        self.output_filename = os.path.join(self.local_dir_path, os.path.basename(self.relative_path))
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(self.output_filename), exist_ok=True)
-        self._logger = logging.getLogger(fullname(self))
 
-    def fetch(self):
-        # Ensure the directory path for output_filename exists
-        if not os.path.exists(self.output_filename):
-            self.download_boto()
-        return self.output_filename
+    def download(self):
+        self.download_boto()
 
     def download_boto(self):
-        """Downloads file from S3 via boto at `url` and writes it in `self.output_filename`."""
-        try:  # try with authentication
-            self._logger.debug("attempting default download (signed)")
-            self.download_boto_config(config=None)
-        except Exception as e_signed:  # try without authentication
-            self._logger.debug("default download failed, trying unsigned")
-            # disable signing requests. see https://stackoverflow.com/a/34866092/2225200
-            unsigned_config = Config(signature_version=UNSIGNED)
+        """
+        Downloads file from S3 via boto at `url` and writes it in `self.output_filename`.
+        """
+        self._with_boto_client(self.download_boto_client)
+
+    def open_ranges(self):
+        return self._with_boto_client(lambda s3: self.ranged_reader(s3)[::2])
+
+    def _with_boto_client(self, action):
+        """
+        Calls `action` with an S3 client.
+        Requests are signed by default and retried unsigned for public buckets.
+        The mode that succeeded is remembered for the bucket and tried first on subsequent requests.
+        :return: the result of `action`
+        """
+        remembered_signed = _bucket_signing.get(self.bucketname)
+        modes = [True, False] if remembered_signed is None else [remembered_signed, not remembered_signed]
+        errors = []
+        for signed in modes:
+            self._logger.debug(f"attempting {'signed' if signed else 'unsigned'} download")
             try:
-                self.download_boto_config(config=unsigned_config)
-            except Exception as e_unsigned:
-                # when unsigned download also fails, raise both exceptions
-                # raise Exception instead of specific type to avoid missing __init__ arguments
-                raise Exception([e_signed, e_unsigned])
-
-    def download_boto_config(self, config):
-        s3 = boto3.resource('s3', config=config)
-        obj = s3.Object(self.bucketname, self.relative_path)
-        # show progress. see https://gist.github.com/wy193777/e7607d12fad13459e8992d4f69b53586
-        with tqdm(total=obj.content_length, unit='B', unit_scale=True,
-                  desc=self.bucketname + "/" + self.relative_path) as progress_bar:
-            def progress_hook(bytes_amount):
-                if bytes_amount > 0:  # at the end, this sometimes passes a negative byte amount which tqdm can't handle
-                    progress_bar.update(bytes_amount)
-
-            self._logger.debug(f'BEGIN download_file {self.relative_path} to {self.output_filename}')
-            obj.download_file(self.output_filename, ExtraArgs=self.extra_args, Callback=progress_hook)
-            self._logger.debug(f'END   download_file {self.relative_path} to {self.output_filename}')
-
-
-def verify_sha1(filepath, sha1):
+                result = action(get_s3_client(
+                    signed=signed, max_pool_connections=self.download_config.max_concurrency))
+            except HashMismatchError:
+                raise  # the object was accessible, but is not the one we expected
+            except Exception as e:
+                errors.append(e)
+                continue
+            _bucket_signing[self.bucketname] = signed
+            return result
+        # when all download attempts fail, raise all exceptions
+        # raise Exception instead of specific type to avoid missing __init__ arguments
+        raise Exception(errors)
+
+    def download_boto_client(self, s3):
+        size, etag, read_range = self.ranged_reader(s3)
+        self.download_resumable(size, etag, read_range, description=self.bucketname + "/" + self.relative_path)
+
+    def ranged_reader(self, s3):
+        """
+        :return: the size and ETag of the object, and a `read_range` function for it
+        """
+        extra_args = self.extra_args or {}
+        head = s3.head_object(Bucket=self.bucketname, Key=self.relative_path, **extra_args)
+        size, etag = head['ContentLength'], head.get('ETag')
+
+        def read_range(start, end):
+            # fail rather than mix bytes of different versions if the object changes while downloading
+            match_args = {'IfMatch': etag} if etag else {}
+            response = s3.get_object(Bucket=self.bucketname, Key=self.relative_path,
+                                     Range=f"bytes={start}-{end}", **match_args, **extra_args)
+            return response['Body'].read()
+
+        return size, etag, read_range
+
+
+class LocalFileFetcher(Fetcher):
+    """
+    A Fetcher that copies files from a mirror on a filesystem path, given as a `file://` URL or a plain path.
+    """
+
+    def __init__(self, location, local_filename, version_id=None, download_config=None, sha1=None):
+        super(LocalFileFetcher, self).__init__(location, local_filename, sha1=sha1, download_config=download_config)
+        self.source_filename = url2pathname(urlparse(location).path)
+
+    def download(self):
+        self._logger.debug(f"Copying {self.source_filename} to {self.output_filename}")
+        self.copy_file(self.source_filename)
+
+    def open_ranges(self):
+        def read_range(start, end):
+            with open(self.source_filename, 'rb') as f:
+                f.seek(start)
+                return f.read(end - start + 1)
+
+        return os.path.getsize(self.source_filename), read_range
+
+
+_http_pool = None
+_http_pool_lock = threading.Lock()
+
+
+def get_http_pool():
+    """
+    Returns a process-wide pool of HTTP(S) connections that are kept alive and reused across downloads.
+    """
+    global _http_pool
+    with _http_pool_lock:
+        if _http_pool is None:
+            import urllib3
+            _http_pool = urllib3.PoolManager(maxsize=DownloadConfig().max_concurrency,
+                                             retries=urllib3.Retry(total=3, backoff_factor=0.5))
+        return _http_pool
+
+
+class HttpFetcher(Fetcher):
+    """
+    A Fetcher that retrieves files over HTTP(S).
+    Servers that accept range requests are downloaded from in parallel byte ranges and can be resumed,
+    other servers are downloaded from in a single streamed request.
+    """
+
+    def __init__(self, location, local_filename, version_id=None, download_config=None, sha1=None):
+        super(HttpFetcher, self).__init__(location, local_filename, sha1=sha1, download_config=download_config)
+
+    def download(self):
+        http = get_http_pool()
+        head = self.head(http)
+        if not self.accepts_ranges(head):
+            self.download_stream(http)
+            return
+        size, etag, read_range = self.ranged_reader(http, head)
+        self.download_resumable(size, etag, read_range, description=self.location)
+
+    def open_ranges(self):
+        http = get_http_pool()
+        head = self.head(http)
+        if not self.accepts_ranges(head):
+            raise IOError(f"{self.location} does not support range requests")
+        return self.ranged_reader(http, head)[::2]
+
+    def head(self, http):
+        head = http.request('HEAD', self.location)
+        if head.status != 200:
+            raise IOError(f"HEAD {self.location}: HTTP status {head.status}")
+        return head
+
+    @staticmethod
+    def accepts_ranges(head):
+        return head.headers.get('Content-Length') is not None and \
+            head.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+    def ranged_reader(self, http, head):
+        """
+        :return: the size and version identifier of the file, and a `read_range` function for it
+        """
+        size = int(head.headers['Content-Length'])
+        etag = head.headers.get('ETag') or head.headers.get('Last-Modified')
+
+        def read_range(start, end):
+            headers = {'Range': f"bytes={start}-{end}"}
+            if etag:
+                # fail rather than mix bytes of different versions if the file changes while downloading
+                headers['If-Range' if head.headers.get('ETag') is None else 'If-Match'] = etag
+            response = http.request('GET', self.location, headers=headers)
+            whole_file = response.status == 200 and start == 0 and end == size - 1
+            if response.status != 206 and not whole_file:
+                raise IOError(f"GET {self.location} bytes {start}-{end}: HTTP status {response.status}")
+            return response.data
+
+        return size, etag, read_range
+
+    def download_stream(self, http):
+        partial_filename = self.output_filename + ".partial"
+        hasher = hashlib.sha1()
+        response = http.request('GET', self.location, preload_content=False)
+        try:
+            if response.status != 200:
+                raise IOError(f"GET {self.location}: HTTP status {response.status}")
+            with open(partial_filename, 'wb') as target:
+                for chunk in response.stream(MB):
+                    hasher.update(chunk)
+                    target.write(chunk)
+            self._check_hash(hasher, f"Download of '{self.location}'")
+        except BaseException:
+            _remove_if_exists(partial_filename)
+            raise
+        finally:
+            response.release_conn()
+        self._move_into_place(partial_filename)
+
+
+def _write_json_atomic(path, content):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def _remove_if_exists(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def verify_sha1(filepath, sha1, paranoid=False):
+    """
+    Checks that the file at `filepath` has the SHA-1 hash `sha1`.
+    A successful check is recorded in the verification ledger together with the file's size, modification time
+    and inode, and the file is not hashed again while these still match.
+    :param paranoid: hash the file even if it has already been verified
+    """
+    if not paranoid and is_verified(filepath, sha1):
+        _logger.debug(f"sha1 previously verified: {filepath}")
+        return
     actual_hash = sha1_hash(filepath)
     if sha1 != actual_hash:
-        raise IOError(f"File '{filepath}': invalid SHA-1 hash {actual_hash} (expected {sha1})")
+        forget_verified(filepath)
+        raise HashMismatchError(f"File '{filepath}': invalid SHA-1 hash {actual_hash} (expected {sha1})")
+    record_verified(filepath, sha1)
     _logger.debug(f"sha1 OK: {filepath}")
 
 
+def is_paranoid():
+    return os.getenv(BRAINIO_PARANOID, '').lower() in ('1', 'true', 'yes')
+
+
+def _ledger_directory():
+    return os.path.join(get_local_data_path(), VERIFIED_DIRECTORY)
+
+
+def _ledger_path(filepath):
+    key = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()
+    return os.path.join(_ledger_directory(), key + ".json")
+
+
+def _file_signature(filepath):
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+
+def is_verified(filepath, sha1):
+    """
+    :return: whether the file at `filepath` was verified to have hash `sha1` and has not changed since
+    """
+    try:
+        with open(_ledger_path(filepath)) as f:
+            entry = json.load(f)
+        signature = _file_signature(filepath)
+    except (OSError, ValueError):
+        return False
+    return entry.get('sha1') == sha1 and entry.get('path') == os.path.abspath(filepath) and \
+        all(entry.get(key) == value for key, value in signature.items())
+
+
+def record_verified(filepath, sha1):
+    entry = {'path': os.path.abspath(filepath), 'sha1': sha1, **_file_signature(filepath)}
+    ledger_path = _ledger_path(filepath)
+    os.makedirs(os.path.dirname(ledger_path), exist_ok=True)
+    _write_json_atomic(ledger_path, entry)
+
+
+def forget_verified(filepath):
+    _remove_if_exists(_ledger_path(filepath))
+
+
+def verify_local_data(max_workers=None):
+    """
+    Re-hashes every file recorded in the verification ledger, in parallel.
+    Files that are missing or no longer match their hash are removed from the ledger.
+    :param max_workers: the number of files hashed at the same time
+    :return: a DataFrame with one row per file: `path`, `sha1`, and `status` ("ok", "invalid", or "missing")
+    """
+    ledger_directory = _ledger_directory()
+    entries = []
+    if os.path.isdir(ledger_directory):
+        for filename in os.listdir(ledger_directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(ledger_directory, filename)) as f:
+                    entries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    def reverify(entry):
+        path = entry['path']
+        if not os.path.isfile(path):
+            forget_verified(path)
+            return {'path': path, 'sha1': entry['sha1'], 'status': "missing"}
+        try:
+            verify_sha1(path, entry['sha1'], paranoid=True)
+        except IOError:
+            return {'path': path, 'sha1': entry['sha1'], 'status': "invalid"}
+        return {'path': path, 'sha1': entry['sha1'], 'status': "ok"}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(reverify, entries))
+    return pd.DataFrame(results, columns=['path', 'sha1', 'status'])
+
+
 _fetcher_types = {
     "S3": BotoFetcher,
+    "HTTP": HttpFetcher,
+    "file": LocalFileFetcher,
 }
 
 
-def get_fetcher(type="S3", location=None, local_filename=None, version_id=None):
-    return _fetcher_types[type](location, local_filename, version_id=version_id)
+def register_fetcher_type(location_type, fetcher_class):
+    """
+    Makes files with the given `location_type` in a catalog available through `fetcher_class`.
+    :param location_type: the value in the catalog's `location_type` column
+    :param fetcher_class: a subclass of :class:`Fetcher`, constructed with
+        `(location, local_filename, version_id=...)` and optionally `sha1=...`, that implements `download()`
+    """
+    _fetcher_types[location_type] = fetcher_class
+
+
+def get_fetcher(type="S3", location=None, local_filename=None, version_id=None, sha1=None):
+    fetcher_class = _fetcher_types[type]
+    if _accepts_sha1(fetcher_class):
+        return fetcher_class(location, local_filename, version_id=version_id, sha1=sha1)
+    # fetchers written before the expected hash was passed on construction
+    fetcher = fetcher_class(location, local_filename, version_id=version_id)
+    fetcher.sha1 = sha1
+    return fetcher
 
 
-def fetch_file(location_type, location, sha1, version_id=None):
+def _accepts_sha1(fetcher_class):
+    parameters = inspect.signature(fetcher_class.__init__).parameters.values()
+    return any(parameter.name == 'sha1' or parameter.kind == inspect.Parameter.VAR_KEYWORD
+               for parameter in parameters)
+
+
+def fetch_file(location_type, location, sha1, version_id=None, paranoid=None):
+    """
+    :param paranoid: hash the local file even if it has already been verified,
+        by default the value of the `BRAINIO_PARANOID` environment variable
+    """
     filename = filename_from_link(location)
     fetcher = get_fetcher(type=location_type, location=location,
-                          local_filename=filename, version_id=version_id)
-    local_path = fetcher.fetch()
-    verify_sha1(local_path, sha1)
+                          local_filename=filename, version_id=version_id, sha1=sha1)
+    # only one process downloads and verifies, the others wait and reuse the file.
+    # The lock is the one of the whole cache entry, which eviction and extraction take as well.
+    with file_lock(fetcher.local_dir_path):
+        os.makedirs(fetcher.local_dir_path, exist_ok=True)  # in case it was evicted in the meantime
+        local_path = fetcher.fetch()
+        verify_sha1(local_path, sha1, paranoid=is_paranoid() if paranoid is None else paranoid)
+    _record_access(local_path)
     return local_path
 
 
+def _record_access(local_path):
+    """
+    Marks the file as recently used in the cache index, if the local cache has a budget.
+    """
+    from brainio import cache  # the cache is built on top of this module
+    if cache.get_budget() is None:
+        return
+    try:
+        cache.touch(local_path)
+    except OSError as e:  # e.g. a read-only data directory, the file itself is fine
+        _logger.debug(f"Could not update the cache index for {local_path}: {e}")
+
+
+@contextmanager
+def _loading(lookups):
+    """
+    Protects the cache entries of the files in `lookups` from eviction while they are fetched and loaded,
+    and evicts other entries once they are loaded if the local cache is over budget.
+    """
+    from brainio import cache
+    names = {filename_from_link(lookup['location']) for lookup in lookups}
+    with cache.in_use(names):
+        yield
+    if cache.get_budget() is not None:
+        try:
+            cache.gc(keep=names)
+        except OSError as e:
+            _logger.debug(f"Could not collect garbage in the local cache: {e}")
+
+
 def filename_from_link(location):
     parse = urlparse(location)
     local_name = os.path.basename(parse.path)
@@ -137,16 +968,128 @@ def filename_from_link(location):
     return local_name
 
 
-def unzip(zip_path):
+def unzip(zip_path, sha1=None, max_workers=None, atomic=None):
+    """
+    Extracts a zip file into the directory that contains it.
+    A completed extraction is recorded in a hidden marker file keyed by the zip's hash,
+    so that later calls return without opening the archive or checking its members.
+    :param sha1: the zip's SHA-1 hash from the catalog. Without it, the marker is keyed by the zip's size and mtime.
+    :param max_workers: the number of threads extracting members in parallel, by default up to 8
+    :param atomic: extract into a temporary directory first and move the members into place once all are written,
+        by default the value of the `BRAINIO_ATOMIC_UNZIP` environment variable
+    :return: the directory containing the extracted files
+    """
     containing_dir = os.path.dirname(zip_path)
-    with zipfile.ZipFile(zip_path, 'r') as zip_file:
-        if not all(map(lambda filename: os.path.exists(os.path.join(containing_dir, filename)), zip_file.namelist())):
-            _logger.debug(f"Extractall to {containing_dir}")
-            zip_file.extractall(containing_dir)
+    marker_path = os.path.join(containing_dir, f".{os.path.basename(zip_path)}.extracted")
+    stat = os.stat(zip_path)
+    key = sha1 or f"{stat.st_size}-{stat.st_mtime_ns}"
+    if _read_marker(marker_path) == key:
+        return containing_dir
+    with file_lock(containing_dir):
+        previous_key = _read_marker(marker_path)
+        if previous_key == key:  # extracted while waiting for the lock
+            return containing_dir
+        with zipfile.ZipFile(zip_path, 'r') as zip_file:
+            members = zip_file.infolist()
+            # a marker with a different key means that a different archive was extracted here before
+            if previous_key is not None or not _extracted(containing_dir, members):
+                atomic = os.getenv(BRAINIO_ATOMIC_UNZIP, '').lower() in ('1', 'true', 'yes') \
+                    if atomic is None else atomic
+                _logger.debug(f"Extracting {len(members)} members to {containing_dir}"
+                              + (" atomically" if atomic else ""))
+                if atomic:
+                    _extract_atomic(zip_file, zip_path, members, containing_dir, max_workers=max_workers)
+                else:
+                    _extract(zip_file, zip_path, members, containing_dir, max_workers=max_workers)
+            # the manifest lets loaders check for stimulus files without listing the directory
+            _write_json_atomic(_manifest_path(zip_path), [member.filename for member in members
+                                                          if not member.is_dir()])
+        _write_json_atomic(marker_path, {'key': key, 'members': len(members)})
     return containing_dir
 
 
+def _manifest_path(zip_path):
+    return os.path.join(os.path.dirname(zip_path), f".{os.path.basename(zip_path)}.members")
+
+
+def read_extraction_manifest(zip_path):
+    """
+    :return: the names of the files extracted from the zip file by :func:`unzip`,
+        or None if the extraction did not record them
+    """
+    try:
+        with open(_manifest_path(zip_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_marker(marker_path):
+    try:
+        with open(marker_path) as f:
+            return json.load(f).get('key')
+    except (OSError, ValueError):
+        return None
+
+
+def _extracted(directory, members):
+    """
+    Archives extracted before extraction markers were introduced have no marker:
+    they count as extracted if all members exist with their full size.
+    """
+    for member in members:
+        try:
+            if not member.is_dir() and os.stat(os.path.join(directory, member.filename)).st_size != member.file_size:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def _extract(zip_file, zip_path, members, target_dir, max_workers=None, min_parallel_members=64):
+    """
+    Extracts the members of `zip_file` into `target_dir`, in parallel for archives with many members.
+    Every thread reads from its own handle on the archive.
+    """
+    max_workers = max_workers or min(8, os.cpu_count() or 1)
+    if max_workers <= 1 or len(members) < min_parallel_members:
+        zip_file.extractall(target_dir, members=members)
+        return
+    # create all directories upfront so that threads do not race to create the same one
+    for directory in {os.path.dirname(member.filename) for member in members} - {''}:
+        os.makedirs(os.path.join(target_dir, directory), exist_ok=True)
+    files = [member for member in members if not member.is_dir()]
+    batches = [files[index::max_workers] for index in range(max_workers)]
+
+    def extract_batch(batch):
+        with zipfile.ZipFile(zip_path, 'r') as handle:
+            for member in batch:
+                handle.extract(member, target_dir)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(extract_batch, batch) for batch in batches]:
+            future.result()
+
+
+def _extract_atomic(zip_file, zip_path, members, target_dir, max_workers=None):
+    """
+    Extracts into a hidden temporary directory next to the zip, then moves the extracted files and directories
+    into `target_dir`. Readers never see partially written members.
+    """
+    temporary_dir = tempfile.mkdtemp(prefix=".extracting-", dir=target_dir)
+    try:
+        _extract(zip_file, zip_path, members, temporary_dir, max_workers=max_workers)
+        for name in os.listdir(temporary_dir):
+            target = os.path.join(target_dir, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            os.replace(os.path.join(temporary_dir, name), target)
+    finally:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+
+
 def resolve_assembly_class(class_name):
+    import brainio.assemblies as assemblies  # deferred since xarray and netCDF4 are slow to import
     cls = getattr(assemblies, class_name)
     return cls
 
@@ -156,44 +1099,432 @@ def resolve_stimulus_set_class(class_name):
     return cls
 
 
-def get_assembly(identifier):
+def parse_size(size):
+    """
+    :param size: a number of bytes, optionally with a binary unit suffix, e.g. `"500M"` or `"2.5T"`
+    :return: the number of bytes
+    """
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)i?B?\s*", str(size), flags=re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size {size}")
+    return int(float(match.group(1)) * _units[match.group(2).upper()])
+
+
+class MemoryCache(object):
+    """
+    A process-wide cache of loaded assemblies and stimulus sets, evicting the least recently used ones
+    when their estimated size in memory exceeds the budget.
+    The cached objects themselves are never handed out: their arrays are made read-only,
+    and callers receive either a deep copy or a read-only view.
+    """
+    COPY = 'copy'
+    READ_ONLY = 'readonly'
+
+    def __init__(self, budget, mode=COPY):
+        """
+        :param budget: the memory budget in bytes, optionally with a unit suffix, e.g. `"8G"`
+        :param mode: the default return mode, :attr:`COPY` for independent deep copies
+            or :attr:`READ_ONLY` for cheap views whose data cannot be modified
+        """
+        self.budget = parse_size(budget)
+        self.mode = _check_mode(mode)
+        self.nbytes = 0
+        self._items = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, mode=None):
+        """
+        :return: a copy or view of the cached value, or None if `key` is not cached
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+        return _cached_view(item[0], _check_mode(mode or self.mode))
+
+    def put(self, key, value, mode=None):
+        """
+        Caches `value` unless it is larger than the whole budget.
+        :return: a copy or view of `value` to use instead of `value`
+        """
+        nbytes = estimate_nbytes(value)
+        if nbytes > self.budget:
+            _logger.debug(f"Not caching {key} in memory: {nbytes} bytes exceed the budget of {self.budget}")
+            return value
+        _freeze(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.budget:
+                evicted_key, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                _logger.debug(f"Evicted {evicted_key} ({evicted_nbytes} bytes) from the memory cache")
+        return _cached_view(value, _check_mode(mode or self.mode))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+def _check_mode(mode):
+    if mode not in (MemoryCache.COPY, MemoryCache.READ_ONLY):
+        raise ValueError(f"Unknown memory cache mode {mode}, "
+                         f"expected '{MemoryCache.COPY}' or '{MemoryCache.READ_ONLY}'")
+    return mode
+
+
+def enable_memory_cache(budget, mode=MemoryCache.COPY):
+    """
+    Keeps loaded assemblies and stimulus sets in memory, so that loading them again in this process is free.
+    The cache can also be enabled with the `BRAINIO_MEMORY_CACHE` (budget)
+    and `BRAINIO_MEMORY_CACHE_MODE` environment variables.
+    :return: the :class:`MemoryCache`
+    """
+    global _memory_cache
+    _memory_cache = MemoryCache(budget, mode=mode)
+    return _memory_cache
+
+
+def disable_memory_cache():
+    global _memory_cache
+    _memory_cache = None
+
+
+def get_memory_cache():
+    """
+    :return: the process-wide :class:`MemoryCache`, or None if it is not enabled
+    """
+    if _memory_cache is None and os.getenv(BRAINIO_MEMORY_CACHE):
+        enable_memory_cache(os.getenv(BRAINIO_MEMORY_CACHE),
+                            mode=os.getenv(BRAINIO_MEMORY_CACHE_MODE, MemoryCache.COPY))
+    return _memory_cache
+
+
+def _nested_values(value):
+    """
+    :return: the assemblies and stimulus sets referenced by the attributes of an assembly, e.g. its stimulus set
+    """
+    attrs = getattr(value, 'attrs', None)
+    if not isinstance(value, pd.DataFrame) and isinstance(attrs, dict):
+        return {name: nested for name, nested in attrs.items()
+                if isinstance(nested, pd.DataFrame) or hasattr(nested, 'variable')}
+    return {}
+
+
+def estimate_nbytes(value):
+    """
+    :return: the approximate memory used by an assembly (including its coordinates and stimulus set)
+        or a stimulus set
+    """
+    if isinstance(value, pd.DataFrame):
+        nbytes = int(value.memory_usage(deep=True).sum())
+        stimulus_paths = getattr(value, 'stimulus_paths', None)
+        if isinstance(stimulus_paths, StimulusPaths):
+            nbytes += stimulus_paths.nbytes
+        elif isinstance(stimulus_paths, dict) and len(stimulus_paths) > 0:
+            nbytes += len(stimulus_paths) * 2 * len(str(next(iter(stimulus_paths.values()))))
+        return nbytes
+    nbytes = value.nbytes + sum(coord.nbytes for coord in value.coords.values())
+    return nbytes + sum(estimate_nbytes(nested) for nested in _nested_values(value).values())
+
+
+def _freeze(value):
+    """
+    Loads an assembly's data into memory (unless it is chunked with dask) and marks all arrays as read-only.
+    """
+    if isinstance(value, pd.DataFrame):
+        arrays = [value.index.values] + list(getattr(value._mgr, 'arrays', []))
+    else:
+        if type(value.variable._data).__module__.split('.')[0] != 'dask':
+            value.load()
+        arrays = [value.variable._data] + [coord.variable._data for coord in value.coords.values()]
+        for nested in _nested_values(value).values():
+            _freeze(nested)
+    for array in arrays:
+        array = getattr(array, '_ndarray', array)  # e.g. the codes of a categorical column
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+
+
+def _cached_view(value, mode):
+    if isinstance(value, pd.DataFrame):
+        view = value.copy(deep=mode == MemoryCache.COPY)
+        for attribute in ('identifier', 'stimulus_paths'):
+            if hasattr(value, attribute):
+                attribute_value = getattr(value, attribute)
+                setattr(view, attribute, attribute_value.copy()
+                        if isinstance(attribute_value, (dict, StimulusPaths)) else attribute_value)
+        return view
+    nested_values = _nested_values(value)
+    # copy nested assemblies and stimulus sets separately rather than as part of the attributes
+    view = value.copy(deep=False)
+    view.attrs = {name: attribute for name, attribute in value.attrs.items() if name not in nested_values}
+    if mode == MemoryCache.COPY:
+        view = view.copy(deep=True)
+    for name, nested in nested_values.items():
+        view.attrs[name] = _cached_view(nested, mode)
+    return view
+
+
+def get_assembly(identifier, memory_cache_mode=None, stimulus_mode=None):
+    """
+    :param memory_cache_mode: if the memory cache is enabled (see :func:`enable_memory_cache`),
+        whether to return a deep copy (`"copy"`) or a read-only view (`"readonly"`) of a cached assembly.
+        By default, the mode the cache was enabled with.
+    :param stimulus_mode: how the assembly's stimulus set accesses its stimuli, see :func:`get_stimulus_set`
+    """
+    stimulus_mode = _check_stimulus_mode(stimulus_mode)
     assembly_lookup = lookup_assembly(identifier)
-    file_path = fetch_file(location_type=assembly_lookup['location_type'],
-                           location=assembly_lookup['location'], sha1=assembly_lookup['sha1'])
-    stimulus_set = get_stimulus_set(assembly_lookup['stimulus_set_identifier'])
-    cls = resolve_assembly_class(assembly_lookup['class'])
-    loader = cls.get_loader_class()(
-        cls=cls,
-        file_path=file_path,
-        stimulus_set_identifier=assembly_lookup['stimulus_set_identifier'],
-        stimulus_set=stimulus_set,
-    )
-    assembly = loader.load()
+    stimulus_set_identifier = assembly_lookup['stimulus_set_identifier']
+    csv_lookup, zip_lookup = lookup_stimulus_set(stimulus_set_identifier)
+    memory_cache = get_memory_cache()
+    cache_key = ('assembly', identifier, assembly_lookup['sha1'], csv_lookup['sha1'], zip_lookup['sha1'],
+                 stimulus_mode)
+    if memory_cache is not None:
+        assembly = memory_cache.get(cache_key, mode=memory_cache_mode)
+        if assembly is not None:
+            return assembly
+    with _loading([assembly_lookup, csv_lookup, zip_lookup]):
+        # the assembly and the stimulus set do not depend on each other: fetch them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            file_path_future = executor.submit(_fetch_lookup, assembly_lookup)
+            stimulus_set_future = executor.submit(_get_stimulus_set_memoized,
+                                                  stimulus_set_identifier, csv_lookup, zip_lookup, stimulus_mode)
+            file_path, stimulus_set = file_path_future.result(), stimulus_set_future.result()
+        cls = resolve_assembly_class(assembly_lookup['class'])
+        loader = cls.get_loader_class()(
+            cls=cls,
+            file_path=file_path,
+            stimulus_set_identifier=stimulus_set_identifier,
+            stimulus_set=stimulus_set,
+        )
+        assembly = loader.load()
     assembly.attrs['identifier'] = identifier
+    if memory_cache is not None:
+        assembly = memory_cache.put(cache_key, assembly, mode=memory_cache_mode)
     return assembly
 
 
-def get_stimulus_set(identifier):
+def get_stimulus_set(identifier, memory_cache_mode=None, stimulus_mode=None):
+    """
+    :param memory_cache_mode: if the memory cache is enabled (see :func:`enable_memory_cache`),
+        whether to return a deep copy (`"copy"`) or a read-only view (`"readonly"`) of a cached stimulus set.
+        By default, the mode the cache was enabled with.
+    :param stimulus_mode: `"files"` to extract the stimuli from the stimulus set's zip file,
+        so that `get_stimulus` returns paths to them,
+        `"zip"` to serve them straight from the zip file (see :class:`brainio.stimuli.ZipStimulusStore`),
+        so that `get_stimulus` returns in-memory files (`io.BytesIO`),
+        or `"remote"` to not download the zip file, but only its central directory,
+        and fetch stimuli with range requests when they are first accessed
+        (see :class:`brainio.stimuli.RemoteZipStimulusStore`).
+        By default, the value of the `BRAINIO_STIMULUS_MODE` environment variable or `"files"`.
+    """
+    stimulus_mode = _check_stimulus_mode(stimulus_mode)
     csv_lookup, zip_lookup = lookup_stimulus_set(identifier)
-    csv_path = fetch_file(location_type=csv_lookup['location_type'], location=csv_lookup['location'],
-                          sha1=csv_lookup['sha1'])
-    zip_path = fetch_file(location_type=zip_lookup['location_type'], location=zip_lookup['location'],
-                          sha1=zip_lookup['sha1'])
-    stimuli_directory = unzip(zip_path)
+    memory_cache = get_memory_cache()
+    cache_key = ('stimulus_set', identifier, csv_lookup['sha1'], zip_lookup['sha1'], stimulus_mode)
+    if memory_cache is not None:
+        stimulus_set = memory_cache.get(cache_key, mode=memory_cache_mode)
+        if stimulus_set is not None:
+            return stimulus_set
+    with _loading([csv_lookup, zip_lookup]):
+        stimulus_set = _get_stimulus_set_memoized(identifier, csv_lookup, zip_lookup, stimulus_mode)
+    if memory_cache is not None:
+        stimulus_set = memory_cache.put(cache_key, stimulus_set, mode=memory_cache_mode)
+    return stimulus_set
+
+
+def _check_stimulus_mode(stimulus_mode):
+    stimulus_mode = stimulus_mode or os.getenv(BRAINIO_STIMULUS_MODE, STIMULUS_MODE_FILES)
+    if stimulus_mode not in (STIMULUS_MODE_FILES, STIMULUS_MODE_ZIP, STIMULUS_MODE_REMOTE):
+        raise ValueError(f"Unknown stimulus mode {stimulus_mode}, "
+                         f"expected '{STIMULUS_MODE_FILES}', '{STIMULUS_MODE_ZIP}' or '{STIMULUS_MODE_REMOTE}'")
+    return stimulus_mode
+
+
+def _get_stimulus_set_memo():
+    """
+    Stimulus sets are shared by many assemblies. Loading one parses its csv and checks every stimulus file,
+    so loaded stimulus sets are kept in a memory cache of their own, bounded by the `BRAINIO_STIMULUS_SET_CACHE`
+    environment variable (default 1G, 0 to disable).
+    Callers receive read-only views that share their data with the cached stimulus sets rather than copies of them,
+    so that the cache takes no memory beyond the stimulus sets in use.
+    """
+    global _stimulus_set_memo
+    if _stimulus_set_memo is None:
+        _stimulus_set_memo = MemoryCache(os.getenv(BRAINIO_STIMULUS_SET_CACHE, '1G'), mode=MemoryCache.READ_ONLY)
+    return _stimulus_set_memo
+
+
+def _get_stimulus_set_memoized(identifier, csv_lookup, zip_lookup, stimulus_mode=STIMULUS_MODE_FILES):
+    """
+    Fetches and loads a stimulus set only once per process, even when requested from several threads at once.
+    :return: a read-only view of the stimulus set
+    """
+    memo = _get_stimulus_set_memo()
+    stimuli_directory = os.path.join(get_local_data_path(), filename_from_link(zip_lookup['location']))
+    stimuli_location = os.path.join(stimuli_directory, os.path.basename(urlparse(zip_lookup['location']).path)) \
+        if stimulus_mode == STIMULUS_MODE_ZIP else stimuli_directory
+    key = (identifier, csv_lookup['sha1'], zip_lookup['sha1'], stimuli_location, stimulus_mode)
+    with _thread_locks_lock:
+        key_lock, waiting = _stimulus_set_locks.get(key, (threading.Lock(), 0))
+        _stimulus_set_locks[key] = (key_lock, waiting + 1)
+    try:
+        with key_lock:
+            return _load_stimulus_set_memoized(memo, key, stimuli_location, identifier, csv_lookup, zip_lookup,
+                                               stimulus_mode)
+    finally:
+        with _thread_locks_lock:
+            key_lock, waiting = _stimulus_set_locks.pop(key)
+            if waiting > 1:  # other threads are still loading the same stimulus set
+                _stimulus_set_locks[key] = (key_lock, waiting - 1)
+
+
+def _load_stimulus_set_memoized(memo, key, stimuli_location, identifier, csv_lookup, zip_lookup, stimulus_mode):
+    # the stimuli might have been evicted from the local cache in the meantime
+    stimulus_set = memo.get(key) if os.path.exists(stimuli_location) else None
+    if stimulus_set is not None:
+        return stimulus_set
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        csv_path_future, stimuli_future = _submit_stimulus_set_files(executor, csv_lookup, zip_lookup, stimulus_mode)
+        csv_path, stimuli = csv_path_future.result(), stimuli_future.result()
+    stimulus_set = _load_stimulus_set(identifier, csv_lookup, csv_path=csv_path, **stimuli)
+    return memo.put(key, stimulus_set)
+
+
+def _fetch_lookup(lookup):
+    return fetch_file(location_type=lookup['location_type'], location=lookup['location'], sha1=lookup['sha1'])
+
+
+def _fetch_stimuli(zip_lookup, stimulus_mode):
+    """
+    :return: the keyword arguments of :func:`_load_stimulus_set` to load the stimuli with:
+        the local stimuli directory, and either the files extracted into it,
+        or the store to serve stimuli from instead of extracted files
+    """
+    if stimulus_mode == STIMULUS_MODE_FILES:
+        zip_path = _fetch_lookup(zip_lookup)
+        stimuli_directory = unzip(zip_path, sha1=zip_lookup['sha1'])
+        return {'stimuli_directory': stimuli_directory, 'stimulus_files': read_extraction_manifest(zip_path)}
+    if stimulus_mode == STIMULUS_MODE_REMOTE:
+        fetcher = get_fetcher(type=zip_lookup['location_type'], location=zip_lookup['location'],
+                              local_filename=filename_from_link(zip_lookup['location']), sha1=zip_lookup['sha1'])
+        # no need for range requests if the whole zip has been fetched before
+        if not os.path.exists(fetcher.output_filename):
+            return {'stimuli_directory': fetcher.local_dir_path, 'stimulus_store': _open_remote_zip(fetcher)}
+    zip_path = _fetch_lookup(zip_lookup)
+    return {'stimuli_directory': os.path.dirname(zip_path), 'stimulus_store': _open_zip(zip_path, zip_lookup['sha1'])}
+
+
+def _open_zip(zip_path, sha1):
+    index_path = os.path.join(os.path.dirname(zip_path), f".{os.path.basename(zip_path)}.{sha1}.index")
+    store = ZipStimulusStore(zip_path, index_path=index_path)
+    _record_access(index_path)
+    return store
+
+
+def _open_remote_zip(fetcher):
+    size, read_range = fetcher.open_ranges()
+    zip_filename = os.path.basename(fetcher.output_filename)
+    directory_cache_path = os.path.join(fetcher.local_dir_path, f".{zip_filename}.{fetcher.sha1}.directory")
+    store = RemoteZipStimulusStore(fetcher.location, size, read_range, cache_directory=fetcher.local_dir_path,
+                                   directory_cache_path=directory_cache_path,
+                                   max_workers=fetcher.download_config.max_concurrency)
+    _record_access(directory_cache_path)
+    return store
+
+
+def _submit_stimulus_set_files(executor, csv_lookup, zip_lookup, stimulus_mode=STIMULUS_MODE_FILES):
+    """
+    Schedules the download of a stimulus set's csv and zip on `executor`.
+    In the `"files"` stimulus mode, the zip is extracted on its worker as soon as it arrives,
+    without waiting for the csv.
+    :return: futures of the local csv path and of the stimuli, see :func:`_fetch_stimuli`
+    """
+    csv_path_future = executor.submit(_fetch_lookup, csv_lookup)
+    stimuli_future = executor.submit(_fetch_stimuli, zip_lookup, stimulus_mode)
+    return csv_path_future, stimuli_future
+
+
+def _load_stimulus_set(identifier, csv_lookup, csv_path, stimuli_directory, stimulus_store=None,
+                       stimulus_files=None):
     loader = StimulusSetLoader(
         csv_path=csv_path,
         stimuli_directory=stimuli_directory,
-        cls=resolve_stimulus_set_class(csv_lookup['class'])
+        cls=resolve_stimulus_set_class(csv_lookup['class']),
+        stimulus_store=stimulus_store,
+        stimulus_files=stimulus_files,
     )
     stimulus_set = loader.load()
     stimulus_set.identifier = identifier
     # ensure perfect overlap
-    stimuli_paths = [Path(stimuli_directory) / local_path for local_path in os.listdir(stimuli_directory)
-                     if not local_path.endswith('.zip') and not local_path.endswith('.csv')]
-    assert set(stimulus_set.stimulus_paths.values()) == set(stimuli_paths), \
+    if stimulus_store is not None:
+        assert set(stimulus_set.stimulus_paths.filenames) == set(stimulus_store.names()), \
+            "Inconsistency: zip members do not match csv paths"
+        return stimulus_set
+    # the loader already listed the directory (or read the extraction manifest) to check that all stimuli exist
+    stimulus_files = {filename for filename in loader.stimulus_files
+                      if not filename.endswith('.zip') and not filename.endswith('.csv')}
+    assert set(stimulus_set.stimulus_paths.filenames) == stimulus_files, \
         "Inconsistency: unzipped stimuli paths do not match csv paths"
     return stimulus_set
 
 
+def prefetch(identifiers, max_workers=4):
+    """
+    Downloads and verifies the files of the given assemblies and stimulus sets without loading them,
+    so that subsequent calls to :func:`get_assembly` and :func:`get_stimulus_set` are served locally.
+    Files shared between identifiers, such as the stimulus set of several assemblies, are only fetched once.
+    :param identifiers: assembly or stimulus set identifiers. Assemblies include their stimulus set.
+    :param max_workers: the number of files fetched at the same time
+    :return: a DataFrame with one row per file: `identifier`, `lookup_type`, `location`, `local_path`,
+        `bytes`, `seconds`, and whether the file was already `cached` locally
+    """
+    lookups = {}
+    for identifier in identifiers:
+        for file_lookup in _file_lookups(identifier):
+            key = (file_lookup['location_type'], file_lookup['location'], file_lookup['sha1'])
+            lookups.setdefault(key, file_lookup)
+    with _loading(lookups.values()), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_prefetch_file, file_lookup) for file_lookup in lookups.values()]
+        report = pd.DataFrame([future.result() for future in futures],
+                              columns=['identifier', 'lookup_type', 'location', 'local_path',
+                                       'bytes', 'seconds', 'cached'])
+    _logger.info(f"Prefetched {len(report)} files ({report['cached'].sum()} cached), "
+                 f"{report['bytes'].sum()} bytes")
+    return report
+
+
+def _file_lookups(identifier):
+    try:
+        assembly_lookup = lookup_assembly(identifier)
+    except AssemblyLookupError:
+        return list(lookup_stimulus_set(identifier))
+    return [assembly_lookup, *lookup_stimulus_set(assembly_lookup['stimulus_set_identifier'])]
+
+
+def _prefetch_file(lookup):
+    fetcher = get_fetcher(type=lookup['location_type'], location=lookup['location'],
+                          local_filename=filename_from_link(lookup['location']))
+    cached = os.path.exists(fetcher.output_filename)
+    start = time.perf_counter()
+    local_path = fetch_file(location_type=lookup['location_type'], location=lookup['location'], sha1=lookup['sha1'])
+    if lookup[KIND] == KIND_ZIP:
+        unzip(local_path, sha1=lookup['sha1'])
+    return {'identifier': lookup['identifier'], 'lookup_type': lookup['lookup_type'],
+            'location': lookup['location'], 'local_path': local_path, 'bytes': os.path.getsize(local_path),
+            'seconds': time.perf_counter() - start, 'cached': cached}
+
+
 def fullname(obj):
     return obj.__module__ + "." + obj.__class__.__name__
@@ -1,91 +1,291 @@
 import hashlib
+import json
 import logging
+import os
 
 import entrypoints
 import numpy as np
 import pandas as pd
 
-from brainio.catalogs import Catalog, SOURCE_CATALOG
+from brainio.catalogs import Catalog, SOURCE_CATALOG, CATALOG_COLUMNS, SQLiteCatalogStore, STORAGE_SQLITE
 
 ENTRYPOINT = "brainio_lookups"
 TYPE_ASSEMBLY = 'assembly'
 TYPE_STIMULUS_SET = 'stimulus_set'
+CATALOG_MANIFEST = "catalog_manifest.json"
+LOOKUP_KEY = ['identifier', 'lookup_type']
+KIND = 'kind'
+KIND_CSV = 'csv'
+KIND_ZIP = 'zip'
+KIND_ASSEMBLY = 'assembly'
 _catalogs = {}
+_combined = None
+_entry_points = None
+_manifest = None
 
 _logger = logging.getLogger(__name__)
 
 
+def _get_entry_points():
+    global _entry_points
+    if _entry_points is None:
+        _entry_points = entrypoints.get_group_named(ENTRYPOINT)
+    return _entry_points
+
+
 def list_catalogs():
-    return sorted(list(entrypoints.get_group_named(ENTRYPOINT).keys()))
+    return sorted(list(_get_entry_points().keys()))
 
 
 def _load_catalog(identifier, entry_point):
+    _logger.debug(f"Loading catalog {identifier} from entrypoint {entry_point}")
     catalog = entry_point.load()()
     assert isinstance(catalog, Catalog)
     assert catalog.identifier == identifier
+    _record_manifest(identifier, catalog)
     return catalog
 
 
 def _load_installed_catalogs():
-    installed_catalogs = entrypoints.get_group_named(ENTRYPOINT)
+    installed_catalogs = _get_entry_points()
     _logger.debug(f"Loading catalog from entrypoints")
-    print(f"Loading catalog from entrypoints")
     for k, v in installed_catalogs.items():
         catalog = _load_catalog(k, v)
         _catalogs[k] = catalog
+    _invalidate_combined_catalog()
     return _catalogs
 
 
 def get_catalog(identifier):
-    catalogs = get_catalogs()
-    return catalogs[identifier]
+    if identifier not in _catalogs:
+        _catalogs[identifier] = _load_catalog(identifier, _get_entry_points()[identifier])
+    return _catalogs[identifier]
 
 
 def get_catalogs():
-    if not _catalogs:
-        _load_installed_catalogs()
+    for identifier in _get_entry_points():
+        get_catalog(identifier)
+    return _catalogs
+
+
+def _get_catalogs_providing(identifier, lookup_type):
+    """
+    Loads only those installed catalogs that can contain `identifier` for `lookup_type`,
+    according to the catalog manifest. Catalogs without a current manifest entry are always loaded.
+    :return: the loaded catalogs
+    """
+    manifest = _get_manifest()
+    for catalog_identifier, entry_point in _get_entry_points().items():
+        if catalog_identifier in _catalogs:
+            continue
+        entry = manifest.get(catalog_identifier)
+        if _is_manifest_entry_current(entry, entry_point) and \
+                identifier not in entry['lookups'].get(lookup_type, ()):
+            continue
+        get_catalog(catalog_identifier)
     return _catalogs
 
 
+def _manifest_path():
+    from brainio.fetch import get_local_data_path
+    return os.path.join(get_local_data_path(), CATALOG_MANIFEST)
+
+
+def _get_manifest():
+    """
+    The catalog manifest records, for every installed catalog, which identifiers it provides,
+    keyed by the catalog's source path, modification time and size.
+    """
+    global _manifest
+    if _manifest is None:
+        _manifest = _read_manifest(_manifest_path())
+    return _manifest
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    for entry in manifest.values():
+        entry['lookups'] = {lookup_type: set(identifiers) for lookup_type, identifiers in entry['lookups'].items()}
+    return manifest
+
+
+def _entry_point_spec(entry_point):
+    return f"{entry_point.module_name}:{entry_point.object_name}"
+
+
+def _is_manifest_entry_current(entry, entry_point):
+    if entry is None or entry['entry_point'] != _entry_point_spec(entry_point):
+        return False
+    if not os.path.isfile(entry['source_path']):
+        return False
+    try:
+        stat = os.stat(entry['source_path'])
+    except OSError:
+        return False
+    return stat.st_mtime_ns == entry['mtime_ns'] and stat.st_size == entry['size']
+
+
+def _record_manifest(catalog_identifier, catalog):
+    entry_point = _get_entry_points().get(catalog_identifier)
+    source_path = catalog.attrs.get('source_path')
+    # catalogs that are not backed by a file, e.g. in memory, cannot be checked for changes
+    if entry_point is None or source_path is None or not os.path.isfile(source_path):
+        return
+    manifest = _get_manifest()
+    try:
+        stat = os.stat(source_path)
+    except OSError:
+        return
+    lookups = {}
+    for identifier, lookup_type in zip(catalog['identifier'], catalog['lookup_type']):
+        if isinstance(identifier, str) and isinstance(lookup_type, str):
+            lookups.setdefault(lookup_type, set()).add(identifier)
+    entry = {
+        'entry_point': _entry_point_spec(entry_point),
+        'source_path': str(source_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'lookups': lookups,
+    }
+    if manifest.get(catalog_identifier) == entry:
+        return
+    from brainio.fetch import file_lock  # fetching is built on top of the lookups
+    path = _manifest_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with file_lock(path):
+            # other processes might have recorded their catalogs since this process read the manifest
+            manifest.update(_read_manifest(path))
+            manifest[catalog_identifier] = entry
+            serializable = {identifier: {**recorded, 'lookups': {lookup_type: sorted(identifiers)
+                                                                 for lookup_type, identifiers in
+                                                                 recorded['lookups'].items()}}
+                            for identifier, recorded in manifest.items()}
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(serializable, f)
+            os.replace(tmp_path, path)
+    except OSError:
+        manifest[catalog_identifier] = entry
+        _logger.debug(f"Could not write catalog manifest {path}", exc_info=True)
+
+
+class CombinedCatalog:
+    """
+    All installed catalogs concatenated into one frame, with hash indexes for constant-time lookups.
+    The indexes are built once and reused until the set of catalogs changes.
+    """
+
+    def __init__(self, catalogs):
+        # keep references to the source catalogs so that their ids in the signature cannot be reused
+        self.catalogs = dict(catalogs)
+        self.signature = _catalogs_signature(self.catalogs)
+        target_catalogs = []
+        for identifier, source_catalog in self.catalogs.items():
+            target_catalog = source_catalog.copy()
+            target_catalog[SOURCE_CATALOG] = identifier
+            target_catalogs.append(target_catalog)
+        self.frame = pd.concat(target_catalogs, ignore_index=True) if target_catalogs else pd.DataFrame()
+        if len(self.frame) > 0:
+            self.frame[KIND] = _lookup_kinds(self.frame)
+            self._positions = self.frame.groupby(['identifier', 'lookup_type'], sort=False).indices
+        else:
+            self._positions = {}
+        self._identifiers = {}
+        for identifier, lookup_type in self._positions:
+            self._identifiers.setdefault(lookup_type, set()).add(identifier)
+        self._assemblies_by_stimulus_set = {}
+        assembly_rows = self.frame[self.frame['lookup_type'] == TYPE_ASSEMBLY] if len(self.frame) > 0 else self.frame
+        for identifier, stimulus_set_identifier in zip(assembly_rows['identifier'],
+                                                       assembly_rows['stimulus_set_identifier']):
+            if isinstance(stimulus_set_identifier, str):
+                self._assemblies_by_stimulus_set.setdefault(stimulus_set_identifier, set()).add(identifier)
+
+    def is_current(self, catalogs):
+        return self.signature == _catalogs_signature(catalogs)
+
+    def rows(self, identifier, lookup_type):
+        """
+        :return: the rows of the combined catalog matching `identifier` and `lookup_type`.
+        """
+        positions = self._positions.get((identifier, lookup_type))
+        if positions is None:
+            return self.frame.iloc[[]]
+        return self.frame.iloc[positions]
+
+    def identifiers(self, lookup_type):
+        return self._identifiers.get(lookup_type, set())
+
+    def assemblies_for_stimulus_set(self, stimulus_set_identifier):
+        return self._assemblies_by_stimulus_set.get(stimulus_set_identifier, set())
+
+
+def _catalogs_signature(catalogs):
+    return tuple((identifier, id(catalog), len(catalog)) for identifier, catalog in catalogs.items())
+
+
+def _invalidate_combined_catalog():
+    global _combined
+    _combined = None
+
+
+def get_combined_catalog(catalogs=None):
+    """
+    :param catalogs: the catalogs to combine, all installed catalogs by default
+    :return: the :class:`CombinedCatalog` over `catalogs`,
+        rebuilt only if a catalog was loaded, replaced or appended to since the last call.
+    """
+    global _combined
+    catalogs = catalogs if catalogs is not None else get_catalogs()
+    if _combined is None or not _combined.is_current(catalogs):
+        _logger.debug("Building combined catalog")
+        _combined = CombinedCatalog(catalogs)
+    return _combined
+
+
 def combined_catalog():
-    source_catalogs = get_catalogs()
-    target_catalogs = {}
-    for identifier, source_catalog in source_catalogs.items():
-        target_catalog = source_catalog.copy()
-        target_catalog[SOURCE_CATALOG] = identifier
-        target_catalogs[identifier] = target_catalog
-    concat_catalogs = pd.concat(target_catalogs.values(), ignore_index=True)
-    return concat_catalogs
+    """
+    :return: a DataFrame with the rows of all installed catalogs and a `source_catalog` column.
+        The frame is shared between calls and must not be modified.
+    """
+    return get_combined_catalog().frame
 
 
 def list_stimulus_sets():
-    combined = combined_catalog()
-    stimuli_rows = combined[combined['lookup_type'] == TYPE_STIMULUS_SET]
-    return sorted(list(set(stimuli_rows['identifier'])))
+    return sorted(get_combined_catalog().identifiers(TYPE_STIMULUS_SET))
 
 
 def list_assemblies():
-    combined = combined_catalog()
-    assembly_rows = combined[combined['lookup_type'] == TYPE_ASSEMBLY]
-    return sorted(list(set(assembly_rows['identifier'])))
+    return sorted(get_combined_catalog().identifiers(TYPE_ASSEMBLY))
+
+
+def list_stimulus_set_assemblies(stimulus_set_identifier):
+    """
+    :return: the identifiers of all assemblies that reference the stimulus set `stimulus_set_identifier`.
+    """
+    return sorted(get_combined_catalog().assemblies_for_stimulus_set(stimulus_set_identifier))
 
 
 def lookup_stimulus_set(identifier):
-    combined = combined_catalog()
-    lookup = combined[(combined['identifier'] == identifier) & (combined['lookup_type'] == TYPE_STIMULUS_SET)]
+    catalogs = _get_catalogs_providing(identifier, TYPE_STIMULUS_SET)
+    lookup = get_combined_catalog(catalogs).rows(identifier, TYPE_STIMULUS_SET)
     if len(lookup) == 0:
         raise StimulusSetLookupError(f"Stimulus set {identifier} not found")
-    csv_lookup = _lookup_stimulus_set_filtered(lookup, filter_func=_is_csv_lookup, label="CSV")
-    zip_lookup = _lookup_stimulus_set_filtered(lookup, filter_func=_is_zip_lookup, label="ZIP")
+    csv_lookup = _lookup_stimulus_set_filtered(lookup, kind=KIND_CSV, label="CSV")
+    zip_lookup = _lookup_stimulus_set_filtered(lookup, kind=KIND_ZIP, label="ZIP")
     return csv_lookup, zip_lookup
 
 
-def _lookup_stimulus_set_filtered(lookup, filter_func, label):
-    cols = [n for n in lookup.columns if n != SOURCE_CATALOG]
+def _lookup_stimulus_set_filtered(lookup, kind, label):
+    cols = [n for n in lookup.columns if n not in (SOURCE_CATALOG, KIND)]
     # filter for csv vs. zip
     # if there are any groups of rows where every field except source is the same,
     # we only want one from each group
-    filtered_rows = lookup[lookup.apply(filter_func, axis=1)].drop_duplicates(subset=cols)
+    filtered_rows = lookup[lookup[KIND] == kind].drop_duplicates(subset=cols)
     identifier = lookup.iloc[0]['identifier']
     if len(filtered_rows) == 0:
         raise StimulusSetLookupError(f"{label} for stimulus set {identifier} not found")
@@ -97,11 +297,11 @@ def _lookup_stimulus_set_filtered(lookup, filter_func, label):
 
 
 def lookup_assembly(identifier):
-    combined = combined_catalog()
-    lookup = combined[(combined['identifier'] == identifier) & (combined['lookup_type'] == TYPE_ASSEMBLY)]
+    catalogs = _get_catalogs_providing(identifier, TYPE_ASSEMBLY)
+    lookup = get_combined_catalog(catalogs).rows(identifier, TYPE_ASSEMBLY)
     if len(lookup) == 0:
         raise AssemblyLookupError(f"Data assembly {identifier} not found")
-    cols = [n for n in lookup.columns if n != SOURCE_CATALOG]
+    cols = [n for n in lookup.columns if n not in (SOURCE_CATALOG, KIND)]
     # if there are any groups of rows where every field except source is the same,
     # we only want one from each group
     de_dupe = lookup.drop_duplicates(subset=cols)
@@ -121,11 +321,51 @@ class AssemblyLookupError(KeyError):
 
 def append(catalog_identifier, object_identifier, cls, lookup_type,
            bucket_name, sha1, s3_key, stimulus_set_identifier=None):
-    catalogs = get_catalogs()
-    catalog = catalogs[catalog_identifier]
+    return append_many(catalog_identifier, [dict(
+        object_identifier=object_identifier, cls=cls, lookup_type=lookup_type,
+        bucket_name=bucket_name, sha1=sha1, s3_key=s3_key, stimulus_set_identifier=stimulus_set_identifier)])
+
+
+def append_many(catalog_identifier, rows):
+    """
+    Adds several lookups to a catalog with a single duplicate check and a single write.
+    :param catalog_identifier: the identifier of the catalog to append to
+    :param rows: dicts with the keyword arguments of :func:`append`
+        (`object_identifier`, `cls`, `lookup_type`, `bucket_name`, `sha1`, `s3_key`, `stimulus_set_identifier`)
+    :return: the updated catalog
+    """
+    catalog = get_catalog(catalog_identifier)
     catalog_path = catalog.attrs['source_path']
-    _logger.debug(f"Adding {lookup_type} {object_identifier} to catalog {catalog_identifier}")
-    object_lookup = {
+    add_lookups = pd.DataFrame([_object_lookup(**row) for row in rows], columns=CATALOG_COLUMNS)
+    if len(add_lookups) == 0:
+        return catalog
+    _logger.debug(f"Adding {len(add_lookups)} lookups to catalog {catalog_identifier}: "
+                  f"{', '.join(add_lookups['identifier'].unique())}")
+    assert add_lookups['lookup_type'].isin([TYPE_ASSEMBLY, TYPE_STIMULUS_SET]).all()
+    if catalog.attrs.get('storage') == STORAGE_SQLITE:
+        # duplicates are checked by index queries within the append transaction
+        SQLiteCatalogStore(catalog_path).append(add_lookups, check_duplicates=_check_duplicates)
+        # extend the loaded catalog rather than reading the whole store again
+        appended = pd.concat((catalog, add_lookups), ignore_index=True)
+        appended.attrs.update(source_path=catalog_path, storage=STORAGE_SQLITE)
+        appended.identifier, appended.url = catalog.identifier, catalog.url
+        catalog = appended
+    else:
+        # check duplicates
+        duplicates = catalog.merge(add_lookups[LOOKUP_KEY].drop_duplicates(), on=LOOKUP_KEY, how='inner')
+        _check_duplicates(duplicates, add_lookups)
+        # append and save
+        catalog = pd.concat((catalog, add_lookups))
+        catalog.attrs['source_path'] = catalog_path  # explicitly set since concat does not always preserve
+        catalog.to_csv(catalog_path, index=False)
+    _catalogs[catalog_identifier] = catalog
+    _invalidate_combined_catalog()
+    _record_manifest(catalog_identifier, catalog)
+    return catalog
+
+
+def _object_lookup(object_identifier, cls, lookup_type, bucket_name, sha1, s3_key, stimulus_set_identifier=None):
+    return {
         'identifier': object_identifier,
         'lookup_type': lookup_type,
         'class': cls,
@@ -134,50 +374,70 @@ def append(catalog_identifier, object_identifier, cls, lookup_type,
         'sha1': sha1,
         'stimulus_set_identifier': stimulus_set_identifier,
     }
-    # check duplicates
-    assert object_lookup['lookup_type'] in [TYPE_ASSEMBLY, TYPE_STIMULUS_SET]
-    duplicates = catalog[(catalog['identifier'] == object_lookup['identifier']) &
-                         (catalog['lookup_type'] == object_lookup['lookup_type'])]
-    if len(duplicates) > 0:
-        if object_lookup['lookup_type'] == TYPE_ASSEMBLY:
-            raise ValueError(f"Trying to add duplicate identifier {object_lookup['identifier']}, "
-                             f"existing \n{duplicates.to_string()}")
-        elif object_lookup['lookup_type'] == TYPE_STIMULUS_SET:
-            if len(duplicates) == 1 and duplicates.squeeze()['identifier'] == object_lookup['identifier'] and (
-                    (_is_csv_lookup(duplicates.squeeze()) and _is_zip_lookup(object_lookup)) or
-                    (_is_zip_lookup(duplicates.squeeze()) and _is_csv_lookup(object_lookup))):
-                pass  # all good, we're just adding the second part of a stimulus set
-            else:
-                raise ValueError(
-                    f"Trying to add duplicate identifier {object_lookup['identifier']}, existing {duplicates}")
-    # append and save
-    add_lookup = pd.DataFrame({key: [value] for key, value in object_lookup.items()})
-    catalog = pd.concat((catalog, add_lookup))
-    catalog.attrs['source_path'] = catalog_path  # explicitly set since concat does not always preserve
-    catalog.to_csv(catalog_path, index=False)
-    _catalogs[catalog_identifier] = catalog
-    return catalog
-
-
-def _is_csv_lookup(data_row):
-    return data_row['lookup_type'] == TYPE_STIMULUS_SET \
-           and data_row['location'].endswith('.csv') \
-           and data_row['class'] not in [None, np.nan]
-
-
-def _is_zip_lookup(data_row):
-    return data_row['lookup_type'] == TYPE_STIMULUS_SET \
-           and data_row['location'].endswith('.zip') \
-           and data_row['class'] in [None, np.nan]
 
 
-def sha1_hash(path, buffer_size=64 * 2 ** 10):
+def _check_duplicates(duplicates, add_lookups):
+    """
+    :param duplicates: the existing catalog rows with the same identifier and lookup type as any of `add_lookups`
+    :param add_lookups: the rows that are about to be appended
+    :raises ValueError: if an assembly would be listed more than once,
+        or a stimulus set would have more than one CSV or more than one ZIP row
+    """
+    combined = pd.concat((pd.DataFrame(duplicates)[CATALOG_COLUMNS], add_lookups[CATALOG_COLUMNS]),
+                         ignore_index=True)
+    kinds = _lookup_kinds(combined)
+    counts = pd.DataFrame({'identifier': combined['identifier'], 'lookup_type': combined['lookup_type'],
+                           'rows': 1, 'csv': kinds == KIND_CSV, 'zip': kinds == KIND_ZIP}
+                          ).groupby(LOOKUP_KEY, sort=False).sum()
+    # a stimulus set may be listed twice, but only as one CSV and one ZIP part
+    invalid = (counts['rows'] > 1) & (
+            (counts.index.get_level_values('lookup_type') == TYPE_ASSEMBLY) |
+            (counts['csv'] > 1) | (counts['zip'] > 1) | (counts['rows'] != counts['csv'] + counts['zip']))
+    if invalid.any():
+        identifiers = list(counts.index[invalid].get_level_values('identifier'))
+        existing = pd.DataFrame(duplicates)
+        existing = existing[existing['identifier'].isin(identifiers)]
+        raise ValueError(f"Trying to add duplicate identifier {', '.join(identifiers)}, "
+                         f"existing \n{existing.to_string()}")
+
+
+def _lookup_kinds(lookups):
+    """
+    :return: for every row of `lookups`, whether it points to a stimulus set CSV, a stimulus set ZIP or an assembly,
+        None if it is neither
+    """
+    kinds = np.select([_csv_lookup_mask(lookups), _zip_lookup_mask(lookups),
+                       (lookups['lookup_type'] == TYPE_ASSEMBLY).to_numpy()],
+                      [KIND_CSV, KIND_ZIP, KIND_ASSEMBLY], default=None)
+    return pd.Series(kinds, index=lookups.index, dtype=object)
+
+
+def _csv_lookup_mask(lookups):
+    return (lookups['lookup_type'] == TYPE_STIMULUS_SET) \
+           & lookups['location'].str.endswith('.csv', na=False) \
+           & lookups['class'].notna()
+
+
+def _zip_lookup_mask(lookups):
+    return (lookups['lookup_type'] == TYPE_STIMULUS_SET) \
+           & lookups['location'].str.endswith('.zip', na=False) \
+           & lookups['class'].isna()
+
+
+def sha1_hash(path, buffer_size=None):
+    """
+    :param buffer_size: if given, read the file in chunks of this many bytes.
+        By default, the file is hashed with `hashlib.file_digest` which reads into a single reused buffer.
+    """
     _logger.debug(f'BEGIN sha1_hash on {path}')
-    sha1 = hashlib.sha1()
     with open(path, "rb") as f:
-        buffer = f.read(buffer_size)
-        while len(buffer) > 0:
-            sha1.update(buffer)
+        if buffer_size is None:
+            sha1 = hashlib.file_digest(f, "sha1")
+        else:
+            sha1 = hashlib.sha1()
             buffer = f.read(buffer_size)
+            while len(buffer) > 0:
+                sha1.update(buffer)
+                buffer = f.read(buffer_size)
     _logger.debug(f'END   sha1_hash on {path}')
     return sha1.hexdigest()
@@ -3,6 +3,7 @@ import mimetypes
 import os
 import re
 import zipfile
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Union
 
@@ -10,7 +11,6 @@ import boto3
 import numpy as np
 import pandas as pd
 import xarray as xr
-from PIL import Image
 from tqdm import tqdm
 from xarray import DataArray
 
@@ -146,6 +146,7 @@ def check_experiment_stimulus_set(stimulus_set):
     file_paths = list(stimulus_set.stimulus_paths.values())
 
     file_type_0 = mimetypes.guess_type(file_paths[0])[0]
+    from PIL import Image  # deferred since it is only needed for checking images
 
     for file_path in file_paths:
         check_stimulus_naming_convention(file_path[file_path.rfind('/') + 1:])
@@ -159,7 +160,22 @@ def check_experiment_stimulus_set(stimulus_set):
     check_stimulus_numbers(stimulus_set)
 
 
-def package_stimulus_set(catalog_name, proto_stimulus_set, stimulus_set_identifier, bucket_name="brainio-temp"):
+@contextmanager
+def batch_append(catalog_identifier):
+    """
+    Collects the catalog rows of all packages created within the block and appends them to the catalog
+    with a single write when the block exits.
+    Pass the yielded list as `catalog_rows` to :func:`package_stimulus_set` and :func:`package_data_assembly`.
+    If the block raises, nothing is appended and the error is passed on.
+    :param catalog_identifier: The name of the lookup catalog to add the packages to.
+    """
+    catalog_rows = []
+    yield catalog_rows
+    lookup.append_many(catalog_identifier, catalog_rows)
+
+
+def package_stimulus_set(catalog_name, proto_stimulus_set, stimulus_set_identifier, bucket_name="brainio-temp",
+                         catalog_rows=None):
     """
     Package a set of stimuli along with their metadata for the BrainIO system.
     :param catalog_name: The name of the lookup catalog to add the stimulus set to.
@@ -169,6 +185,8 @@ def package_stimulus_set(catalog_name, proto_stimulus_set, stimulus_set_identifi
     :param stimulus_set_identifier: A unique name identifying the stimulus set
         <lab identifier>.<first author e.g. 'Rajalingham' or 'MajajHong' for shared first-author><YYYY year of publication>.
     :param bucket_name: The name of the bucket to upload to.
+    :param catalog_rows: If a list is passed, the catalog rows are added to it instead of being appended to the catalog,
+        see :func:`batch_append`.
     """
     _logger.debug(f"Packaging {stimulus_set_identifier}")
 
@@ -197,21 +215,17 @@ def package_stimulus_set(catalog_name, proto_stimulus_set, stimulus_set_identifi
     zip_object_properties = upload_to_s3(str(target_zip_path), bucket_name, target_s3_key=zip_file_name)
     # link to csv and zip from same identifier. The csv however is the only one of the two rows with a class.
 
-    if catalog_name is not None:
-        lookup.append(
-            catalog_identifier=catalog_name,
-            object_identifier=stimulus_set_identifier, cls='StimulusSet',
-            lookup_type=TYPE_STIMULUS_SET,
-            bucket_name=bucket_name, sha1=csv_sha1, s3_key=csv_file_name,
-            stimulus_set_identifier=None
-        )
-        lookup.append(
-            catalog_identifier=catalog_name,
-            object_identifier=stimulus_set_identifier, cls=None,
-            lookup_type=TYPE_STIMULUS_SET,
-            bucket_name=bucket_name, sha1=stimulus_zip_sha1, s3_key=zip_file_name,
-            stimulus_set_identifier=None
-        )
+    rows = [
+        dict(object_identifier=stimulus_set_identifier, cls='StimulusSet',
+             lookup_type=TYPE_STIMULUS_SET,
+             bucket_name=bucket_name, sha1=csv_sha1, s3_key=csv_file_name,
+             stimulus_set_identifier=None),
+        dict(object_identifier=stimulus_set_identifier, cls=None,
+             lookup_type=TYPE_STIMULUS_SET,
+             bucket_name=bucket_name, sha1=stimulus_zip_sha1, s3_key=zip_file_name,
+             stimulus_set_identifier=None),
+    ]
+    _register_lookups(catalog_name, rows, catalog_rows)
     csv_version_id = csv_object_properties['VersionId'] if 'VersionId' in csv_object_properties else None
     zip_version_id = zip_object_properties['VersionId'] if 'VersionId' in zip_object_properties else None
     _logger.debug(f"stimulus set {stimulus_set_identifier} packaged:\n bucket={bucket_name}, csv_sha1={csv_sha1},"
@@ -221,6 +235,13 @@ def package_stimulus_set(catalog_name, proto_stimulus_set, stimulus_set_identifi
 
 
 
+def _register_lookups(catalog_identifier, rows, catalog_rows=None):
+    if catalog_rows is not None:
+        catalog_rows.extend(rows)
+    elif catalog_identifier is not None:
+        lookup.append_many(catalog_identifier, rows)
+
+
 def write_netcdf(assembly, target_netcdf_file, append=False, group=None, compress=True):
     """
     Write a DataAssembly object to a netCDF file.
@@ -256,7 +277,8 @@ def write_netcdf(assembly, target_netcdf_file, append=False, group=None, compres
 
 
 def package_data_assembly(catalog_identifier, proto_data_assembly, assembly_identifier, stimulus_set_identifier,
-                          assembly_class_name="NeuronRecordingAssembly", bucket_name="brainio-temp", extras=None):
+                          assembly_class_name="NeuronRecordingAssembly", bucket_name="brainio-temp", extras=None,
+                          catalog_rows=None):
     """
     Package a set of data along with its metadata for the BrainIO system.
     :param catalog_identifier: The name of the lookup catalog to add the data assembly to.
@@ -276,6 +298,8 @@ def package_data_assembly(catalog_identifier, proto_data_assembly, assembly_iden
     :param stimulus_set_identifier: The unique name of an existing StimulusSet in the BrainIO system.
     :param assembly_class_name: The name of a DataAssembly subclass.
     :param bucket_name: The name of the bucket to upload to.
+    :param catalog_rows: If a list is passed, the catalog row is added to it instead of being appended to the catalog,
+        see :func:`batch_append`.
     """
     _logger.debug(f"Packaging {assembly_identifier}")
 
@@ -299,14 +323,11 @@ def package_data_assembly(catalog_identifier, proto_data_assembly, assembly_iden
             netcdf_kf_sha1 = write_netcdf(ex, target_netcdf_path, append=True, group=k)
     object_properties = upload_to_s3(target_netcdf_path, bucket_name, s3_key)
 
-    if catalog_identifier is not None:
-        lookup.append(
-            catalog_identifier=catalog_identifier,
-            object_identifier=assembly_identifier, stimulus_set_identifier=stimulus_set_identifier,
-            lookup_type=TYPE_ASSEMBLY,
-            bucket_name=bucket_name, sha1=netcdf_kf_sha1,
-            s3_key=s3_key, cls=assembly_class_name,
-        )
+    rows = [dict(object_identifier=assembly_identifier, stimulus_set_identifier=stimulus_set_identifier,
+                 lookup_type=TYPE_ASSEMBLY,
+                 bucket_name=bucket_name, sha1=netcdf_kf_sha1,
+                 s3_key=s3_key, cls=assembly_class_name)]
+    _register_lookups(catalog_identifier, rows, catalog_rows)
     version_id = object_properties['VersionId'] if 'VersionId' in object_properties else None
     _logger.debug(f"assembly {assembly_identifier} packaged:\n, version_id={version_id}, sha1={netcdf_kf_sha1}, "
                   f"bucket_name={bucket_name}, cls={assembly_class_name}")
@@ -1,21 +1,44 @@
+import bz2
+import io
+import json
 import logging
 import os
+import struct
+import threading
+import zipfile
+import zlib
+from collections.abc import MutableMapping, ItemsView, ValuesView
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+from brainio.dtypes import compact_dtypes, compact_metadata_enabled, infer_compact_dtypes
+
 _logger = logging.getLogger(__name__)
 
+DTYPES_SIDECAR_SUFFIX = ".dtypes.json"
+STIMULUS_ID_COLUMNS = ('stimulus_id', 'image_id')  # merged with assemblies, never compacted
+
 
 class StimulusSet(pd.DataFrame):
     # http://pandas.pydata.org/pandas-docs/stable/development/extending.html#subclassing-pandas-data-structures
-    _metadata = pd.DataFrame._metadata + ["identifier", "get_stimulus", 'get_loader_class', "stimulus_paths", "from_files"]
+    _metadata = pd.DataFrame._metadata + ["identifier", "get_stimulus", 'get_loader_class', "stimulus_paths", "from_files",
+                                          "stimulus_store"]
+    stimulus_store = None  # serves the stimuli from a zip file instead of extracted files, see ZipStimulusStore
 
     @property
     def _constructor(self):
         return StimulusSet
 
     def get_stimulus(self, stimulus_id):
+        """
+        :return: the path of the stimulus file or, if the stimulus set is backed by a `stimulus_store`,
+            an in-memory binary file (`io.BytesIO`) with the stimulus' contents
+        """
+        if self.stimulus_store is not None:
+            return self.stimulus_store.open(self.stimulus_paths[stimulus_id])
         return self.stimulus_paths[stimulus_id]
 
     @classmethod
@@ -34,27 +57,595 @@ class StimulusSet(pd.DataFrame):
         return loader.load()
 
 
+class StimulusPaths(MutableMapping):
+    """
+    Maps stimulus ids to the paths of their files.
+    Only arrays of the ids and filenames are kept, `Path` objects are created when a path is accessed.
+    Like a dict, the mapping can be modified: changes are kept separately from the arrays.
+    """
+
+    def __init__(self, stimulus_ids, filenames, directory=None):
+        """
+        :param directory: the directory that the filenames are relative to.
+            Without a directory, the filenames are returned as they are, e.g. as names within a stimulus store.
+        """
+        stimulus_ids = pd.Index(stimulus_ids)
+        filenames = np.asarray(filenames, dtype=object)
+        unique = ~stimulus_ids.duplicated(keep='last')  # like a dict, keep the last path of every id
+        if not unique.all():
+            stimulus_ids, filenames = stimulus_ids[unique], filenames[unique]
+        self._stimulus_ids = stimulus_ids
+        self._filenames = filenames
+        self.directory = directory
+        self._assigned = {}  # stimulus id -> path, for ids assigned after construction
+        self._hidden = set()  # ids in the arrays that were deleted or assigned
+
+    def _path(self, filename):
+        return Path(self.directory) / filename if self.directory is not None else filename
+
+    def _in_arrays(self, stimulus_id):
+        try:
+            return stimulus_id in self._stimulus_ids and stimulus_id not in self._hidden
+        except TypeError:
+            return False
+
+    @property
+    def _modified(self):
+        return bool(self._assigned) or bool(self._hidden)
+
+    def __getitem__(self, stimulus_id):
+        try:
+            return self._assigned[stimulus_id]
+        except (KeyError, TypeError):
+            pass
+        if stimulus_id in self._hidden:
+            raise KeyError(stimulus_id)
+        try:
+            position = self._stimulus_ids.get_loc(stimulus_id)
+        except (KeyError, TypeError):
+            raise KeyError(stimulus_id)
+        return self._path(self._filenames[position])
+
+    def __setitem__(self, stimulus_id, path):
+        if self._in_arrays(stimulus_id):
+            self._hidden.add(stimulus_id)
+        self._assigned[stimulus_id] = path
+
+    def __delitem__(self, stimulus_id):
+        if stimulus_id in self._assigned:
+            del self._assigned[stimulus_id]
+        elif self._in_arrays(stimulus_id):
+            self._hidden.add(stimulus_id)
+        else:
+            raise KeyError(stimulus_id)
+
+    def __contains__(self, stimulus_id):
+        try:
+            return stimulus_id in self._assigned or self._in_arrays(stimulus_id)
+        except TypeError:
+            return False
+
+    def __iter__(self):
+        if not self._modified:
+            return iter(self._stimulus_ids)
+        return (stimulus_id for stimulus_id, _ in self.items())
+
+    def __len__(self):
+        return len(self._stimulus_ids) - len(self._hidden) + len(self._assigned)
+
+    def clear(self):
+        self._stimulus_ids = self._stimulus_ids[:0]
+        self._filenames = self._filenames[:0]
+        self._assigned = {}
+        self._hidden = set()
+
+    def copy(self):
+        """
+        :return: a copy that can be modified independently, sharing the arrays with this mapping
+        """
+        copy = type(self).__new__(type(self))
+        copy.__dict__.update(self.__dict__)
+        copy._assigned = dict(self._assigned)
+        copy._hidden = set(self._hidden)
+        return copy
+
+    def values(self):
+        return _StimulusPathsValues(self)
+
+    def items(self):
+        return _StimulusPathsItems(self)
+
+    def _array_items(self):
+        items = zip(self._stimulus_ids, self._filenames)
+        if self._hidden:
+            items = ((stimulus_id, filename) for stimulus_id, filename in items if stimulus_id not in self._hidden)
+        return items
+
+    @property
+    def filenames(self):
+        """
+        :return: the filenames of all stimuli, relative to `directory` unless they were assigned
+        """
+        if not self._modified:
+            return self._filenames
+        return np.array([filename for _, filename in self._array_items()]
+                        + [str(path) for path in self._assigned.values()], dtype=object)
+
+    @property
+    def nbytes(self):
+        # the filename strings are shared with the stimulus set's column
+        nbytes = int(self._stimulus_ids.memory_usage()) + self._filenames.nbytes
+        return nbytes + sum(2 * len(str(path)) for path in self._assigned.values())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} stimuli in {self.directory})"
+
+
+class _StimulusPathsValues(ValuesView):
+    def __iter__(self):
+        return (path for _, path in self._mapping.items())
+
+
+class _StimulusPathsItems(ItemsView):
+    def __iter__(self):
+        mapping = self._mapping
+        for stimulus_id, filename in mapping._array_items():
+            yield stimulus_id, mapping._path(filename)
+        yield from mapping._assigned.items()
+
+
 class StimulusSetLoader:
     """
-    Loads a StimulusSet from a CSV file and a directory of stimuli.
+    Loads a StimulusSet from a CSV file and a directory of stimuli, or a :class:`ZipStimulusStore`.
     """
-    def __init__(self, cls, csv_path, stimuli_directory):
+    def __init__(self, cls, csv_path, stimuli_directory, stimulus_store=None, stimulus_files=None,
+                 dtypes=None, compact=None):
+        """
+        :param stimulus_files: the paths, relative to `stimuli_directory`, of all files in it,
+            e.g. from the manifest of an extraction. By default, the directory is scanned.
+        :param dtypes: the dtypes of metadata columns, by default read from the csv's dtypes sidecar
+            (see :func:`write_dtypes_sidecar`) or inferred, see :func:`brainio.dtypes.compact_dtypes`
+        :param compact: whether to convert metadata columns to compact dtypes,
+            by default the value of the `BRAINIO_COMPACT_METADATA` environment variable.
+            Repeated strings become categoricals, which e.g. need `observed=` in `groupby`
+            and only accept values of their categories when assigned to.
+        """
         self.stimulus_set_class = cls
         self.csv_path = csv_path
         self.stimuli_directory = stimuli_directory
+        self.stimulus_store = stimulus_store
+        self.stimulus_files = stimulus_files
+        self.dtypes = dtypes
+        self.compact = compact_metadata_enabled() if compact is None else compact
 
     def load(self):
         stimulus_set = pd.read_csv(self.csv_path)
         self.correct_stimulus_id_name(stimulus_set)
+        if self.compact:
+            dtypes = self.dtypes if self.dtypes is not None else read_dtypes_sidecar(self.csv_path)
+            stimulus_set = compact_dtypes(stimulus_set, dtypes=dtypes, exclude=STIMULUS_ID_COLUMNS,
+                                          description=self.csv_path)
+        attrs = stimulus_set.attrs
         stimulus_set = self.stimulus_set_class(stimulus_set)
-        stimulus_set.stimulus_paths = {row['stimulus_id']: Path(self.stimuli_directory) / row['filename']
-                                       for _, row in stimulus_set.iterrows()}
+        stimulus_set.attrs.update(attrs)
+        if self.stimulus_store is not None:
+            # stimuli are identified by their names within the store, which the csv records as filenames
+            stimulus_set.stimulus_store = self.stimulus_store
+            stimulus_set.stimulus_paths = StimulusPaths(stimulus_set['stimulus_id'].values,
+                                                        stimulus_set['filename'].values)
+            assert all(filename in self.stimulus_store for filename in stimulus_set.stimulus_paths.filenames)
+            return stimulus_set
+        stimulus_set.stimulus_paths = StimulusPaths(stimulus_set['stimulus_id'].values,
+                                                    stimulus_set['filename'].values,
+                                                    directory=self.stimuli_directory)
         # make sure that all the stimulus files a loaded StimulusSet offers access to are actually available
-        assert all(stimulus_path.is_file() for stimulus_path in stimulus_set.stimulus_paths.values())
+        missing = self.missing_files(stimulus_set.stimulus_paths.filenames)
+        assert len(missing) == 0, f"{len(missing)} stimulus files missing in {self.stimuli_directory}, " \
+                                  f"e.g. {missing[:3]}"
         return stimulus_set
 
+    def missing_files(self, filenames):
+        """
+        Checks all files at once against the known or scanned files in the stimuli directory,
+        and only checks the files that are not among them individually (e.g. absolute paths).
+        :return: the filenames of files that do not exist
+        """
+        if self.stimulus_files is None:
+            self.stimulus_files = scan_files(self.stimuli_directory)
+        unknown = filenames[~pd.Index(filenames).isin(self.stimulus_files)]
+        return [filename for filename in unknown if not (Path(self.stimuli_directory) / filename).is_file()]
+
     @classmethod
     def correct_stimulus_id_name(cls, stimulus_set):
         if 'image_id' in stimulus_set and 'stimulus_id' not in stimulus_set:
             stimulus_set['stimulus_id'] = stimulus_set['image_id']
 
+
+def write_dtypes_sidecar(csv_path):
+    """
+    Writes the compact dtypes of the columns in a csv file to a sidecar next to it,
+    so that loading the csv does not need to infer them.
+    """
+    frame = pd.read_csv(csv_path)
+    dtypes = infer_compact_dtypes(frame, exclude=STIMULUS_ID_COLUMNS)
+    with open(str(csv_path) + DTYPES_SIDECAR_SUFFIX, 'w') as f:
+        json.dump(dtypes, f)
+    return dtypes
+
+
+def read_dtypes_sidecar(csv_path):
+    """
+    :return: the dtypes in the sidecar of a csv file, or None if there is none
+    """
+    try:
+        with open(str(csv_path) + DTYPES_SIDECAR_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def scan_files(directory):
+    """
+    Lists all files below `directory` in a single pass, skipping hidden files and directories.
+    :return: the paths of the files relative to `directory`, separated by `/`
+    """
+    files = []
+    pending = [(str(directory), '')]
+    while pending:
+        path, prefix = pending.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    pending.append((entry.path, prefix + entry.name + '/'))
+                elif entry.is_file():
+                    files.append(prefix + entry.name)
+    return files
+
+
+_LOCAL_FILE_HEADER = struct.Struct('<4s5H3L2H')
+_LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+class ZipStimulusStore:
+    """
+    Serves stimuli straight from a zip file without extracting it,
+    so that a stimulus set stays a single file on disk no matter how many stimuli it contains.
+    The zip's central directory is read once into an index of member offsets, which can be kept in a file,
+    and members are read from a single descriptor of the zip with positional reads, from any number of threads.
+    """
+    _index_dtype = [('offset', np.int64), ('end', np.int64), ('compress_size', np.int64), ('file_size', np.int64),
+                    ('crc', np.uint32), ('compress_type', np.uint16), ('flag_bits', np.uint16)]
+
+    def __init__(self, zip_path, index_path=None):
+        """
+        :param index_path: a file to keep the index of member offsets in, so that the central directory
+            does not need to be parsed again. It has to be specific to the zip's contents, e.g. named after its hash.
+        """
+        self.zip_path = str(zip_path)
+        self.index_path = index_path
+        index = self._load_index()
+        if index is None:
+            index = self._read_index()
+            self._save_index(*index)
+        self._names, self._entries = index
+        self._positions = {name: position for position, name in enumerate(self._names)}
+        self._file_lock = threading.Lock()
+        self._file = None
+
+    def _open_zip(self):
+        return zipfile.ZipFile(self.zip_path, 'r')
+
+    def _load_index(self):
+        if self.index_path is None:
+            return None
+        try:
+            with np.load(self.index_path, allow_pickle=False) as index:
+                return index['names'].tolist(), index['entries']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+    def _save_index(self, names, entries):
+        if self.index_path is None:
+            return
+        buffer = io.BytesIO()
+        np.savez(buffer, names=np.array(names, dtype=str), entries=entries)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            _write_file_atomic(self.index_path, buffer.getvalue())
+        except OSError:  # e.g. a read-only directory, the index is read from the zip again next time
+            _logger.debug(f"Could not write the index of {self.zip_path} to {self.index_path}", exc_info=True)
+
+    def _read_index(self):
+        """
+        :return: the member names and an array of the members' offsets, sizes and checksums.
+            Every member spans the bytes from its offset to its `end`, the offset of the member that follows it.
+        """
+        with self._open_zip() as zip_file:
+            members = [member for member in zip_file.infolist() if not member.is_dir()]
+            central_directory_offset = zip_file.start_dir
+        names = [member.filename for member in members]
+        entries = np.array([(member.header_offset, 0, member.compress_size, member.file_size,
+                             member.CRC, member.compress_type, member.flag_bits) for member in members],
+                           dtype=self._index_dtype)
+        order = np.argsort(entries['offset'], kind='stable')
+        ends = np.append(entries['offset'][order][1:], central_directory_offset)
+        entries['end'][order] = ends
+        return names, entries
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def names(self):
+        return list(self._names)
+
+    def _position(self, name):
+        try:
+            return self._positions[name]
+        except KeyError:
+            raise KeyError(f"{name} not in {self.zip_path}")
+
+    def read(self, name):
+        """
+        :return: the uncompressed contents of the member `name`, checked against the size and CRC in the zip
+        """
+        entry = self._entries[self._position(name)]
+        offset = int(entry['offset'])
+        return self._member_from_span(name, entry, self._read_range(offset, int(entry['end']) - offset))
+
+    def open(self, name):
+        """
+        :return: an in-memory binary file (`io.BytesIO`) with the contents of the member `name`
+        """
+        return io.BytesIO(self.read(name))
+
+    def _member_from_span(self, name, entry, span):
+        """
+        :param span: the bytes of the member in the zip, starting with its local file header
+        """
+        if len(span) < _LOCAL_FILE_HEADER.size:
+            raise zipfile.BadZipFile(f"{name} in {self.zip_path} is truncated")
+        fields = _LOCAL_FILE_HEADER.unpack(span[:_LOCAL_FILE_HEADER.size])
+        if fields[0] != _LOCAL_FILE_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad local file header for {name} in {self.zip_path}")
+        data_offset = _LOCAL_FILE_HEADER.size + fields[-2] + fields[-1]  # skip the name and extra field
+        data = bytes(span[data_offset:data_offset + int(entry['compress_size'])])
+        if len(data) != entry['compress_size']:
+            raise zipfile.BadZipFile(f"{name} in {self.zip_path} is truncated")
+        return self._decompress(name, entry, data)
+
+    def _decompress(self, name, entry, data):
+        if entry['flag_bits'] & 0x1:
+            raise NotImplementedError(f"{name} in {self.zip_path} is encrypted")
+        compress_type = int(entry['compress_type'])
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        elif compress_type == zipfile.ZIP_BZIP2:
+            data = bz2.decompress(data)
+        elif compress_type != zipfile.ZIP_STORED:
+            raise NotImplementedError(f"Compression method {compress_type} of {name} in {self.zip_path}")
+        if len(data) != entry['file_size'] or zlib.crc32(data) != entry['crc']:
+            raise zipfile.BadZipFile(f"Bad size or CRC-32 for {name} in {self.zip_path}")
+        return data
+
+    def _read_range(self, offset, length):
+        with self._file_lock:
+            if self._file is None:
+                self._file = open(self.zip_path, 'rb')
+            if not hasattr(os, 'pread'):  # e.g. on Windows, reads share the file position
+                self._file.seek(offset)
+                data = self._file.read(length)
+        if hasattr(os, 'pread'):
+            data = os.pread(self._file.fileno(), length, offset)
+        if len(data) != length:
+            raise zipfile.BadZipFile(f"{self.zip_path} is truncated")
+        return data
+
+    def close(self):
+        with self._file_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __getstate__(self):
+        # open files cannot be pickled, processes open their own
+        state = dict(self.__dict__)
+        del state['_file_lock']
+        state['_file'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._file_lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        return self  # the store is read-only, copies of a stimulus set can share it
+
+
+class RemoteZipStimulusStore(ZipStimulusStore):
+    """
+    Serves stimuli from a remote zip file without downloading all of it.
+    Only the zip's central directory is fetched up front, with ranged reads from the end of the file.
+    Members are fetched the first time they are opened, or in batches with :meth:`prefetch`,
+    checked against their size and CRC, and kept as files in `cache_directory`.
+    """
+
+    def __init__(self, location, size, read_range, cache_directory, directory_cache_path=None,
+                 max_gap=256 * 1024, max_request_size=16 * 2 ** 20, max_workers=8):
+        """
+        :param location: the location of the zip file, used in messages
+        :param size: the size of the zip file in bytes
+        :param read_range: a function `(start, end)` returning the bytes from `start` to `end` (inclusive) of the zip
+        :param cache_directory: the directory to keep fetched members in, under their names in the zip
+        :param directory_cache_path: a file to keep the central directory in,
+            so that the store can be recreated without fetching it again
+        :param max_gap: the number of unneeded bytes between two members up to which both are fetched in one request
+        :param max_request_size: the number of bytes beyond which members are fetched in separate requests
+        :param max_workers: the number of requests made in parallel
+        """
+        self.size = size
+        self.read_range = read_range
+        self.cache_directory = str(cache_directory)
+        self.directory_cache_path = directory_cache_path
+        self.max_gap = max_gap
+        self.max_request_size = max_request_size
+        self.max_workers = max_workers
+        self._range_file = _RangeFile(size, read_range, tail=self._read_directory_cache())
+        super(RemoteZipStimulusStore, self).__init__(location)
+        self._write_directory_cache()
+
+    def _open_zip(self):
+        return zipfile.ZipFile(self._range_file, 'r')
+
+    def _read_directory_cache(self):
+        if self.directory_cache_path is None:
+            return b''
+        try:
+            with open(self.directory_cache_path, 'rb') as f:
+                tail = f.read()
+        except OSError:
+            return b''
+        return tail if len(tail) <= self.size else b''
+
+    def _write_directory_cache(self):
+        if self.directory_cache_path is None or self._range_file.fetched == 0:
+            return
+        os.makedirs(os.path.dirname(self.directory_cache_path), exist_ok=True)
+        _write_file_atomic(self.directory_cache_path, self._range_file.tail)
+
+    def _read_range(self, offset, length):
+        return self.read_range(offset, offset + length - 1)
+
+    def local_path(self, name):
+        """
+        :return: the path that the member `name` is kept at once fetched
+        """
+        path = os.path.normpath(os.path.join(self.cache_directory, name))
+        if os.path.isabs(name) or os.path.relpath(path, self.cache_directory).startswith('..'):
+            raise zipfile.BadZipFile(f"Unsafe member name {name} in {self.zip_path}")
+        return path
+
+    def _is_fetched(self, name):
+        try:
+            return os.path.getsize(self.local_path(name)) == self._entries[self._position(name)]['file_size']
+        except OSError:
+            return False
+
+    def path(self, name):
+        """
+        :return: the local path of the member `name`, fetched first if it has not been fetched yet
+        """
+        if not self._is_fetched(name):
+            self.prefetch([name])
+        return self.local_path(name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def open(self, name):
+        """
+        :return: an in-memory file with the contents of the member `name`, like :meth:`ZipStimulusStore.open`,
+            so that stimuli are accessed the same way in all stimulus modes
+        """
+        return io.BytesIO(self.read(name))
+
+    def prefetch(self, names):
+        """
+        Fetches all members in `names` that have not been fetched yet.
+        Members close to each other in the zip are fetched together in one request,
+        and requests are made in parallel.
+        :return: the number of members fetched
+        """
+        positions = sorted({self._position(name) for name in names if not self._is_fetched(name)},
+                           key=lambda position: self._entries[position]['offset'])
+        batches = self._coalesce(positions)
+        if len(batches) > 0:
+            _logger.debug(f"Fetching {len(positions)} members of {self.zip_path} in {len(batches)} requests")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for future in [executor.submit(self._fetch_batch, *batch) for batch in batches]:
+                future.result()
+        return len(positions)
+
+    def _coalesce(self, positions):
+        """
+        :param positions: member positions, ordered by offset
+        :return: a list of `(start, end, positions)` of requests that together cover all members
+        """
+        batches = []
+        for position in positions:
+            start, end = int(self._entries[position]['offset']), int(self._entries[position]['end'])
+            if batches and start - batches[-1][1] <= self.max_gap and end - batches[-1][0] <= self.max_request_size:
+                batches[-1][1] = max(batches[-1][1], end)
+                batches[-1][2].append(position)
+            else:
+                batches.append([start, end, [position]])
+        return batches
+
+    def _fetch_batch(self, start, end, positions):
+        data = memoryview(self.read_range(start, end - 1))
+        if len(data) != end - start:
+            raise zipfile.BadZipFile(f"Requested {end - start} bytes of {self.zip_path}, received {len(data)}")
+        for position in positions:
+            name, entry = self._names[position], self._entries[position]
+            member = self._member_from_span(name, entry, data[int(entry['offset']) - start:int(entry['end']) - start])
+            path = self.local_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_file_atomic(path, member)
+
+    def __getstate__(self):
+        raise TypeError(f"{type(self).__name__} cannot be pickled, its `read_range` is bound to this process")
+
+
+class _RangeFile(io.RawIOBase):
+    """
+    A read-only file over the ranged reads of a remote file, for :mod:`zipfile` to parse the central directory from.
+    Everything read is kept, from the lowest offset read to the end of the file.
+    """
+
+    def __init__(self, size, read_range, tail=b''):
+        self.size = size
+        self.read_range = read_range
+        self.tail = tail
+        self.fetched = 0  # the number of bytes fetched
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.position = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence] + offset
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        if self.position >= end:
+            return b''
+        tail_offset = self.size - len(self.tail)
+        if self.position < tail_offset:
+            self.tail = self.read_range(self.position, tail_offset - 1) + self.tail
+            self.fetched += tail_offset - self.position
+            tail_offset = self.position
+        data = self.tail[self.position - tail_offset:end - tail_offset]
+        self.position = end
+        return data
+
+
+def _write_file_atomic(path, content):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
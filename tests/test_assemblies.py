@@ -4,6 +4,7 @@ import pytest
 import numpy as np
 import pandas as pd
 import xarray as xr
+from brainio.dtypes import COMPACT_ATTRIBUTE
 from brainio.stimuli import StimulusSet
 from tests.conftest import get_nc_extras_path, get_nc_path, get_csv_path, get_dir_path, make_proto_assembly
 from xarray import DataArray
@@ -562,3 +563,26 @@ class TestFromFiles:
 
 
 
+
+
+def test_merge_compact_stimulus_set():
+    stimulus_set = StimulusSet({'stimulus_id': [f'n{index}' for index in range(10)],
+                                'category': pd.Categorical(['a', 'b'] * 5),
+                                'size': np.arange(10, dtype=np.int8),
+                                'ty': np.linspace(0, 1, 10, dtype=np.float32)})
+    stimulus_set.attrs[COMPACT_ATTRIBUTE] = True
+    loader = assemblies.StimulusMergeAssemblyLoader(cls=DataAssembly, file_path=get_nc_path(),
+                                                    stimulus_set_identifier="test", stimulus_set=stimulus_set)
+    assembly = loader.load()
+    assert assembly['category'].dtype == object
+    assert set(assembly['category'].values) <= {'a', 'b'}
+    assert assembly['size'].dtype == np.int64
+    assert assembly['ty'].dtype == np.float64
+
+
+def test_merge_keeps_dtypes_without_compaction():
+    stimulus_set = StimulusSet({'stimulus_id': [f'n{index}' for index in range(10)],
+                                'ty': np.linspace(0, 1, 10, dtype=np.float32)})
+    loader = assemblies.StimulusMergeAssemblyLoader(cls=DataAssembly, file_path=get_nc_path(),
+                                                    stimulus_set_identifier="test", stimulus_set=stimulus_set)
+    assert loader.load()['ty'].dtype == np.float32
@@ -0,0 +1,199 @@
+import os
+
+import pytest
+
+from brainio import cache, fetch
+from brainio.__main__ import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Makes every access happen one second after the previous one. """
+    now = [1_000_000]
+
+    def time():
+        now[0] += 1
+        return now[0]
+
+    monkeypatch.setattr(cache.time, "time", time)
+
+
+def make_entry(home, name, size, extension=".nc"):
+    directory = home / name
+    directory.mkdir(exist_ok=True)
+    path = directory / (name + extension)
+    path.write_bytes(b"x" * size)
+    cache.touch(str(path))
+    return str(path)
+
+
+@pytest.mark.parametrize(['size', 'expected'], [
+    (1024, 1024),
+    ("1024", 1024),
+    ("2K", 2048),
+    ("1.5M", int(1.5 * 2 ** 20)),
+    ("10GiB", 10 * 2 ** 30),
+    ("1t", 2 ** 40),
+])
+def test_parse_size(size, expected):
+    assert cache.parse_size(size) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        cache.parse_size("a lot")
+
+
+def test_stats(brainio_home, clock):
+    make_entry(brainio_home, "assy_b", 200)
+    make_entry(brainio_home, "assy_a", 100)
+    (brainio_home / ".verified").mkdir()
+    report = cache.stats()
+    assert list(report['entry']) == ["assy_b", "assy_a"]
+    assert list(report['size']) == [200, 100]
+    assert not report['pinned'].any()
+
+
+def test_stats_measures_new_files(brainio_home, clock):
+    path = make_entry(brainio_home, "image_test", 100, extension=".zip")
+    (brainio_home / "image_test" / "n0.png").write_bytes(b"x" * 50)
+    cache.touch(path)
+    assert cache.stats()['size'].item() == 150
+
+
+class TestGC:
+    def test_evicts_least_recently_used(self, brainio_home, clock):
+        for name in ["assy_old", "assy_middle", "assy_new"]:
+            make_entry(brainio_home, name, 100)
+        assert cache.gc(budget=150) == ["assy_old", "assy_middle"]
+        assert sorted(os.listdir(brainio_home)) == [".cache_index.json", ".locks", "assy_new"]
+        assert list(cache.stats()['entry']) == ["assy_new"]
+
+    def test_access_refreshes(self, brainio_home, clock):
+        old_path = make_entry(brainio_home, "assy_old", 100)
+        make_entry(brainio_home, "assy_new", 100)
+        cache.touch(old_path)
+        assert cache.gc(budget=150) == ["assy_new"]
+
+    def test_within_budget(self, brainio_home, clock):
+        make_entry(brainio_home, "assy", 100)
+        assert cache.gc(budget=100) == []
+        assert cache.gc(budget=None) == []
+
+    def test_budget_environment(self, brainio_home, clock, monkeypatch):
+        make_entry(brainio_home, "assy_old", 100)
+        make_entry(brainio_home, "assy_new", 100)
+        monkeypatch.setenv(cache.BRAINIO_CACHE_BUDGET, "0.1K")
+        assert cache.get_budget() == 102
+        assert cache.gc() == ["assy_old"]
+
+    def test_dry_run(self, brainio_home, clock):
+        make_entry(brainio_home, "assy_old", 100)
+        make_entry(brainio_home, "assy_new", 100)
+        assert cache.gc(budget=100, dry_run=True) == ["assy_old"]
+        assert os.path.isdir(brainio_home / "assy_old")
+
+    def test_keeps_protected(self, brainio_home, clock):
+        make_entry(brainio_home, "assy_kept", 100)
+        make_entry(brainio_home, "assy_downloading", 100)
+        (brainio_home / "assy_downloading" / "assy_downloading.nc.partial").write_bytes(b"x")
+        make_entry(brainio_home, "assy_new", 100)
+        assert cache.gc(budget=0, keep=["assy_kept"]) == ["assy_new"]
+
+    def test_forgets_verification(self, brainio_home, clock):
+        path = make_entry(brainio_home, "assy", 100)
+        fetch.verify_sha1(path, fetch.sha1_hash(path))
+        cache.gc(budget=0)
+        assert not os.listdir(brainio_home / fetch.VERIFIED_DIRECTORY)
+
+    def test_removes_unused_locks(self, brainio_home, clock):
+        make_entry(brainio_home, "assy", 100)
+        with fetch.file_lock(str(brainio_home / "assy")):
+            pass
+        cache.gc(budget=0)
+        assert os.listdir(brainio_home / fetch.LOCKS_DIRECTORY) == []
+
+    def test_in_use_not_evicted(self, brainio_home, clock):
+        make_entry(brainio_home, "assy_loading", 100)
+        make_entry(brainio_home, "assy_new", 100)
+        with cache.in_use(["assy_loading"]):
+            assert cache.gc(budget=0) == ["assy_new"]
+        assert cache.gc(budget=0) == ["assy_loading"]
+
+    @pytest.mark.parametrize('lock', ["in_use", "file_lock"])
+    def test_in_use_by_other_process(self, brainio_home, clock, lock):
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        locked, release = context.Event(), context.Event()
+        make_entry(brainio_home, "assy_loading", 100)
+        make_entry(brainio_home, "assy_new", 100)
+
+        def load():
+            with (cache.in_use(["assy_loading"]) if lock == "in_use"
+                  else fetch.file_lock(str(brainio_home / "assy_loading"))):
+                locked.set()
+                release.wait(10)
+
+        process = context.Process(target=load)
+        process.start()
+        try:
+            assert locked.wait(10)
+            # skipped without waiting for the other process
+            assert cache.gc(budget=0) == ["assy_new"]
+        finally:
+            release.set()
+            process.join(10)
+        assert cache.gc(budget=0) == ["assy_loading"]
+
+    def test_no_index_without_budget(self, brainio_home, monkeypatch):
+        monkeypatch.delenv(cache.BRAINIO_CACHE_BUDGET, raising=False)
+        directory = brainio_home / "assy"
+        directory.mkdir()
+        fetch._record_access(str(directory / "assy.nc"))
+        assert not os.path.exists(brainio_home / cache.CACHE_INDEX)
+
+
+class TestPin:
+    @pytest.fixture
+    def lookups(self, monkeypatch):
+        file_lookups = {
+            "test.assembly": [{'location': "https://bucket.s3.amazonaws.com/assy_test.nc"},
+                              {'location': "https://bucket.s3.amazonaws.com/image_test.csv"},
+                              {'location': "https://bucket.s3.amazonaws.com/image_test.zip"}],
+        }
+        monkeypatch.setattr(cache, "_file_lookups", lambda identifier: file_lookups[identifier])
+
+    def test_pinned_not_evicted(self, brainio_home, clock, lookups):
+        make_entry(brainio_home, "assy_test", 100)
+        make_entry(brainio_home, "image_test", 100, extension=".zip")
+        make_entry(brainio_home, "assy_other", 100)
+        assert cache.pin("test.assembly") == ["assy_test", "image_test"]
+        assert cache.pinned() == ["test.assembly"]
+        assert list(cache.stats()['pinned']) == [True, True, False]
+        assert cache.gc(budget=0) == ["assy_other"]
+
+    def test_unpin(self, brainio_home, clock, lookups):
+        make_entry(brainio_home, "assy_test", 100)
+        cache.pin("test.assembly")
+        cache.unpin("test.assembly")
+        assert cache.pinned() == []
+        assert cache.gc(budget=0) == ["assy_test"]
+
+
+class TestCLI:
+    def test_stats(self, brainio_home, clock, capsys):
+        make_entry(brainio_home, "assy", 1000)
+        assert main(["cache", "stats"]) == 0
+        output = capsys.readouterr().out
+        assert "assy" in output
+        assert "1 entries, 1,000 bytes" in output
+
+    def test_gc(self, brainio_home, clock, capsys):
+        make_entry(brainio_home, "assy_old", 100)
+        make_entry(brainio_home, "assy_new", 100)
+        assert main(["cache", "gc", "--budget", "100"]) == 0
+        assert "evicted: assy_old" in capsys.readouterr().out
+        assert not os.path.exists(brainio_home / "assy_old")
+
+    def test_gc_without_budget(self, brainio_home, capsys):
+        assert main(["cache", "gc"]) == 1
@@ -0,0 +1,1141 @@
+import functools
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import boto3
+import numpy as np
+import pytest
+from moto import mock_aws
+
+from brainio import fetch, lookup
+from brainio.assemblies import DataAssembly
+from brainio.catalogs import Catalog
+from brainio.fetch import BotoFetcher, DownloadConfig, download_ranges
+from brainio.lookup import TYPE_ASSEMBLY, TYPE_STIMULUS_SET, sha1_hash
+from brainio.stimuli import StimulusSet, ZipStimulusStore
+from tests.conftest import get_csv_path, get_dir_path, get_nc_path
+
+TEST_BUCKET = "brainio-fetch-test"
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # pooled clients created outside of this mock would reach out to the real S3
+    monkeypatch.setattr(fetch, "_s3_clients", {})
+    monkeypatch.setattr(fetch, "_bucket_signing", {})
+    with mock_aws():
+        client = boto3.client('s3', region_name="us-east-1")
+        client.create_bucket(Bucket=TEST_BUCKET)
+        yield client
+
+
+def s3_location(key):
+    return f"https://{TEST_BUCKET}.s3.amazonaws.com/{key}"
+
+
+def put_object(client, key, size, **kwargs):
+    content = os.urandom(size)
+    client.put_object(Bucket=TEST_BUCKET, Key=key, Body=content, **kwargs)
+    return content
+
+
+def put_file(client, key, path):
+    client.upload_file(str(path), TEST_BUCKET, key)
+    return {'location_type': "S3", 'location': s3_location(key), 'sha1': sha1_hash(path)}
+
+
+@pytest.fixture
+def s3_catalog(s3_bucket, tmp_path, monkeypatch):
+    """ Uploads the test stimulus set and assembly and registers them in a catalog of their own. """
+    zip_path = tmp_path / "image_test_fetch.zip"
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        for filename in os.listdir(get_dir_path()):
+            if filename.endswith('.png'):
+                zip_file.write(os.path.join(get_dir_path(), filename), arcname=filename)
+    rows = [
+        {'identifier': "test.fetch", 'lookup_type': TYPE_STIMULUS_SET, 'class': "StimulusSet",
+         'stimulus_set_identifier': None, **put_file(s3_bucket, "image_test_fetch.csv", get_csv_path())},
+        {'identifier': "test.fetch", 'lookup_type': TYPE_STIMULUS_SET, 'class': None,
+         'stimulus_set_identifier': None, **put_file(s3_bucket, "image_test_fetch.zip", zip_path)},
+        {'identifier': "test.fetch", 'lookup_type': TYPE_ASSEMBLY, 'class': "DataAssembly",
+         'stimulus_set_identifier': "test.fetch", **put_file(s3_bucket, "assy_test_fetch.nc", get_nc_path())},
+    ]
+    monkeypatch.setitem(lookup._catalogs, "brainio_fetch_test", Catalog(rows))
+    yield
+
+
+class TestDownloadConfig:
+    def test_parts(self):
+        config = DownloadConfig(max_concurrency=2, part_size=10)
+        assert config.parts(0) == []
+        assert config.parts(10) == [(0, 9)]
+        assert config.parts(25) == [(0, 9), (10, 19), (20, 24)]
+
+    def test_environment(self, monkeypatch):
+        monkeypatch.setenv(fetch.BRAINIO_DOWNLOAD_THREADS, "3")
+        monkeypatch.setenv(fetch.BRAINIO_DOWNLOAD_PART_SIZE, "1024")
+        config = DownloadConfig()
+        assert config.max_concurrency == 3
+        assert config.part_size == 1024
+        assert config.multipart_threshold == 1024
+
+
+@pytest.mark.parametrize('pwrite', [True, False])
+def test_download_ranges_out_of_order(tmp_path, monkeypatch, pwrite):
+    if not pwrite:  # e.g. on Windows
+        monkeypatch.delattr(os, "pwrite", raising=False)
+    content = os.urandom(1000)
+    requested = []
+
+    def read_range(start, end):
+        requested.append((start, end))
+        return content[start:end + 1]
+
+    target_path = tmp_path / "out.bin"
+    download_ranges(len(content), read_range, target_path, config=DownloadConfig(max_concurrency=4, part_size=64))
+    assert target_path.read_bytes() == content
+    assert sorted(requested) == DownloadConfig(part_size=64).parts(len(content))
+
+
+def test_download_ranges_short_read(tmp_path):
+    with pytest.raises(IOError):
+        download_ranges(100, lambda start, end: b"x", tmp_path / "out.bin",
+                        config=DownloadConfig(max_concurrency=2, part_size=10))
+
+
+def test_download_ranges_hash_in_order(tmp_path):
+    content = os.urandom(1000)
+
+    def read_range(start, end):
+        time.sleep((1000 - start) / 100000)  # early parts arrive last
+        return content[start:end + 1]
+
+    hasher = hashlib.sha1()
+    download_ranges(len(content), read_range, tmp_path / "out.bin",
+                    config=DownloadConfig(max_concurrency=4, part_size=64), hasher=hasher)
+    assert hasher.hexdigest() == hashlib.sha1(content).hexdigest()
+
+
+def test_download_ranges_hash_failure(tmp_path):
+    def read_range(start, end):
+        if start == 0:
+            raise IOError("connection reset")
+        return b"x" * (end - start + 1)
+
+    # the failing first part is never hashed, the scheduler must not wait for it
+    with pytest.raises(IOError, match="connection reset"):
+        download_ranges(1000, read_range, tmp_path / "out.bin",
+                        config=DownloadConfig(max_concurrency=2, part_size=10), hasher=hashlib.sha1())
+
+
+def test_sha1_hash_buffered(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(100000))
+    assert sha1_hash(path) == sha1_hash(path, buffer_size=1024) == hashlib.sha1(path.read_bytes()).hexdigest()
+
+
+@pytest.mark.parametrize('size', [0, 1000, 300 * 1024])
+def test_boto_fetcher_parallel(s3_bucket, brainio_home, size):
+    content = put_object(s3_bucket, "assy_test_parallel.nc", size)
+    fetcher = BotoFetcher(s3_location("assy_test_parallel.nc"), "assy_test_parallel",
+                          download_config=DownloadConfig(max_concurrency=4, part_size=64 * 1024))
+    local_path = fetcher.fetch()
+    with open(local_path, 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(local_path + ".partial")
+
+
+
+class TestHashWhileDownloading:
+    def test_verified_without_rereading(self, s3_bucket, brainio_home, monkeypatch):
+        content = put_object(s3_bucket, "assy_test_hashed.nc", 300 * 1024)
+        sha1 = hashlib.sha1(content).hexdigest()
+        monkeypatch.setattr(fetch, "sha1_hash", lambda *args, **kwargs: pytest.fail("file was read back to hash it"))
+        local_path = fetch.fetch_file("S3", s3_location("assy_test_hashed.nc"), sha1)
+        assert fetch.is_verified(local_path, sha1)
+
+    def test_mismatch_not_moved_into_place(self, s3_bucket, brainio_home):
+        content = put_object(s3_bucket, "assy_test_mismatch.nc", 1000)
+        fetcher = BotoFetcher(s3_location("assy_test_mismatch.nc"), "assy_test_mismatch", sha1="0" * 40)
+        with pytest.raises(fetch.HashMismatchError):
+            fetcher.fetch()
+        assert fetcher.downloaded_sha1 == hashlib.sha1(content).hexdigest()
+        assert not os.path.exists(fetcher.output_filename)
+        assert not os.path.exists(fetcher.output_filename + ".partial")
+
+
+
+def test_download_ranges_resume(tmp_path):
+    content = os.urandom(1000)
+    target_path = tmp_path / "out.bin"
+    target_path.write_bytes(content[:320] + b"\0" * 680)
+    requested, checkpoints = [], []
+
+    def read_range(start, end):
+        requested.append((start, end))
+        return content[start:end + 1]
+
+    hasher = hashlib.sha1(content[:320])
+    download_ranges(len(content), read_range, target_path, config=DownloadConfig(max_concurrency=4, part_size=64),
+                    hasher=hasher, offset=320, checkpoint=checkpoints.append)
+    assert target_path.read_bytes() == content
+    assert hasher.hexdigest() == hashlib.sha1(content).hexdigest()
+    assert min(requested)[0] == 320
+    assert checkpoints == sorted(checkpoints) and checkpoints[-1] == len(content)
+
+
+class TestResume:
+    PART_SIZE = 64 * 1024
+
+    @pytest.fixture
+    def interrupt_at(self, monkeypatch):
+        """ Makes downloads fail from the given byte onwards, as if the process was preempted. """
+        download = fetch.download_ranges
+
+        def interrupt(position):
+            def interrupted_download_ranges(size, read_range, *args, **kwargs):
+                def interrupted_read_range(start, end):
+                    if start >= position:
+                        raise ConnectionError("preempted")
+                    return read_range(start, end)
+
+                return download(size, interrupted_read_range, *args, **kwargs)
+
+            monkeypatch.setattr(fetch, "download_ranges", interrupted_download_ranges)
+            return lambda: monkeypatch.setattr(fetch, "download_ranges", download)
+
+        return interrupt
+
+    def fetcher(self, key, sha1=None):
+        return BotoFetcher(s3_location(key), os.path.splitext(key)[0], sha1=sha1,
+                           download_config=DownloadConfig(max_concurrency=1, part_size=self.PART_SIZE))
+
+    def test_resumes(self, s3_bucket, brainio_home, interrupt_at, monkeypatch):
+        content = put_object(s3_bucket, "assy_test_resume.nc", 5 * self.PART_SIZE)
+        resume = interrupt_at(2 * self.PART_SIZE)
+        fetcher = self.fetcher("assy_test_resume.nc")
+        with pytest.raises(Exception):
+            fetcher.fetch()
+        partial_filename = fetcher.output_filename + ".partial"
+        assert not os.path.exists(fetcher.output_filename)
+        assert os.path.exists(partial_filename)
+        with open(partial_filename + ".json") as f:
+            assert json.load(f)['completed'] == 2 * self.PART_SIZE
+
+        resume()
+        requested = []
+        download = fetch.download_ranges
+
+        def recording_download_ranges(size, read_range, *args, **kwargs):
+            return download(size, lambda start, end: requested.append(start) or read_range(start, end),
+                            *args, **kwargs)
+
+        monkeypatch.setattr(fetch, "download_ranges", recording_download_ranges)
+        fetcher = self.fetcher("assy_test_resume.nc", sha1=hashlib.sha1(content).hexdigest())
+        local_path = fetcher.fetch()
+        assert requested == [2 * self.PART_SIZE, 3 * self.PART_SIZE, 4 * self.PART_SIZE]
+        with open(local_path, 'rb') as f:
+            assert f.read() == content
+        assert fetcher.downloaded_sha1 == hashlib.sha1(content).hexdigest()
+        assert not os.path.exists(partial_filename)
+        assert not os.path.exists(partial_filename + ".json")
+
+    def test_changed_object_restarts(self, s3_bucket, brainio_home, interrupt_at):
+        put_object(s3_bucket, "assy_test_changed.nc", 5 * self.PART_SIZE)
+        resume = interrupt_at(2 * self.PART_SIZE)
+        with pytest.raises(Exception):
+            self.fetcher("assy_test_changed.nc").fetch()
+        resume()
+        content = put_object(s3_bucket, "assy_test_changed.nc", 5 * self.PART_SIZE)
+        local_path = self.fetcher("assy_test_changed.nc", sha1=hashlib.sha1(content).hexdigest()).fetch()
+        with open(local_path, 'rb') as f:
+            assert f.read() == content
+
+
+class TestS3Clients:
+    def test_pooled(self, s3_bucket):
+        client = fetch.get_s3_client(signed=True, max_pool_connections=4)
+        assert fetch.get_s3_client(signed=True, max_pool_connections=4) is client
+        assert fetch.get_s3_client(signed=False, max_pool_connections=4) is not client
+        assert fetch.get_s3_client(signed=True, max_pool_connections=8) is not client
+
+    def test_pooled_across_threads(self, s3_bucket):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda _: fetch.get_s3_client(), range(32)))
+        assert all(client is clients[0] for client in clients)
+
+    def test_signing_mode_remembered(self, s3_bucket, brainio_home, monkeypatch):
+        put_object(s3_bucket, "public_1.csv", 100, ACL='public-read')
+        put_object(s3_bucket, "public_2.csv", 100, ACL='public-read')
+        attempts = []
+        get_s3_client = fetch.get_s3_client
+
+        def public_bucket_client(signed=True, max_pool_connections=10):
+            attempts.append(signed)
+            if signed:
+                raise IOError("Access Denied")
+            return get_s3_client(signed=signed, max_pool_connections=max_pool_connections)
+
+        monkeypatch.setattr(fetch, "get_s3_client", public_bucket_client)
+        BotoFetcher(s3_location("public_1.csv"), "public_1").fetch()
+        assert attempts == [True, False]
+        assert fetch._bucket_signing[TEST_BUCKET] is False
+        BotoFetcher(s3_location("public_2.csv"), "public_2").fetch()
+        assert attempts == [True, False, False]
+
+    def test_all_modes_fail(self, s3_bucket, brainio_home):
+        fetcher = BotoFetcher(s3_location("missing.csv"), "missing")
+        with pytest.raises(Exception) as e:
+            fetcher.fetch()
+        assert len(e.value.args[0]) == 2
+        assert TEST_BUCKET not in fetch._bucket_signing
+
+
+class TestConcurrentDependencies:
+    def test_get_assembly(self, s3_catalog, brainio_home):
+        assembly = fetch.get_assembly("test.fetch")
+        assert assembly.attrs['identifier'] == "test.fetch"
+        assert assembly.shape == (6, 3)
+        assert set(assembly['thing'].values) == {'foo0', 'foo1', 'foo4', 'foo9'}
+        assert assembly.attrs['stimulus_set'].identifier == "test.fetch"
+
+    def test_get_stimulus_set(self, s3_catalog, brainio_home):
+        stimulus_set = fetch.get_stimulus_set("test.fetch")
+        assert len(stimulus_set) == 10
+        assert all(path.is_file() for path in stimulus_set.stimulus_paths.values())
+
+    def test_dependencies_fetched_concurrently(self, s3_catalog, brainio_home, monkeypatch):
+        # every fetch waits for the other two: fetching the files one after the other would break the barrier
+        barrier = threading.Barrier(3, timeout=10)
+        fetch_file = fetch.fetch_file
+
+        def concurrent_fetch_file(*args, **kwargs):
+            barrier.wait()
+            return fetch_file(*args, **kwargs)
+
+        monkeypatch.setattr(fetch, "fetch_file", concurrent_fetch_file)
+        assembly = fetch.get_assembly("test.fetch")
+        assert len(assembly['stimulus_id']) == 6
+
+    def test_fetch_error_propagates(self, s3_catalog, brainio_home, monkeypatch):
+        fetch_file = fetch.fetch_file
+
+        def failing_fetch_file(location_type, location, sha1, version_id=None):
+            if location.endswith(".zip"):
+                raise IOError("zip unavailable")
+            return fetch_file(location_type, location, sha1, version_id=version_id)
+
+        monkeypatch.setattr(fetch, "fetch_file", failing_fetch_file)
+        with pytest.raises(IOError, match="zip unavailable"):
+            fetch.get_assembly("test.fetch")
+
+
+class TestPrefetch:
+    def test_report(self, s3_catalog, brainio_home):
+        report = fetch.prefetch(["test.fetch"])
+        assert len(report) == 3
+        assert set(report['lookup_type']) == {TYPE_ASSEMBLY, TYPE_STIMULUS_SET}
+        assert not report['cached'].any()
+        assert (report['seconds'] >= 0).all()
+        for local_path, size in zip(report['local_path'], report['bytes']):
+            assert os.path.getsize(local_path) == size
+        # the zip is extracted so that the stimulus set can be loaded without further work
+        stimuli_directory = os.path.dirname(report[report['location'].str.endswith('.zip')]['local_path'].item())
+        assert os.path.isfile(os.path.join(stimuli_directory, "n0.png"))
+
+    def test_cached(self, s3_catalog, brainio_home):
+        fetch.prefetch(["test.fetch"])
+        report = fetch.prefetch(["test.fetch"], max_workers=1)
+        assert report['cached'].all()
+
+    def test_deduplicates_shared_files(self, s3_catalog, brainio_home, monkeypatch):
+        fetched = []
+        fetch_file = fetch.fetch_file
+
+        def recording_fetch_file(location_type, location, sha1, version_id=None):
+            fetched.append(location)
+            return fetch_file(location_type, location, sha1, version_id=version_id)
+
+        monkeypatch.setattr(fetch, "fetch_file", recording_fetch_file)
+        # every file of the twice-requested assembly and its stimulus set is only fetched once
+        report = fetch.prefetch(["test.fetch", "test.fetch"])
+        assert len(report) == 3
+        assert sorted(fetched) == sorted(set(fetched))
+
+    def test_unknown_identifier(self, s3_catalog, brainio_home):
+        with pytest.raises(lookup.StimulusSetLookupError):
+            fetch.prefetch(["test.does-not-exist"])
+
+
+class TestVerificationLedger:
+    @pytest.fixture
+    def data_file(self, brainio_home):
+        path = brainio_home / "assy_test_ledger" / "assy_test_ledger.nc"
+        path.parent.mkdir()
+        path.write_bytes(os.urandom(1000))
+        return str(path)
+
+    @pytest.fixture
+    def hash_calls(self, monkeypatch):
+        calls = []
+        hash_file = fetch.sha1_hash
+
+        def counting_sha1_hash(path, *args, **kwargs):
+            calls.append(path)
+            return hash_file(path, *args, **kwargs)
+
+        monkeypatch.setattr(fetch, "sha1_hash", counting_sha1_hash)
+        return calls
+
+    def test_not_rehashed(self, data_file, hash_calls):
+        sha1 = sha1_hash(data_file)
+        fetch.verify_sha1(data_file, sha1)
+        fetch.verify_sha1(data_file, sha1)
+        assert hash_calls == [data_file]
+        assert fetch.is_verified(data_file, sha1)
+
+    def test_paranoid(self, data_file, hash_calls):
+        sha1 = sha1_hash(data_file)
+        fetch.verify_sha1(data_file, sha1)
+        fetch.verify_sha1(data_file, sha1, paranoid=True)
+        assert len(hash_calls) == 2
+
+    def test_paranoid_environment(self, monkeypatch):
+        assert not fetch.is_paranoid()
+        monkeypatch.setenv(fetch.BRAINIO_PARANOID, "1")
+        assert fetch.is_paranoid()
+
+    def test_modified_file_rehashed(self, data_file):
+        sha1 = sha1_hash(data_file)
+        fetch.verify_sha1(data_file, sha1)
+        with open(data_file, 'r+b') as f:
+            f.write(b"corrupted")
+        stat = os.stat(data_file)
+        os.utime(data_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert not fetch.is_verified(data_file, sha1)
+        with pytest.raises(IOError):
+            fetch.verify_sha1(data_file, sha1)
+
+    def test_different_hash(self, data_file):
+        fetch.verify_sha1(data_file, sha1_hash(data_file))
+        assert not fetch.is_verified(data_file, "0" * 40)
+
+    def test_verify_local_data(self, brainio_home):
+        paths = {}
+        for name in ["ok", "invalid", "missing"]:
+            path = brainio_home / f"{name}.csv"
+            path.write_bytes(os.urandom(100))
+            fetch.verify_sha1(str(path), sha1_hash(path))
+            paths[name] = str(path)
+        with open(paths["invalid"], 'r+b') as f:
+            f.write(b"corrupted")
+        os.remove(paths["missing"])
+        report = fetch.verify_local_data(max_workers=2)
+        assert dict(zip(report['path'], report['status'])) == {
+            paths["ok"]: "ok", paths["invalid"]: "invalid", paths["missing"]: "missing"}
+        assert set(fetch.verify_local_data()['path']) == {paths["ok"]}
+
+    def test_cli(self, data_file, capsys):
+        from brainio.__main__ import main
+        fetch.verify_sha1(data_file, sha1_hash(data_file))
+        assert main(["verify", "--workers", "2"]) == 0
+        assert "1 ok, 0 failed" in capsys.readouterr().out
+        os.remove(data_file)
+        assert main(["verify"]) == 1
+        assert f"missing: {data_file}" in capsys.readouterr().out
+
+
+class TestLocks:
+    def test_excludes_processes(self, brainio_home):
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        locked, release = context.Event(), context.Event()
+
+        def hold_lock():
+            with fetch.file_lock(str(brainio_home / "shared.nc")):
+                locked.set()
+                release.wait(10)
+
+        process = context.Process(target=hold_lock)
+        process.start()
+        try:
+            assert locked.wait(10)
+            acquired = threading.Event()
+
+            def acquire():
+                with fetch.file_lock(str(brainio_home / "shared.nc")):
+                    acquired.set()
+
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            assert not acquired.wait(0.5)
+            release.set()
+            assert acquired.wait(10)
+            thread.join()
+        finally:
+            release.set()
+            process.join()
+
+    def test_single_download(self, s3_bucket, brainio_home, monkeypatch):
+        content = put_object(s3_bucket, "assy_test_locked.nc", 1000)
+        downloads = []
+        download_boto = BotoFetcher.download_boto
+
+        def counting_download_boto(self):
+            downloads.append(self.location)
+            return download_boto(self)
+
+        monkeypatch.setattr(BotoFetcher, "download_boto", counting_download_boto)
+        sha1 = hashlib.sha1(content).hexdigest()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            paths = list(executor.map(
+                lambda _: fetch.fetch_file("S3", s3_location("assy_test_locked.nc"), sha1), range(8)))
+        assert len(downloads) == 1
+        assert len(set(paths)) == 1
+
+    def test_single_extraction(self, brainio_home, monkeypatch):
+        zip_path = brainio_home / "image_test_locked" / "image_test_locked.zip"
+        zip_path.parent.mkdir()
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            zip_file.write(os.path.join(get_dir_path(), "n0.png"), arcname="n0.png")
+        extractions = []
+        extractall = zipfile.ZipFile.extractall
+
+        def counting_extractall(self, *args, **kwargs):
+            extractions.append(self.filename)
+            return extractall(self, *args, **kwargs)
+
+        monkeypatch.setattr(zipfile.ZipFile, "extractall", counting_extractall)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: fetch.unzip(str(zip_path)), range(8)))
+        assert len(extractions) == 1
+
+
+    def test_unused_locks_removed(self, brainio_home):
+        with fetch.file_lock(str(brainio_home / "held.nc")):
+            with fetch.file_lock(str(brainio_home / "released.nc")):
+                pass
+            assert len(os.listdir(brainio_home / fetch.LOCKS_DIRECTORY)) == 2
+            assert fetch.remove_unused_locks() == 1
+            assert len(os.listdir(brainio_home / fetch.LOCKS_DIRECTORY)) == 1
+        assert fetch.remove_unused_locks() == 1
+        with fetch.file_lock(str(brainio_home / "released.nc")):
+            pass
+
+    def test_thread_locks_dropped(self, brainio_home):
+        for index in range(10):
+            with fetch.file_lock(str(brainio_home / f"{index}.nc")):
+                pass
+        assert fetch.remove_unused_locks() == 10
+        assert not any(lock_path.startswith(str(brainio_home)) for lock_path in fetch._thread_locks)
+
+    def test_removal_excludes_threads(self, brainio_home, monkeypatch):
+        # a thread locking the file while it is being removed waits for the removal and locks a new file
+        path = str(brainio_home / "shared.nc")
+        with fetch.file_lock(path):
+            pass
+        removing, locked = threading.Event(), threading.Event()
+        remove = os.remove
+
+        def slow_remove(lock_path):
+            removing.set()
+            assert not locked.wait(0.5)
+            remove(lock_path)
+
+        monkeypatch.setattr(fetch.os, "remove", slow_remove)
+
+        def acquire():
+            removing.wait(10)
+            with fetch.file_lock(path):
+                locked.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert fetch.remove_unused_locks() == 1
+        thread.join(10)
+        assert locked.is_set()
+        assert len(os.listdir(brainio_home / fetch.LOCKS_DIRECTORY)) == 1
+
+    def test_locks_of_other_processes_kept(self, brainio_home):
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        locked, release = context.Event(), context.Event()
+
+        def hold_lock():
+            with fetch.file_lock(str(brainio_home / "shared.nc")):
+                locked.set()
+                release.wait(10)
+
+        process = context.Process(target=hold_lock)
+        process.start()
+        try:
+            assert locked.wait(10)
+            assert fetch.remove_unused_locks() == 0  # held by the other process
+        finally:
+            release.set()
+            process.join(10)
+        assert fetch.remove_unused_locks() == 1
+
+
+class TestSharedTier:
+    @pytest.fixture
+    def shared_home(self, tmp_path, monkeypatch):
+        shared_home = tmp_path / "shared"
+        shared_home.mkdir()
+        monkeypatch.setattr(fetch, "_shared_data_paths", [str(shared_home)])
+        return shared_home
+
+    @pytest.fixture
+    def brainio_home(self, tmp_path, monkeypatch):
+        local_home = tmp_path / "local"
+        monkeypatch.setattr(fetch, "_local_data_path", str(local_home))
+        return local_home
+
+    def put_shared(self, shared_home, key, content):
+        directory = shared_home / os.path.splitext(key)[0]
+        directory.mkdir()
+        (directory / key).write_bytes(content)
+
+    def test_environment(self, monkeypatch):
+        monkeypatch.setattr(fetch, "_shared_data_paths", None)
+        monkeypatch.setenv(fetch.BRAINIO_SHARED_HOME, os.pathsep.join(["/shared/a", "/shared/b"]))
+        assert fetch.get_shared_data_paths() == ["/shared/a", "/shared/b"]
+        assert fetch.get_data_paths()[1:] == ["/shared/a", "/shared/b"]
+
+    def test_promoted(self, s3_bucket, shared_home, brainio_home, monkeypatch):
+        content = os.urandom(1000)
+        self.put_shared(shared_home, "assy_test_shared.nc", content)
+        monkeypatch.setattr(BotoFetcher, "download", lambda self: pytest.fail("downloaded despite shared copy"))
+        local_path = fetch.fetch_file("S3", s3_location("assy_test_shared.nc"), hashlib.sha1(content).hexdigest())
+        assert local_path == str(brainio_home / "assy_test_shared" / "assy_test_shared.nc")
+        with open(local_path, 'rb') as f:
+            assert f.read() == content
+        assert fetch.is_verified(local_path, hashlib.sha1(content).hexdigest())
+
+    def test_invalid_shared_copy_downloaded(self, s3_bucket, shared_home, brainio_home):
+        content = put_object(s3_bucket, "assy_test_stale.nc", 1000)
+        self.put_shared(shared_home, "assy_test_stale.nc", b"stale")
+        local_path = fetch.fetch_file("S3", s3_location("assy_test_stale.nc"), hashlib.sha1(content).hexdigest())
+        with open(local_path, 'rb') as f:
+            assert f.read() == content
+
+    def test_missing_in_shared_downloaded(self, s3_bucket, shared_home, brainio_home):
+        content = put_object(s3_bucket, "assy_test_missing.nc", 1000)
+        local_path = fetch.fetch_file("S3", s3_location("assy_test_missing.nc"), hashlib.sha1(content).hexdigest())
+        with open(local_path, 'rb') as f:
+            assert f.read() == content
+        assert not os.listdir(shared_home)
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """ Serves files with support for single byte ranges, like a typical static file server. """
+    accept_ranges = True
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        with open(path, 'rb') as f:
+            content = f.read()
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        byte_range = self.headers.get('Range')
+        self.requests.append((self.command, byte_range))
+        if self.headers.get('If-Match') not in (None, etag):
+            self.send_error(412)
+            return None
+        if byte_range and self.accept_ranges:
+            start, end = map(int, byte_range[len("bytes="):].split("-"))
+            content = content[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{os.path.getsize(path)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        if self.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return io.BytesIO(content)
+
+
+class TestHttpFetcher:
+    @pytest.fixture(params=[True, False], ids=["ranges", "no-ranges"])
+    def http_server(self, request, tmp_path, monkeypatch):
+        directory = tmp_path / "mirror"
+        directory.mkdir()
+        handler = type("Handler", (RangeRequestHandler,), {'accept_ranges': request.param, 'requests': []})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler, directory=str(directory)))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        monkeypatch.setattr(fetch, "_http_pool", None)
+        yield directory, f"http://127.0.0.1:{server.server_port}", handler
+        server.shutdown()
+        server.server_close()
+
+    @pytest.mark.parametrize('size', [0, 1000, 300 * 1024])
+    def test_fetch(self, http_server, brainio_home, size):
+        directory, url, handler = http_server
+        content = os.urandom(size)
+        (directory / "assy_test_http.nc").write_bytes(content)
+        fetcher = fetch.get_fetcher("HTTP", f"{url}/assy_test_http.nc", "assy_test_http",
+                                    sha1=hashlib.sha1(content).hexdigest())
+        fetcher.download_config = DownloadConfig(max_concurrency=4, part_size=64 * 1024)
+        with open(fetcher.fetch(), 'rb') as f:
+            assert f.read() == content
+        assert fetch.is_verified(fetcher.output_filename, hashlib.sha1(content).hexdigest())
+        ranged = [byte_range for command, byte_range in handler.requests if command == 'GET' and byte_range]
+        expected_parts = len(fetcher.download_config.parts(size)) if handler.accept_ranges else 0
+        assert len(ranged) == expected_parts
+
+    def test_mismatch(self, http_server, brainio_home):
+        directory, url, _ = http_server
+        (directory / "assy_test_http.nc").write_bytes(os.urandom(1000))
+        fetcher = fetch.get_fetcher("HTTP", f"{url}/assy_test_http.nc", "assy_test_http", sha1="0" * 40)
+        with pytest.raises(fetch.HashMismatchError):
+            fetcher.fetch()
+        assert not os.listdir(fetcher.local_dir_path)
+
+    def test_not_found(self, http_server, brainio_home):
+        _, url, _ = http_server
+        with pytest.raises(IOError):
+            fetch.get_fetcher("HTTP", f"{url}/missing.nc", "missing").fetch()
+
+    def test_connections_reused(self, http_server, brainio_home):
+        directory, url, _ = http_server
+        for index in range(3):
+            (directory / f"image_test_{index}.csv").write_bytes(os.urandom(100))
+            fetch.get_fetcher("HTTP", f"{url}/image_test_{index}.csv", f"image_test_{index}").fetch()
+        pool = fetch.get_http_pool()
+        assert pool is fetch.get_http_pool()
+        assert len(pool.pools) == 1
+
+    def test_open_ranges(self, http_server, brainio_home):
+        directory, url, handler = http_server
+        content = os.urandom(1000)
+        (directory / "image_test_http.zip").write_bytes(content)
+        fetcher = fetch.get_fetcher("HTTP", f"{url}/image_test_http.zip", "image_test_http")
+        if not handler.accept_ranges:
+            with pytest.raises(IOError):
+                fetcher.open_ranges()
+            return
+        size, read_range = fetcher.open_ranges()
+        assert size == 1000
+        assert read_range(100, 199) == content[100:200]
+        assert not os.path.exists(fetcher.output_filename)
+
+
+class TestLocalFileFetcher:
+    def test_fetch(self, tmp_path, brainio_home):
+        content = os.urandom(1000)
+        source = tmp_path / "mirror" / "assy_test_file.nc"
+        source.parent.mkdir()
+        source.write_bytes(content)
+        local_path = fetch.fetch_file("file", source.as_uri(), hashlib.sha1(content).hexdigest())
+        assert local_path == str(brainio_home / "assy_test_file" / "assy_test_file.nc")
+        with open(local_path, 'rb') as f:
+            assert f.read() == content
+
+    def test_mismatch(self, tmp_path, brainio_home):
+        source = tmp_path / "assy_test_file.nc"
+        source.write_bytes(os.urandom(1000))
+        with pytest.raises(fetch.HashMismatchError):
+            fetch.fetch_file("file", source.as_uri(), "0" * 40)
+        assert not os.path.exists(brainio_home / "assy_test_file" / "assy_test_file.nc")
+
+
+def test_register_fetcher_type(tmp_path, brainio_home, monkeypatch):
+    class MemoryFetcher(fetch.Fetcher):
+        def __init__(self, location, local_filename, version_id=None, sha1=None):
+            super(MemoryFetcher, self).__init__(location, local_filename, sha1=sha1)
+
+        def download(self):
+            with open(self.output_filename, 'wb') as f:
+                f.write(b"in memory")
+
+    monkeypatch.setitem(fetch._fetcher_types, "memory", MemoryFetcher)  # restored after the test
+    fetch.register_fetcher_type("memory", MemoryFetcher)
+    local_path = fetch.fetch_file("memory", "memory://catalog/image_test_memory.csv",
+                                  hashlib.sha1(b"in memory").hexdigest())
+    with open(local_path, 'rb') as f:
+        assert f.read() == b"in memory"
+
+
+def test_register_fetcher_type_without_sha1(tmp_path, brainio_home, monkeypatch):
+    class LegacyFetcher(fetch.Fetcher):
+        def __init__(self, location, local_filename, version_id=None):
+            super(LegacyFetcher, self).__init__(location, local_filename)
+
+        def download(self):
+            with open(self.output_filename, 'wb') as f:
+                f.write(b"legacy")
+
+    monkeypatch.setitem(fetch._fetcher_types, "legacy", LegacyFetcher)  # restored after the test
+    fetch.register_fetcher_type("legacy", LegacyFetcher)
+    sha1 = hashlib.sha1(b"legacy").hexdigest()
+    assert fetch.get_fetcher("legacy", "legacy://catalog/image_test_legacy.csv", "image_test_legacy", sha1=sha1) \
+        .sha1 == sha1
+    local_path = fetch.fetch_file("legacy", "legacy://catalog/image_test_legacy.csv", sha1)
+    with open(local_path, 'rb') as f:
+        assert f.read() == b"legacy"
+
+
+class TestMemoryCache:
+    @pytest.fixture(autouse=True)
+    def no_memory_cache(self, monkeypatch):
+        monkeypatch.setattr(fetch, "_memory_cache", None)
+        monkeypatch.delenv(fetch.BRAINIO_MEMORY_CACHE, raising=False)
+
+    def stimulus_set(self, identifier, rows=100):
+        stimulus_set = StimulusSet([{'stimulus_id': f"n{i}", 'value': i} for i in range(rows)])
+        stimulus_set.identifier = identifier
+        stimulus_set.stimulus_paths = {f"n{i}": f"/stimuli/n{i}.png" for i in range(rows)}
+        return stimulus_set
+
+    def test_parse_size(self):
+        assert fetch.parse_size("2K") == 2048
+
+    def test_lru(self):
+        size = fetch.estimate_nbytes(self.stimulus_set("a"))
+        cache = fetch.MemoryCache(2 * size)
+        for key in ["a", "b"]:
+            cache.put(key, self.stimulus_set(key))
+        cache.get("a")
+        cache.put("c", self.stimulus_set("c"))
+        assert "a" in cache and "c" in cache and "b" not in cache
+        assert cache.nbytes == 2 * size
+
+    def test_too_large(self):
+        stimulus_set = self.stimulus_set("a")
+        cache = fetch.MemoryCache(fetch.estimate_nbytes(stimulus_set) - 1)
+        assert cache.put("a", stimulus_set) is stimulus_set
+        assert len(cache) == 0
+        assert cache.get("a") is None
+
+    def test_copy(self):
+        cache = fetch.MemoryCache("1M", mode=fetch.MemoryCache.COPY)
+        cache.put("a", self.stimulus_set("a"))
+        copy = cache.get("a")
+        copy.loc[0, 'value'] = -1
+        copy.stimulus_paths["n0"] = "/elsewhere"
+        assert cache.get("a").loc[0, 'value'] == 0
+        assert cache.get("a").get_stimulus("n0") == "/stimuli/n0.png"
+        assert cache.get("a").identifier == "a"
+
+    def test_read_only(self):
+        cache = fetch.MemoryCache("1M", mode=fetch.MemoryCache.READ_ONLY)
+        view = cache.put("a", self.stimulus_set("a"))
+        with pytest.raises(ValueError):
+            view.loc[0, 'value'] = -1
+        assert cache.get("a", mode=fetch.MemoryCache.COPY) is not None
+
+    def test_read_only_assembly(self):
+        assembly = DataAssembly([[1, 2], [3, 4]], coords={'stimulus_id': ('presentation', ["n0", "n1"]),
+                                                          'neuroid_id': ('neuroid', ["a", "b"])},
+                                dims=['presentation', 'neuroid'])
+        assembly.attrs['stimulus_set'] = self.stimulus_set("a")
+        cache = fetch.MemoryCache("1M", mode=fetch.MemoryCache.READ_ONLY)
+        view = cache.put("assembly", assembly)
+        with pytest.raises(ValueError):
+            view.values[0, 0] = -1
+        with pytest.raises(ValueError):
+            view.attrs['stimulus_set'].loc[0, 'value'] = -1
+        copy = cache.get("assembly", mode=fetch.MemoryCache.COPY)
+        copy.values[0, 0] = -1
+        assert cache.get("assembly").values[0, 0] == 1
+        assert fetch.estimate_nbytes(assembly) > fetch.estimate_nbytes(assembly.attrs['stimulus_set'])
+
+    def test_invalid_mode(self):
+        with pytest.raises(ValueError):
+            fetch.MemoryCache("1M", mode="shared")
+
+    def test_environment(self, monkeypatch):
+        assert fetch.get_memory_cache() is None
+        monkeypatch.setenv(fetch.BRAINIO_MEMORY_CACHE, "1G")
+        monkeypatch.setenv(fetch.BRAINIO_MEMORY_CACHE_MODE, "readonly")
+        cache = fetch.get_memory_cache()
+        assert cache.budget == 2 ** 30
+        assert cache.mode == fetch.MemoryCache.READ_ONLY
+        assert fetch.get_memory_cache() is cache
+
+    def test_get_assembly(self, s3_catalog, brainio_home, monkeypatch):
+        fetch.enable_memory_cache("100M")
+        assembly = fetch.get_assembly("test.fetch")
+        monkeypatch.setattr(fetch, "fetch_file", lambda *args, **kwargs: pytest.fail("fetched despite memory cache"))
+        cached = fetch.get_assembly("test.fetch")
+        assert cached is not assembly
+        assert (cached.values == assembly.values).all()
+        assert cached.attrs['stimulus_set'].identifier == "test.fetch"
+        view = fetch.get_assembly("test.fetch", memory_cache_mode="readonly")
+        with pytest.raises(ValueError):
+            view.values[0, 0] = -1
+
+    def test_get_stimulus_set(self, s3_catalog, brainio_home, monkeypatch):
+        fetch.enable_memory_cache("100M")
+        stimulus_set = fetch.get_stimulus_set("test.fetch")
+        monkeypatch.setattr(fetch, "fetch_file", lambda *args, **kwargs: pytest.fail("fetched despite memory cache"))
+        cached = fetch.get_stimulus_set("test.fetch")
+        assert cached.equals(stimulus_set)
+        assert cached.stimulus_paths == stimulus_set.stimulus_paths
+
+    def test_disabled(self, s3_catalog, brainio_home, monkeypatch):
+        fetch.enable_memory_cache("100M")
+        fetch.disable_memory_cache()
+        fetch.get_stimulus_set("test.fetch")
+        assert fetch.get_memory_cache() is None
+
+
+class TestStimulusSetReuse:
+    @pytest.fixture(autouse=True)
+    def fresh_memo(self, monkeypatch):
+        monkeypatch.setattr(fetch, "_stimulus_set_memo", None)
+        monkeypatch.delenv(fetch.BRAINIO_STIMULUS_SET_CACHE, raising=False)
+
+    @pytest.fixture
+    def loads(self, monkeypatch):
+        loads = []
+        load_stimulus_set = fetch._load_stimulus_set
+
+        def counting_load_stimulus_set(identifier, *args, **kwargs):
+            loads.append(identifier)
+            return load_stimulus_set(identifier, *args, **kwargs)
+
+        monkeypatch.setattr(fetch, "_load_stimulus_set", counting_load_stimulus_set)
+        return loads
+
+    def test_loaded_once_for_many_assemblies(self, s3_catalog, brainio_home, loads):
+        assemblies = [fetch.get_assembly("test.fetch") for _ in range(10)]
+        assert loads == ["test.fetch"]
+        assert all(assembly.attrs['stimulus_set'].identifier == "test.fetch" for assembly in assemblies)
+        assert len({id(assembly.attrs['stimulus_set']) for assembly in assemblies}) == 10
+
+    def test_concurrent_requests_load_once(self, s3_catalog, brainio_home, loads):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            stimulus_sets = list(executor.map(lambda _: fetch.get_stimulus_set("test.fetch"), range(8)))
+        assert loads == ["test.fetch"]
+        assert all(len(stimulus_set) == 10 for stimulus_set in stimulus_sets)
+        assert fetch._stimulus_set_locks == {}
+
+    def test_views_share_data(self, s3_catalog, brainio_home):
+        stimulus_set = fetch.get_stimulus_set("test.fetch")
+        reloaded = fetch.get_stimulus_set("test.fetch")
+        assert reloaded is not stimulus_set
+        assert np.shares_memory(stimulus_set['stimulus_id'].values, reloaded['stimulus_id'].values)
+        with pytest.raises(ValueError):
+            stimulus_set['stimulus_id'].values[0] = "modified"
+
+    def test_copies_independent(self, s3_catalog, brainio_home):
+        stimulus_set = fetch.get_stimulus_set("test.fetch")
+        stimulus_set['thing'] = "modified"
+        stimulus_set.stimulus_paths.clear()
+        reloaded = fetch.get_stimulus_set("test.fetch")
+        assert set(reloaded['thing']) != {"modified"}
+        assert len(reloaded.stimulus_paths) == 10
+
+    def test_reloaded_after_eviction(self, s3_catalog, brainio_home, loads):
+        from brainio import cache
+        fetch.get_stimulus_set("test.fetch")
+        cache.gc(budget=0)
+        stimulus_set = fetch.get_stimulus_set("test.fetch")
+        assert loads == ["test.fetch", "test.fetch"]
+        assert all(path.is_file() for path in stimulus_set.stimulus_paths.values())
+
+    def test_manifest_instead_of_scan(self, s3_catalog, brainio_home, monkeypatch):
+        import brainio.stimuli
+        monkeypatch.setattr(brainio.stimuli, "scan_files", lambda directory: pytest.fail("scanned"))
+        stimulus_set = fetch.get_stimulus_set("test.fetch")
+        assert all(path.is_file() for path in stimulus_set.stimulus_paths.values())
+
+    def test_disabled(self, s3_catalog, brainio_home, loads, monkeypatch):
+        monkeypatch.setenv(fetch.BRAINIO_STIMULUS_SET_CACHE, "0")
+        fetch.get_stimulus_set("test.fetch")
+        fetch.get_stimulus_set("test.fetch")
+        assert loads == ["test.fetch", "test.fetch"]
+        assert len(fetch._get_stimulus_set_memo()) == 0
+
+
+class TestCacheBudget:
+    def test_load_keeps_own_files(self, s3_catalog, brainio_home, monkeypatch):
+        from brainio import cache
+        monkeypatch.setenv(cache.BRAINIO_CACHE_BUDGET, "1K")
+        assembly = fetch.get_assembly("test.fetch")
+        assert len(assembly['stimulus_id']) > 0
+        # the files just loaded are kept even though they exceed the budget
+        assert {"assy_test_fetch", "image_test_fetch"} <= set(os.listdir(brainio_home))
+
+    def test_evicts_other_files(self, s3_catalog, brainio_home, monkeypatch):
+        from brainio import cache
+        fetch.get_stimulus_set("test.fetch")
+        monkeypatch.setenv(cache.BRAINIO_CACHE_BUDGET, "1")
+        other = brainio_home / "assy_other"
+        other.mkdir()
+        (other / "assy_other.nc").write_bytes(b"x" * 100)
+        fetch.get_stimulus_set("test.fetch")
+        assert not os.path.exists(other)
+        assert os.path.exists(brainio_home / "image_test_fetch")
+
+
+class TestUnzip:
+    def make_zip(self, directory, count, name="image_test_unzip.zip", content=b"stimulus"):
+        directory.mkdir(exist_ok=True)
+        zip_path = directory / name
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            for index in range(count):
+                zip_file.writestr(f"group{index % 3}/n{index}.png", content + str(index).encode())
+        return str(zip_path)
+
+    def assert_extracted(self, directory, count, content=b"stimulus"):
+        for index in range(count):
+            with open(directory / f"group{index % 3}" / f"n{index}.png", 'rb') as f:
+                assert f.read() == content + str(index).encode()
+
+    def test_marker_skips_archive(self, tmp_path, brainio_home, monkeypatch):
+        zip_path = self.make_zip(tmp_path / "stimuli", 10)
+        fetch.unzip(zip_path, sha1="abc")
+        assert os.path.exists(tmp_path / "stimuli" / ".image_test_unzip.zip.extracted")
+        monkeypatch.setattr(zipfile, "ZipFile", lambda *args, **kwargs: pytest.fail("archive opened"))
+        monkeypatch.setattr(os.path, "exists", lambda *args, **kwargs: pytest.fail("members checked"))
+        assert fetch.unzip(zip_path, sha1="abc") == str(tmp_path / "stimuli")
+
+    def test_different_archive_extracted(self, tmp_path, brainio_home):
+        zip_path = self.make_zip(tmp_path / "stimuli", 10)
+        fetch.unzip(zip_path, sha1="abc")
+        os.remove(zip_path)
+        zip_path = self.make_zip(tmp_path / "stimuli", 10, content=b"updated!")
+        fetch.unzip(zip_path, sha1="def")
+        self.assert_extracted(tmp_path / "stimuli", 10, content=b"updated!")
+
+    def test_previously_extracted_without_marker(self, tmp_path, brainio_home, monkeypatch):
+        zip_path = self.make_zip(tmp_path / "stimuli", 10)
+        with zipfile.ZipFile(zip_path) as zip_file:
+            zip_file.extractall(tmp_path / "stimuli")
+        monkeypatch.setattr(fetch, "_extract", lambda *args, **kwargs: pytest.fail("extracted again"))
+        fetch.unzip(zip_path, sha1="abc")
+        assert os.path.exists(tmp_path / "stimuli" / ".image_test_unzip.zip.extracted")
+
+    def test_truncated_member_extracted(self, tmp_path, brainio_home):
+        zip_path = self.make_zip(tmp_path / "stimuli", 10)
+        with zipfile.ZipFile(zip_path) as zip_file:
+            zip_file.extractall(tmp_path / "stimuli")
+        (tmp_path / "stimuli" / "group0" / "n0.png").write_bytes(b"st")
+        fetch.unzip(zip_path, sha1="abc")
+        self.assert_extracted(tmp_path / "stimuli", 10)
+
+    def test_manifest(self, tmp_path, brainio_home):
+        zip_path = self.make_zip(tmp_path / "stimuli", 10)
+        assert fetch.read_extraction_manifest(zip_path) is None
+        fetch.unzip(zip_path)
+        assert sorted(fetch.read_extraction_manifest(zip_path)) == sorted(
+            f"group{index % 3}/n{index}.png" for index in range(10))
+
+    def test_parallel(self, tmp_path, brainio_home, monkeypatch):
+        zip_path = self.make_zip(tmp_path / "stimuli", 200)
+        threads = set()
+        extract = zipfile.ZipFile.extract
+
+        def recording_extract(self, *args, **kwargs):
+            threads.add(threading.get_ident())
+            return extract(self, *args, **kwargs)
+
+        monkeypatch.setattr(zipfile.ZipFile, "extract", recording_extract)
+        fetch.unzip(zip_path, max_workers=4)
+        self.assert_extracted(tmp_path / "stimuli", 200)
+        assert len(threads) > 1
+
+    @pytest.mark.parametrize('count', [10, 200])
+    def test_atomic(self, tmp_path, brainio_home, count):
+        zip_path = self.make_zip(tmp_path / "stimuli", count)
+        fetch.unzip(zip_path, max_workers=4, atomic=True)
+        self.assert_extracted(tmp_path / "stimuli", count)
+        assert sorted(name for name in os.listdir(tmp_path / "stimuli") if name.startswith('.')) == \
+               [".image_test_unzip.zip.extracted", ".image_test_unzip.zip.members"]
+
+    def test_atomic_failure_leaves_nothing(self, tmp_path, brainio_home, monkeypatch):
+        zip_path = self.make_zip(tmp_path / "stimuli", 200)
+        extract = zipfile.ZipFile.extract
+
+        def failing_extract(self, member, *args, **kwargs):
+            if member.filename.endswith("n150.png"):
+                raise OSError("disk full")
+            return extract(self, member, *args, **kwargs)
+
+        monkeypatch.setattr(zipfile.ZipFile, "extract", failing_extract)
+        with pytest.raises(OSError, match="disk full"):
+            fetch.unzip(zip_path, max_workers=4, atomic=True)
+        assert os.listdir(tmp_path / "stimuli") == ["image_test_unzip.zip"]
+
+
+class TestZipStimulusMode:
+    @pytest.fixture(autouse=True)
+    def fresh_memo(self, monkeypatch):
+        monkeypatch.setattr(fetch, "_stimulus_set_memo", None)
+
+    def test_not_extracted(self, s3_catalog, brainio_home, monkeypatch):
+        monkeypatch.setattr(fetch, "unzip", lambda *args, **kwargs: pytest.fail("extracted"))
+        stimulus_set = fetch.get_stimulus_set("test.fetch", stimulus_mode="zip")
+        assert len(stimulus_set) == 10
+        assert not any(filename.endswith('.png') for filename in os.listdir(brainio_home / "image_test_fetch"))
+        stimulus = stimulus_set.get_stimulus("n3")
+        assert isinstance(stimulus, io.BytesIO)
+        with open(os.path.join(get_dir_path(), "n3.png"), 'rb') as f:
+            assert stimulus.read() == f.read()
+
+    def test_assembly(self, s3_catalog, brainio_home):
+        assembly = fetch.get_assembly("test.fetch", stimulus_mode="zip")
+        stimulus_set = assembly.attrs['stimulus_set']
+        assert stimulus_set.stimulus_store is not None
+        assert len(stimulus_set.get_stimulus("n0").read()) > 0
+
+    def test_environment(self, s3_catalog, brainio_home, monkeypatch):
+        monkeypatch.setenv(fetch.BRAINIO_STIMULUS_MODE, "zip")
+        assert fetch.get_stimulus_set("test.fetch").stimulus_store is not None
+        assert fetch.get_stimulus_set("test.fetch", stimulus_mode="files").stimulus_store is None
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            fetch.get_stimulus_set("test.fetch", stimulus_mode="tar")
+
+
+class TestRemoteStimulusMode:
+    @pytest.fixture(autouse=True)
+    def fresh_memo(self, monkeypatch):
+        monkeypatch.setattr(fetch, "_stimulus_set_memo", None)
+
+    def test_zip_not_downloaded(self, s3_catalog, brainio_home, monkeypatch):
+        monkeypatch.setattr(fetch.BotoFetcher, "download", lambda self: pytest.fail("downloaded")
+                            if self.output_filename.endswith(".zip") else fetch.BotoFetcher.download_boto(self))
+        stimulus_set = fetch.get_stimulus_set("test.fetch", stimulus_mode="remote")
+        assert len(stimulus_set) == 10
+        stimuli_directory = brainio_home / "image_test_fetch"
+        assert not any(filename.endswith('.png') for filename in os.listdir(stimuli_directory))
+        stimulus = stimulus_set.get_stimulus("n3")
+        assert isinstance(stimulus, io.BytesIO)  # the same as in the zip mode
+        with open(os.path.join(get_dir_path(), "n3.png"), 'rb') as f:
+            assert stimulus.read() == f.read()
+        assert os.path.isfile(stimuli_directory / "n3.png")
+        assert not os.path.exists(stimuli_directory / "image_test_fetch.zip")
+
+    def test_prefetch_subset(self, s3_catalog, brainio_home):
+        assembly = fetch.get_assembly("test.fetch", stimulus_mode="remote")
+        stimulus_set = assembly.attrs['stimulus_set']
+        stimulus_ids = set(assembly['stimulus_id'].values)
+        fetched = stimulus_set.stimulus_store.prefetch(stimulus_set.stimulus_paths[stimulus_id]
+                                                       for stimulus_id in stimulus_ids)
+        assert fetched == len(stimulus_ids) < len(stimulus_set)
+
+    def test_downloaded_zip_used(self, s3_catalog, brainio_home):
+        fetch.get_stimulus_set("test.fetch", stimulus_mode="zip")
+        stimulus_set = fetch.get_stimulus_set("test.fetch", stimulus_mode="remote")
+        assert type(stimulus_set.stimulus_store) is ZipStimulusStore
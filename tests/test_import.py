@@ -1,3 +1,26 @@
+import subprocess
+import sys
+
+
 def test_import_brainio_collection():
     # noinspection PyUnresolvedReferences
-    from brainio.packaging import package_stimulus_set, package_data_assembly
\ No newline at end of file
+    from brainio.packaging import package_stimulus_set, package_data_assembly
+
+
+def test_import_does_not_load_heavy_dependencies():
+    # guards import time: listing catalogs must not pull in the dependencies needed for fetching and loading
+    heavy_modules = ['boto3', 'botocore', 'xarray', 'netCDF4', 'PIL', 'tqdm']
+    code = ("import sys, brainio; brainio.list_assemblies(); "
+            f"print('loaded:', [module for module in {heavy_modules!r} if module in sys.modules])")
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    loaded = [line for line in output.splitlines() if line.startswith('loaded:')]
+    assert loaded == ['loaded: []']
+
+
+def test_lazy_attributes():
+    import brainio
+    from brainio import get_assembly, get_stimulus_set
+    from brainio.fetch import get_assembly as fetch_get_assembly
+    assert get_assembly is fetch_get_assembly
+    assert brainio.get_stimulus_set is get_stimulus_set
+    assert brainio.fetch.get_local_data_path is not None
@@ -1,4 +1,6 @@
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pytest
@@ -13,6 +15,7 @@ import brainio
 from brainio import assemblies
 from brainio import fetch
 from brainio.assemblies import DataAssembly, get_levels, gather_indexes, is_fastpath
+from brainio.catalogs import Catalog, SQLiteCatalogStore, CATALOG_COLUMNS, STORAGE_SQLITE
 
 
 @pytest.mark.parametrize('assembly', (
@@ -83,8 +86,9 @@ def test_catalogs():
 def test_duplicates():
     all_lookups = brainio.lookup.combined_catalog()
     match_stim = all_lookups['lookup_type'] == brainio.lookup.TYPE_STIMULUS_SET
-    match_csv = all_lookups.apply(brainio.lookup._is_csv_lookup, axis=1)
-    match_zip = all_lookups.apply(brainio.lookup._is_zip_lookup, axis=1)
+    kinds = brainio.lookup._lookup_kinds(all_lookups)
+    match_csv = kinds == brainio.lookup.KIND_CSV
+    match_zip = kinds == brainio.lookup.KIND_ZIP
     match_assy = all_lookups['lookup_type'] == brainio.lookup.TYPE_ASSEMBLY
 
     match_hvm = all_lookups['identifier'] == "dicarlo.hvm"
@@ -103,4 +107,255 @@ def test_duplicates():
     assert len(all_lookups[match_c17 & match_assy]) == 1
 
 
+def test_combined_catalog_reused():
+    first = brainio.lookup.get_combined_catalog()
+    second = brainio.lookup.get_combined_catalog()
+    assert first is second
+    assert brainio.lookup.combined_catalog() is first.frame
 
+
+def test_combined_catalog_rebuilt_on_catalog_change(test_catalog_identifier):
+    combined = brainio.lookup.get_combined_catalog()
+    catalogs = brainio.lookup.get_catalogs()
+    original = catalogs[test_catalog_identifier]
+    try:
+        keep = (original['identifier'] != "tolias.Cadena2017") | (original['lookup_type'] != "assembly")
+        catalogs[test_catalog_identifier] = original[keep]
+        assert brainio.lookup.get_combined_catalog() is not combined
+        assert "tolias.Cadena2017" not in brainio.lookup.list_assemblies()
+    finally:
+        catalogs[test_catalog_identifier] = original
+    assert "tolias.Cadena2017" in brainio.lookup.list_assemblies()
+
+
+def test_list_stimulus_set_assemblies():
+    assemblies = brainio.lookup.list_stimulus_set_assemblies("dicarlo.hvm")
+    assert "dicarlo.MajajHong2015" in assemblies
+    assert "tolias.Cadena2017" not in assemblies
+    assert brainio.lookup.list_stimulus_set_assemblies("BadName") == []
+
+
+class TestLazyCatalogs:
+    @pytest.fixture
+    def fresh_catalogs(self, brainio_home, monkeypatch):
+        def reset():
+            monkeypatch.setattr(brainio.lookup, '_catalogs', {})
+            monkeypatch.setattr(brainio.lookup, '_combined', None)
+            monkeypatch.setattr(brainio.lookup, '_manifest', None)
+        reset()
+        yield reset
+
+    def test_manifest_written(self, fresh_catalogs, brainio_home):
+        brainio.lookup.lookup_assembly("tolias.Cadena2017")
+        manifest_path = brainio_home / brainio.lookup.CATALOG_MANIFEST
+        assert manifest_path.is_file()
+        fresh_catalogs()
+        manifest = brainio.lookup._get_manifest()
+        assert set(manifest) == {"brainio_test", "brainio_test2"}
+        assert "tolias.Cadena2017" in manifest["brainio_test"]['lookups'][brainio.lookup.TYPE_ASSEMBLY]
+
+    def test_loads_only_providing_catalog(self, fresh_catalogs):
+        brainio.lookup.get_catalogs()  # write manifest
+        fresh_catalogs()
+        assy = brainio.lookup.lookup_assembly("tolias.Cadena2017")
+        assert assy['source_catalog'] == "brainio_test"
+        assert set(brainio.lookup._catalogs) == {"brainio_test"}
+
+    def test_loads_all_providing_catalogs(self, fresh_catalogs):
+        brainio.lookup.get_catalogs()  # write manifest
+        fresh_catalogs()
+        brainio.lookup.lookup_stimulus_set("dicarlo.hvm")
+        assert set(brainio.lookup._catalogs) == {"brainio_test", "brainio_test2"}
+
+    def test_stale_manifest_ignored(self, fresh_catalogs, brainio_home):
+        brainio.lookup.get_catalogs()  # write manifest
+        fresh_catalogs()
+        manifest = brainio.lookup._get_manifest()
+        manifest["brainio_test2"]['mtime_ns'] -= 1
+        brainio.lookup.lookup_assembly("tolias.Cadena2017")
+        assert set(brainio.lookup._catalogs) == {"brainio_test", "brainio_test2"}
+
+    def test_unchanged_manifest_not_written(self, fresh_catalogs, brainio_home):
+        brainio.lookup.get_catalogs()  # write manifest
+        manifest_path = brainio_home / brainio.lookup.CATALOG_MANIFEST
+        inode = manifest_path.stat().st_ino
+        fresh_catalogs()
+        brainio.lookup.get_catalogs()
+        assert manifest_path.stat().st_ino == inode
+
+    def test_manifest_merged(self, fresh_catalogs, brainio_home):
+        brainio.lookup.get_catalogs()  # write manifest
+        manifest_path = brainio_home / brainio.lookup.CATALOG_MANIFEST
+        # another process records its catalog after this process has read the manifest
+        with open(manifest_path) as f:
+            on_disk = json.load(f)
+        on_disk["other_catalog"] = {**on_disk["brainio_test2"], 'entry_point': "other:catalog"}
+        with open(manifest_path, 'w') as f:
+            json.dump(on_disk, f)
+        brainio.lookup._get_manifest()["brainio_test"]['size'] -= 1
+        brainio.lookup._record_manifest("brainio_test", brainio.lookup.get_catalog("brainio_test"))
+        with open(manifest_path) as f:
+            assert set(json.load(f)) == {"brainio_test", "brainio_test2", "other_catalog"}
+
+    def test_catalog_without_file(self, fresh_catalogs, brainio_home):
+        catalog = brainio.lookup.get_catalog("brainio_test").copy()
+        (brainio_home / brainio.lookup.CATALOG_MANIFEST).unlink(missing_ok=True)
+        fresh_catalogs()
+        catalog.attrs['source_path'] = ":memory:"
+        brainio.lookup._record_manifest("brainio_test", catalog)
+        assert "brainio_test" not in brainio.lookup._get_manifest()
+
+
+class TestCatalogSidecar:
+    @pytest.fixture
+    def csv_path(self, tmp_path):
+        source = Path(brainio.lookup.get_catalog("brainio_test").attrs['source_path'])
+        csv_path = tmp_path / "lookup.csv"
+        csv_path.write_bytes(source.read_bytes())
+        return csv_path
+
+    def test_sidecar_reused(self, csv_path, brainio_home, monkeypatch):
+        first = Catalog.from_files("sidecar_test", csv_path, url="https://example.com/lookup.csv")
+        assert not (csv_path.parent / "lookup.csv.pkl").exists()
+        assert len(list((brainio_home / brainio.catalogs.SIDECARS_DIRECTORY).glob("lookup.csv.*.pkl"))) == 1
+
+        def fail(*args, **kwargs):
+            raise AssertionError("CSV should not be parsed")
+
+        monkeypatch.setattr(pd, 'read_csv', fail)
+        second = Catalog.from_files("sidecar_test", csv_path, url="https://example.com/lookup.csv")
+        assert isinstance(second, Catalog)
+        assert second.identifier == "sidecar_test"
+        assert second.url == "https://example.com/lookup.csv"
+        assert second.attrs['source_path'] == csv_path
+        pd.testing.assert_frame_equal(pd.DataFrame(first), pd.DataFrame(second))
+
+    def test_sidecar_invalidated(self, csv_path, brainio_home):
+        Catalog.from_files("sidecar_test", csv_path)
+        with open(csv_path, 'a') as f:
+            f.write("test.sidecar,assembly,DataAssembly,S3,https://example.com/test.nc,abc,dicarlo.hvm\n")
+        catalog = Catalog.from_files("sidecar_test", csv_path)
+        assert "test.sidecar" in set(catalog['identifier'])
+
+    def test_sidecar_format_changed(self, csv_path, brainio_home, monkeypatch):
+        # a sidecar written by a previous version that parsed the catalog differently
+        with monkeypatch.context() as previous_version:
+            previous_version.setattr(brainio.catalogs, "SIDECAR_VERSION", brainio.catalogs.SIDECAR_VERSION - 1)
+            previous_version.setattr(pd, "read_csv", lambda path: pd.DataFrame({'identifier': ["stale"]}))
+            assert list(Catalog.from_files("sidecar_test", csv_path)['identifier']) == ["stale"]
+        assert "stale" not in set(Catalog.from_files("sidecar_test", csv_path)['identifier'])
+
+    def test_compact(self, csv_path, brainio_home, monkeypatch):
+        monkeypatch.delenv(brainio.dtypes.BRAINIO_COMPACT_METADATA, raising=False)
+        assert Catalog.from_files("sidecar_test", csv_path)['lookup_type'].dtype == object
+        monkeypatch.setenv(brainio.dtypes.BRAINIO_COMPACT_METADATA, "1")
+        assert isinstance(Catalog.from_files("sidecar_test", csv_path)['lookup_type'].dtype, pd.CategoricalDtype)
+
+
+class TestSQLiteCatalog:
+    @pytest.fixture
+    def sqlite_catalog(self, tmp_path, monkeypatch):
+        source = brainio.lookup.get_catalog("brainio_test").attrs['source_path']
+        db_path = tmp_path / "lookup.sqlite"
+        SQLiteCatalogStore.from_csv(source, db_path)
+        catalog = Catalog.from_sqlite("sqlite_test", db_path)
+        monkeypatch.setitem(brainio.lookup._catalogs, "sqlite_test", catalog)
+        yield catalog
+
+    def test_from_sqlite(self, sqlite_catalog):
+        csv_catalog = brainio.lookup.get_catalog("brainio_test")
+        assert isinstance(sqlite_catalog, Catalog)
+        assert sqlite_catalog.identifier == "sqlite_test"
+        assert len(sqlite_catalog) == len(csv_catalog)
+        assert list(sqlite_catalog['location']) == list(csv_catalog['location'])
+
+    def test_append(self, sqlite_catalog):
+        catalog = brainio.lookup.append("sqlite_test", "test.sqlite_append", "DataAssembly",
+                                        brainio.lookup.TYPE_ASSEMBLY, "brainio-temp", "abc",
+                                        "assy_test_sqlite_append.nc", "dicarlo.hvm")
+        assert catalog.attrs['storage'] == STORAGE_SQLITE
+        assert len(catalog) == len(sqlite_catalog) + 1
+        store = SQLiteCatalogStore(sqlite_catalog.attrs['source_path'])
+        assert len(store.find("test.sqlite_append", brainio.lookup.TYPE_ASSEMBLY)) == 1
+        assert "test.sqlite_append" in brainio.lookup.list_assemblies()
+
+    def test_append_without_reload(self, sqlite_catalog, monkeypatch):
+        monkeypatch.setattr(SQLiteCatalogStore, "read", lambda self: pytest.fail("reloaded the catalog"))
+        for index in range(3):
+            catalog = brainio.lookup.append("sqlite_test", f"test.sqlite_append{index}", "DataAssembly",
+                                            brainio.lookup.TYPE_ASSEMBLY, "brainio-temp", "abc",
+                                            f"assy_test_sqlite_append{index}.nc", "dicarlo.hvm")
+        assert len(catalog) == len(sqlite_catalog) + 3
+        assert catalog.identifier == "sqlite_test"
+        assert catalog.attrs['source_path'] == sqlite_catalog.attrs['source_path']
+        assert list(catalog.index) == list(range(len(catalog)))
+
+    def test_from_csv_into_filled_store(self, sqlite_catalog):
+        source = brainio.lookup.get_catalog("brainio_test").attrs['source_path']
+        with pytest.raises(ValueError):
+            SQLiteCatalogStore.from_csv(source, sqlite_catalog.attrs['source_path'])
+        assert len(SQLiteCatalogStore(sqlite_catalog.attrs['source_path']).read()) == len(sqlite_catalog)
+
+    def test_append_duplicate(self, sqlite_catalog):
+        with pytest.raises(ValueError):
+            brainio.lookup.append("sqlite_test", "tolias.Cadena2017", "DataAssembly",
+                                  brainio.lookup.TYPE_ASSEMBLY, "brainio-temp", "abc",
+                                  "assy_tolias_Cadena2017.nc", "tolias.Cadena2017")
+        store = SQLiteCatalogStore(sqlite_catalog.attrs['source_path'])
+        assert len(store.read()) == len(sqlite_catalog)
+
+    def test_append_stimulus_set_parts(self, sqlite_catalog):
+        for cls, s3_key in [("StimulusSet", "stimulus_test_sqlite.csv"), (None, "stimulus_test_sqlite.zip")]:
+            brainio.lookup.append("sqlite_test", "test.sqlite_stimuli", cls, brainio.lookup.TYPE_STIMULUS_SET,
+                                  "brainio-temp", "abc", s3_key)
+        csv_lookup, zip_lookup = brainio.lookup.lookup_stimulus_set("test.sqlite_stimuli")
+        assert csv_lookup['location'].endswith(".csv")
+        assert zip_lookup['location'].endswith(".zip")
+
+    def test_concurrent_appends(self, sqlite_catalog):
+        store = SQLiteCatalogStore(sqlite_catalog.attrs['source_path'])
+
+        def append(index):
+            row = pd.DataFrame([{'identifier': f"test.concurrent{index}", 'lookup_type': "assembly",
+                                 'class': "DataAssembly", 'location_type': "S3",
+                                 'location': f"https://brainio-temp.s3.amazonaws.com/{index}.nc", 'sha1': "abc",
+                                 'stimulus_set_identifier': "dicarlo.hvm"}])
+            SQLiteCatalogStore(store.db_path).append(row, check_duplicates=brainio.lookup._check_duplicates)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(append, range(32)))
+        assert len(store.read()) == len(sqlite_catalog) + 32
+
+    def test_export_csv(self, sqlite_catalog, tmp_path):
+        csv_path = tmp_path / "export.csv"
+        SQLiteCatalogStore(sqlite_catalog.attrs['source_path']).export_csv(csv_path)
+        exported = Catalog.from_files("export_test", csv_path)
+        assert list(exported.columns) == CATALOG_COLUMNS
+        assert list(exported['sha1']) == list(sqlite_catalog['sha1'])
+
+
+def test_lookup_kinds():
+    lookups = pd.DataFrame([
+        {'lookup_type': "stimulus_set", 'class': "StimulusSet", 'location': "https://example.com/stimuli.csv"},
+        {'lookup_type': "stimulus_set", 'class': None, 'location': "https://example.com/stimuli.zip"},
+        {'lookup_type': "assembly", 'class': "DataAssembly", 'location': "https://example.com/assy.nc"},
+        {'lookup_type': "stimulus_set", 'class': None, 'location': "https://example.com/stimuli.csv"},
+        {'lookup_type': "stimulus_set", 'class': "StimulusSet", 'location': "https://example.com/stimuli.zip"},
+        {'lookup_type': "stimulus_set", 'class': None, 'location': None},
+    ])
+    assert list(brainio.lookup._lookup_kinds(lookups)) == [brainio.lookup.KIND_CSV, brainio.lookup.KIND_ZIP,
+                                                           brainio.lookup.KIND_ASSEMBLY, None, None, None]
+    combined = brainio.lookup.combined_catalog()
+    assert list(combined[brainio.lookup.KIND]) == list(brainio.lookup._lookup_kinds(combined))
+
+
+def test_lookup_stimulus_set_without_row_apply(monkeypatch):
+    brainio.lookup.get_combined_catalog()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("lookups should not be evaluated row by row")
+
+    monkeypatch.setattr(pd.DataFrame, 'apply', fail)
+    csv_lookup, zip_lookup = brainio.lookup.lookup_stimulus_set("dicarlo.hvm")
+    assert csv_lookup['location'].endswith(".csv")
+    assert zip_lookup['location'].endswith(".zip")
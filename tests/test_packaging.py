@@ -12,7 +12,7 @@ from pandas import DataFrame
 from brainio.assemblies import DataAssembly, get_levels
 from brainio.stimuli import StimulusSet
 from brainio.packaging import write_netcdf, check_stimulus_numbers, check_stimulus_naming_convention, TYPE_ASSEMBLY, \
-    package_stimulus_set, package_data_assembly, get_user_info, upload_to_s3
+    TYPE_STIMULUS_SET, package_stimulus_set, package_data_assembly, get_user_info, upload_to_s3, batch_append
 import brainio.lookup as lookup
 from tests.conftest import make_stimulus_set_df, make_spk_assembly, make_meta_assembly, BUCKET_NAME
 
@@ -105,6 +105,79 @@ def test_append(test_catalog_identifier, test_write_netcdf_path, restore_this_fi
     assert identifier in lookup.list_assemblies()
 
 
+def test_append_many(test_catalog_identifier, restore_this_file):
+    catalog = lookup.get_catalog(test_catalog_identifier)
+    restore_this_file(catalog.attrs['source_path'])
+    rows = [
+        dict(object_identifier="test.append_many", cls="StimulusSet", lookup_type=TYPE_STIMULUS_SET,
+             bucket_name="brainio-temp", sha1="abc", s3_key="stimulus_test_append_many.csv"),
+        dict(object_identifier="test.append_many", cls=None, lookup_type=TYPE_STIMULUS_SET,
+             bucket_name="brainio-temp", sha1="def", s3_key="stimulus_test_append_many.zip"),
+        dict(object_identifier="test.append_many", cls="DataAssembly", lookup_type=TYPE_ASSEMBLY,
+             bucket_name="brainio-temp", sha1="ghi", s3_key="assy_test_append_many.nc",
+             stimulus_set_identifier="test.append_many"),
+    ]
+    with patch.object(DataFrame, 'to_csv', autospec=True, side_effect=DataFrame.to_csv) as to_csv:
+        appended = lookup.append_many(test_catalog_identifier, rows)
+    assert to_csv.call_count == 1
+    assert len(appended) == len(catalog) + 3
+    assert "test.append_many" in lookup.list_stimulus_sets()
+    assert "test.append_many" in lookup.list_assemblies()
+
+
+@pytest.mark.parametrize('rows', [
+    # existing assembly
+    [dict(object_identifier="tolias.Cadena2017", cls="DataAssembly", lookup_type=TYPE_ASSEMBLY,
+          bucket_name="brainio-temp", sha1="abc", s3_key="assy_tolias_Cadena2017.nc")],
+    # existing stimulus set CSV
+    [dict(object_identifier="dicarlo.hvm", cls="StimulusSet", lookup_type=TYPE_STIMULUS_SET,
+          bucket_name="brainio-temp", sha1="abc", s3_key="image_dicarlo_hvm.csv")],
+    # duplicate within the batch
+    [dict(object_identifier="test.append_many", cls="DataAssembly", lookup_type=TYPE_ASSEMBLY,
+          bucket_name="brainio-temp", sha1="abc", s3_key="assy_test_append_many.nc")] * 2,
+])
+def test_append_many_duplicates(test_catalog_identifier, restore_this_file, rows):
+    catalog = lookup.get_catalog(test_catalog_identifier)
+    restore_this_file(catalog.attrs['source_path'])
+    with pytest.raises(ValueError):
+        lookup.append_many(test_catalog_identifier, rows)
+    assert lookup.get_catalog(test_catalog_identifier) is catalog
+
+
+def test_batch_append(test_catalog_identifier, brainio_home, restore_this_file, restore_catalog):
+    restore_catalog(test_catalog_identifier)
+    identifiers = ["test.BatchOne", "test.BatchTwo"]
+    with patch('brainio.packaging.upload_to_s3', return_value={}), \
+            patch('brainio.lookup.append_many', wraps=lookup.append_many) as append_many:
+        with batch_append(test_catalog_identifier) as catalog_rows:
+            for identifier in identifiers:
+                stimulus_set = StimulusSet(make_stimulus_set_df())
+                stimulus_set.stimulus_paths = {row["stimulus_id"]: Path(__file__).parent / f'images/{row["filename"]}'
+                                               for _, row in stimulus_set.iterrows()}
+                del stimulus_set["filename"]
+                package_stimulus_set(test_catalog_identifier, stimulus_set, identifier, bucket_name=BUCKET_NAME,
+                                     catalog_rows=catalog_rows)
+            assert len(catalog_rows) == 4
+            assert append_many.call_count == 0
+    assert append_many.call_count == 1
+    for identifier in identifiers:
+        assert identifier in lookup.list_stimulus_sets()
+
+
+def test_batch_append_error(test_catalog_identifier, restore_this_file):
+    catalog = lookup.get_catalog(test_catalog_identifier)
+    restore_this_file(catalog.attrs['source_path'])
+    with patch('brainio.lookup.append_many', wraps=lookup.append_many) as append_many:
+        with pytest.raises(RuntimeError, match="packaging failed"):
+            with batch_append(test_catalog_identifier) as catalog_rows:
+                catalog_rows.append(dict(object_identifier="test.BatchError", cls="StimulusSet",
+                                         lookup_type=TYPE_STIMULUS_SET, bucket_name="brainio-temp", sha1="abc",
+                                         s3_key="image_test_BatchError.csv"))
+                raise RuntimeError("packaging failed")
+    assert append_many.call_count == 0
+    assert "test.BatchError" not in lookup.list_stimulus_sets()
+
+
 @pytest.mark.private_access
 def test_package_stimulus_set(test_stimulus_set_identifier, test_catalog_identifier, brainio_home, restore_this_file,
                               restore_catalog):
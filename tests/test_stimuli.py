@@ -1,4 +1,9 @@
+import copy
 import os
+import pickle
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import imageio
 import numpy as np
@@ -6,7 +11,7 @@ import pandas as pd
 import pytest
 
 import brainio
-from brainio.stimuli import StimulusSet
+from brainio.stimuli import StimulusSet, ZipStimulusStore
 from tests.conftest import get_csv_path, get_dir_path
 
 
@@ -80,3 +85,329 @@ class TestFromFiles:
     def test_basic(self):
         test_from_files()
 
+
+
+@pytest.fixture
+def stimuli_zip(tmp_path):
+    zip_path = tmp_path / "image_test_ten_images.zip"
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        for filename in os.listdir(get_dir_path()):
+            if filename.endswith('.png'):
+                zip_file.write(os.path.join(get_dir_path(), filename), arcname=filename)
+    return zip_path
+
+
+def read_stimulus(filename):
+    with open(os.path.join(get_dir_path(), filename), 'rb') as f:
+        return f.read()
+
+
+class TestZipStimulusStore:
+    @pytest.mark.parametrize('compression', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2])
+    def test_read(self, tmp_path, compression):
+        zip_path = tmp_path / "stimuli.zip"
+        with zipfile.ZipFile(zip_path, 'w', compression=compression) as zip_file:
+            zip_file.writestr("a/n0.png", read_stimulus("n0.png"))
+            zip_file.writestr("b/", b"")
+        store = ZipStimulusStore(zip_path)
+        assert store.names() == ["a/n0.png"]
+        assert store.read("a/n0.png") == read_stimulus("n0.png")
+        assert "b/" not in store
+
+    def test_missing(self, stimuli_zip):
+        with pytest.raises(KeyError):
+            ZipStimulusStore(stimuli_zip).read("n10.png")
+
+    def test_corrupt(self, stimuli_zip):
+        store = ZipStimulusStore(stimuli_zip)
+        content = stimuli_zip.read_bytes()
+        offset = content.index(read_stimulus("n3.png"))
+        stimuli_zip.write_bytes(content[:offset + 100] + bytes([content[offset + 100] ^ 0xFF]) + content[offset + 101:])
+        with pytest.raises(zipfile.BadZipFile):
+            store.read("n3.png")
+
+    def test_threads(self, stimuli_zip):
+        store = ZipStimulusStore(stimuli_zip)
+        filenames = [f"n{index}.png" for index in range(10)] * 20
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            contents = list(executor.map(store.read, filenames))
+        assert contents == [read_stimulus(filename) for filename in filenames]
+        store.close()
+
+    def test_threads_share_one_file(self, stimuli_zip):
+        store = ZipStimulusStore(stimuli_zip)
+        open_files = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+        for _ in range(50):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(store.read, [f"n{index}.png" for index in range(10)]))
+        if open_files is not None:
+            assert len(os.listdir('/proc/self/fd')) <= open_files + 1
+        store.close()
+        assert store._file is None
+
+    def test_index_file(self, stimuli_zip, tmp_path, monkeypatch):
+        index_path = tmp_path / ".stimuli.zip.index"
+        names = ZipStimulusStore(stimuli_zip, index_path=index_path).names()
+        assert index_path.is_file()
+        monkeypatch.setattr(zipfile.ZipFile, "infolist", lambda self: pytest.fail("read the central directory"))
+        store = ZipStimulusStore(stimuli_zip, index_path=index_path)
+        assert store.names() == names
+        assert store.read("n3.png") == read_stimulus("n3.png")
+
+    def test_corrupt_index_file(self, stimuli_zip, tmp_path):
+        index_path = tmp_path / ".stimuli.zip.index"
+        index_path.write_bytes(b"corrupt")
+        store = ZipStimulusStore(stimuli_zip, index_path=index_path)
+        assert store.read("n3.png") == read_stimulus("n3.png")
+        assert len(ZipStimulusStore(stimuli_zip, index_path=index_path)) == len(store)
+
+    def test_copy_and_pickle(self, stimuli_zip):
+        store = ZipStimulusStore(stimuli_zip)
+        store.read("n0.png")
+        assert copy.deepcopy(store) is store
+        unpickled = pickle.loads(pickle.dumps(store))
+        assert unpickled.read("n1.png") == read_stimulus("n1.png")
+
+    def test_stimulus_set(self, stimuli_zip):
+        stimulus_set = StimulusSet.from_files(get_csv_path(), stimuli_zip.parent,
+                                              stimulus_store=ZipStimulusStore(stimuli_zip))
+        stimulus_id = stimulus_set['stimulus_id'].values[0]
+        filename = stimulus_set['filename'].values[0]
+        image = imageio.imread(stimulus_set.get_stimulus(stimulus_id))
+        assert isinstance(image, np.ndarray) and image.size > 0
+        subset = stimulus_set[stimulus_set['stimulus_id'] == stimulus_id]
+        assert subset.get_stimulus(stimulus_id).read() == read_stimulus(filename)
+
+
+class TestRemoteZipStimulusStore:
+    @pytest.fixture
+    def remote(self, tmp_path):
+        """ A zip file of 100 members and a `read_range` function that records the requested ranges. """
+        zip_path = tmp_path / "remote" / "stimuli.zip"
+        zip_path.parent.mkdir()
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            for index in range(100):
+                zip_file.writestr(f"n{index}.png", os.urandom(1000))
+        content = zip_path.read_bytes()
+        requests = []
+
+        def read_range(start, end):
+            requests.append((start, end))
+            return content[start:end + 1]
+
+        return zip_path, len(content), read_range, requests
+
+    def make_store(self, remote, cache_directory, **kwargs):
+        zip_path, size, read_range, _ = remote
+        return brainio.stimuli.RemoteZipStimulusStore("http://example.com/stimuli.zip", size, read_range,
+                                                      cache_directory=cache_directory, **kwargs)
+
+    def expected(self, remote, name):
+        with zipfile.ZipFile(remote[0]) as zip_file:
+            return zip_file.read(name)
+
+    def test_index_from_central_directory(self, remote, tmp_path):
+        store = self.make_store(remote, tmp_path / "cache")
+        assert len(store) == 100
+        fetched = sum(end - start + 1 for start, end in remote[3])
+        assert fetched < 100 * 1000 / 10
+        assert not os.path.exists(tmp_path / "cache")
+
+    def test_fetch_on_access(self, remote, tmp_path):
+        store = self.make_store(remote, tmp_path / "cache")
+        remote[3].clear()
+        with store.open("n42.png") as f:
+            assert f.read() == self.expected(remote, "n42.png")
+        assert len(remote[3]) == 1
+        assert store.read("n42.png") == self.expected(remote, "n42.png")
+        assert len(remote[3]) == 1
+        assert sorted(os.listdir(tmp_path / "cache")) == ["n42.png"]
+
+    def test_prefetch_coalesces(self, remote, tmp_path):
+        store = self.make_store(remote, tmp_path / "cache", max_gap=0)
+        remote[3].clear()
+        assert store.prefetch([f"n{index}.png" for index in [3, 4, 5, 50, 51, 90]]) == 6
+        assert len(remote[3]) == 3
+        assert store.prefetch(["n3.png", "n4.png"]) == 0
+        assert len(remote[3]) == 3
+        assert store.read("n51.png") == self.expected(remote, "n51.png")
+
+    def test_prefetch_splits_large_requests(self, remote, tmp_path):
+        store = self.make_store(remote, tmp_path / "cache", max_request_size=5000)
+        remote[3].clear()
+        store.prefetch(store.names())
+        assert len(remote[3]) > 20
+        assert all(end - start + 1 <= 5000 for start, end in remote[3])
+        assert all(store.read(name) == self.expected(remote, name) for name in store.names())
+
+    def test_corrupt(self, remote, tmp_path):
+        zip_path, size, read_range, _ = remote
+        expected = self.expected(remote, "n7.png")
+
+        def corrupting_read_range(start, end):
+            return read_range(start, end).replace(expected, bytes(len(expected)))
+
+        store = brainio.stimuli.RemoteZipStimulusStore("http://example.com/stimuli.zip", size, corrupting_read_range,
+                                                       cache_directory=tmp_path / "cache")
+        with pytest.raises(zipfile.BadZipFile):
+            store.read("n7.png")
+        assert not os.path.exists(tmp_path / "cache" / "n7.png")
+
+    def test_directory_cache(self, remote, tmp_path):
+        directory_cache_path = str(tmp_path / "cache" / ".stimuli.zip.directory")
+        self.make_store(remote, tmp_path / "cache", directory_cache_path=directory_cache_path)
+        remote[3].clear()
+        store = self.make_store(remote, tmp_path / "cache", directory_cache_path=directory_cache_path)
+        assert len(store) == 100
+        assert remote[3] == []
+
+    def test_unsafe_name(self, tmp_path):
+        zip_path = tmp_path / "unsafe.zip"
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            zip_file.writestr("../escaped.png", b"escaped")
+        content = zip_path.read_bytes()
+        store = brainio.stimuli.RemoteZipStimulusStore(
+            "http://example.com/unsafe.zip", len(content), lambda start, end: content[start:end + 1],
+            cache_directory=tmp_path / "cache")
+        with pytest.raises(zipfile.BadZipFile):
+            store.read("../escaped.png")
+        assert not os.path.exists(tmp_path / "escaped.png")
+
+
+class TestStimulusPaths:
+    def test_mapping(self):
+        stimulus_paths = brainio.stimuli.StimulusPaths(['n0', 'n1'], ['n0.png', 'sub/n1.png'], directory='/stimuli')
+        assert stimulus_paths['n1'] == Path('/stimuli/sub/n1.png')
+        assert 'n0' in stimulus_paths and 'n2' not in stimulus_paths and 0 not in stimulus_paths
+        with pytest.raises(KeyError):
+            stimulus_paths['n2']
+        assert len(stimulus_paths) == 2
+        assert list(stimulus_paths.values()) == [Path('/stimuli/n0.png'), Path('/stimuli/sub/n1.png')]
+        assert stimulus_paths == {'n0': Path('/stimuli/n0.png'), 'n1': Path('/stimuli/sub/n1.png')}
+        assert pickle.loads(pickle.dumps(stimulus_paths)) == stimulus_paths
+
+    def test_duplicates_keep_last(self):
+        stimulus_paths = brainio.stimuli.StimulusPaths([0, 1, 0], ['a.png', 'b.png', 'c.png'])
+        assert dict(stimulus_paths.items()) == {0: 'c.png', 1: 'b.png'}
+
+    def test_modify(self):
+        stimulus_paths = brainio.stimuli.StimulusPaths(['n0', 'n1', 'n2'], ['n0.png', 'n1.png', 'n2.png'],
+                                                       directory='/stimuli')
+        copy = stimulus_paths.copy()
+        stimulus_paths['n1'] = Path('/elsewhere/n1.png')
+        stimulus_paths['n3'] = Path('/stimuli/n3.png')
+        del stimulus_paths['n0']
+        assert stimulus_paths == {'n1': Path('/elsewhere/n1.png'), 'n2': Path('/stimuli/n2.png'),
+                                  'n3': Path('/stimuli/n3.png')}
+        assert len(stimulus_paths) == 3 and 'n0' not in stimulus_paths
+        with pytest.raises(KeyError):
+            del stimulus_paths['n0']
+        assert len(copy) == 3 and copy['n1'] == Path('/stimuli/n1.png')
+        stimulus_paths.clear()
+        assert len(stimulus_paths) == 0 and dict(stimulus_paths) == {}
+
+
+class TestLoadExistence:
+    def test_single_scan(self, monkeypatch):
+        monkeypatch.setattr(Path, "is_file", lambda self: pytest.fail("checked file by file"))
+        stimulus_set = StimulusSet.from_files(get_csv_path(), get_dir_path())
+        assert isinstance(stimulus_set.stimulus_paths, brainio.stimuli.StimulusPaths)
+        assert os.path.isfile(stimulus_set.get_stimulus('n3'))
+
+    def test_known_files(self, monkeypatch):
+        monkeypatch.setattr(os, "scandir", lambda *args: pytest.fail("scanned"))
+        stimulus_set = StimulusSet.from_files(get_csv_path(), get_dir_path(),
+                                              stimulus_files=[f"n{index}.png" for index in range(10)])
+        assert len(stimulus_set) == 10
+
+    def test_nested(self, tmp_path):
+        (tmp_path / "sub").mkdir()
+        (tmp_path / "sub" / "n0.png").write_bytes(b"stimulus")
+        (tmp_path / "n1.png").write_bytes(b"stimulus")
+        csv_path = tmp_path / "stimuli.csv"
+        pd.DataFrame({'stimulus_id': ['n0', 'n1'], 'filename': ['sub/n0.png', str(tmp_path / "n1.png")]}) \
+            .to_csv(csv_path, index=False)
+        stimulus_set = StimulusSet.from_files(csv_path, tmp_path)
+        assert stimulus_set.get_stimulus('n0') == tmp_path / "sub" / "n0.png"
+        assert stimulus_set.get_stimulus('n1') == tmp_path / "n1.png"
+
+    def test_missing(self, tmp_path):
+        csv_path = tmp_path / "stimuli.csv"
+        pd.DataFrame({'stimulus_id': ['n0'], 'filename': ['n0.png']}).to_csv(csv_path, index=False)
+        with pytest.raises(AssertionError, match="1 stimulus files missing"):
+            StimulusSet.from_files(csv_path, tmp_path)
+
+
+class TestCompactDtypes:
+    @pytest.fixture
+    def csv_path(self, tmp_path):
+        csv_path = tmp_path / "stimuli.csv"
+        for index in range(100):
+            (tmp_path / f"n{index}.png").write_bytes(b"stimulus")
+        pd.DataFrame({'stimulus_id': [f"n{index}" for index in range(100)],
+                      'filename': [f"n{index}.png" for index in range(100)],
+                      'object_name': [f"object{index % 5}" for index in range(100)],
+                      'repetition': [index % 3 for index in range(100)],
+                      'ty': [index / 4 for index in range(100)],
+                      'tz': [index / 3 for index in range(100)],
+                      'background_id': [str(index % 2) if index % 10 else None for index in range(100)]}) \
+            .to_csv(csv_path, index=False)
+        return csv_path
+
+    def test_infer(self, csv_path):
+        dtypes = brainio.dtypes.infer_compact_dtypes(pd.read_csv(csv_path), exclude=['stimulus_id'])
+        assert dtypes == {'object_name': 'category', 'repetition': 'int8', 'ty': 'float32', 'background_id': 'float32'}
+
+    def test_opt_in(self, csv_path, monkeypatch):
+        monkeypatch.delenv(brainio.dtypes.BRAINIO_COMPACT_METADATA, raising=False)
+        assert StimulusSet.from_files(csv_path, csv_path.parent)['object_name'].dtype == object
+        monkeypatch.setenv(brainio.dtypes.BRAINIO_COMPACT_METADATA, "1")
+        assert isinstance(StimulusSet.from_files(csv_path, csv_path.parent)['object_name'].dtype,
+                          pd.CategoricalDtype)
+
+    def test_load(self, csv_path):
+        stimulus_set = StimulusSet.from_files(csv_path, csv_path.parent, compact=True)
+        assert stimulus_set['stimulus_id'].dtype == object
+        assert stimulus_set['filename'].dtype == object
+        assert isinstance(stimulus_set['object_name'].dtype, pd.CategoricalDtype)
+        assert stimulus_set['repetition'].dtype == np.int8
+        assert stimulus_set['tz'].dtype == np.float64
+        assert stimulus_set.get_stimulus('n42') == csv_path.parent / "n42.png"
+        plain = StimulusSet.from_files(csv_path, csv_path.parent, compact=False)
+        assert plain['repetition'].dtype == np.int64
+        assert stimulus_set.attrs[brainio.dtypes.COMPACT_ATTRIBUTE]
+        assert brainio.dtypes.COMPACT_ATTRIBUTE not in plain.attrs
+        assert (stimulus_set['object_name'] == plain['object_name']).all()
+        assert stimulus_set.memory_usage(deep=True).sum() < plain.memory_usage(deep=True).sum()
+
+    def test_savings_logged(self, csv_path, caplog):
+        with caplog.at_level('DEBUG', logger='brainio.dtypes'):
+            StimulusSet.from_files(csv_path, csv_path.parent, compact=True)
+        assert "bytes saved" in caplog.text
+
+    def test_sidecar(self, csv_path, monkeypatch):
+        assert brainio.stimuli.write_dtypes_sidecar(csv_path)['repetition'] == 'int8'
+        monkeypatch.setattr(brainio.dtypes, "infer_compact_dtypes", lambda *args, **kwargs: pytest.fail("inferred"))
+        stimulus_set = StimulusSet.from_files(csv_path, csv_path.parent, compact=True)
+        assert stimulus_set['repetition'].dtype == np.int8
+
+    def test_sidecar_values_do_not_fit(self, csv_path):
+        with open(str(csv_path) + brainio.stimuli.DTYPES_SIDECAR_SUFFIX, 'w') as f:
+            f.write('{"stimulus_id": "category", "tz": "float32", "repetition": "bool"}')
+        stimulus_set = StimulusSet.from_files(csv_path, csv_path.parent, compact=True)
+        assert stimulus_set['stimulus_id'].dtype == object
+        assert stimulus_set['tz'].dtype == np.float64
+        assert stimulus_set['repetition'].dtype == np.int8
+
+    def test_categorical_behavior(self, csv_path):
+        stimulus_set = StimulusSet.from_files(csv_path, csv_path.parent, compact=True)
+        # categories without rows are only left out of groupby with observed=True
+        subset = stimulus_set[stimulus_set['object_name'] != "object0"]
+        assert len(subset.groupby('object_name', observed=False).size()) == 5
+        assert len(subset.groupby('object_name', observed=True).size()) == 4
+        # values outside of the categories can only be assigned after adding them
+        with pytest.raises(TypeError):
+            stimulus_set.loc[0, 'object_name'] = "new_object"
+        stimulus_set['object_name'] = stimulus_set['object_name'].cat.add_categories(["new_object"])
+        stimulus_set.loc[0, 'object_name'] = "new_object"
+        assert stimulus_set.loc[0, 'object_name'] == "new_object"